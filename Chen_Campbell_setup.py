@@ -39,6 +39,7 @@ simulateBOLD.warmUpFactor = 0.1
 # simulateBOLD.Toffset = 30.
 simulateBOLD.Tmaxneuronal = int(simulateBOLD.Tmax * simulateBOLD.TR)
 integrator.ds = 0.001  # record every TR seconds
+integrator.recordedObsVars = [0]  # only r_exc feeds the BOLD model, so do not keep the other observation vars
 
 import WholeBrain.Observables.BOLDFilters as BOLDFilters
 BOLDFilters.TR = 2.
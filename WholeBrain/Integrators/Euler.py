@@ -10,7 +10,9 @@
 # --------------------------------------------------------------------------
 # --------------------------------------------------------------------------
 import numpy as np
-from WholeBrain.Utils import numTricks as iC
+import WholeBrain.Utils.parallelKernels as parallelKernels
+import WholeBrain.Utils.jitCache as jitCache
+from WholeBrain.Utils import precision
 from numba import jit
 
 print("Going to use the Euler Integrator...")
@@ -31,15 +33,40 @@ def recompileSignatures():
 
 # Functions to convert the stimulus from a function to an array
 # --------------------------------------------------------------------------
+# Stimuli modules with a vectorized stimulusSamples(tValues) generate the whole (time, regions) array with
+# a single call. Otherwise, we fall back to calling stimulus(t) once per time step. For long runs, set
+# stimuliChunkSize to generate (and integrate) the stimuli lazily, stimuliChunkSize time steps at a time.
 stimuli = None  # To add some stimuli, if needed...
+stimuliChunkSize = None
+stimuliRegionMap = None  # per-region weights of the stimuli, passed to them (None = the same stimulus at all the regions)
 allStimuli = None
+stimuliDt = None
+numStimuliSteps = 0
 def initStimuli(dt, Tmaxneuronal):
-    global allStimuli
-    tValues = np.arange(0, Tmaxneuronal, dt)
-    if stimuli is not None:
-        allStimuli = np.array(list(map(stimuli.stimulus, tValues)))
+    global allStimuli, stimuliDt, numStimuliSteps
+    stimuliDt = dt
+    numStimuliSteps = len(np.arange(0, Tmaxneuronal, dt))
+    allStimuli = generateStimuli(0, numStimuliSteps) if stimuliChunkSize is None else None
+
+
+def generateStimuli(firstStep, numSteps):
+    tValues = np.arange(firstStep, firstStep + numSteps) * stimuliDt
+    if stimuli is None:
+        return np.zeros(numSteps)
+    if hasattr(stimuli, 'stimulusSamples'):
+        return stimuli.stimulusSamples(tValues, stimuliRegionMap)
+    if stimuliRegionMap is None:  # also works with stimuli that do not know about region maps
+        return np.array(list(map(stimuli.stimulus, tValues)))
+    return np.array([stimuli.stimulus(t, stimuliRegionMap) for t in tValues])
+
+
+# Yields (firstStep, stimuli values) for consecutive chunks of the stimuli set up by initStimuli
+def stimuliChunks():
+    if allStimuli is not None:
+        yield 0, allStimuli
     else:
-        allStimuli = np.zeros(len(tValues))
+        for firstStep in range(0, numStimuliSteps, stimuliChunkSize):
+            yield firstStep, generateStimuli(firstStep, min(stimuliChunkSize, numStimuliSteps - firstStep))
 
 
 # bookkeeping vars & methods -> Just forward them to the neuronal model we are using...
@@ -48,24 +75,43 @@ def initStimuli(dt, Tmaxneuronal):
 # ==========================================================================
 # Bookkeeping variables of interest...
 # --------------------------------------------------------------------------
+# What we record is given by a recording spec: which observation vars we keep (recordedObsVars, None for
+# all of them), the downsampling stepsize ds (converted to an integer stride of integration steps) and an
+# optional on-the-fly reduction over each stride (recordReduction = 'mean' stores the mean of all the steps
+# in each ds window instead of a single sample). E.g., if only the first observation var is used
+# afterwards, set recordedObsVars = [0] and the memory needed drops accordingly.
 ds = 1  # downsampling stepsize
+recordedObsVars = None
+recordReduction = None
+def recordingSpec(dt):
+    stride = max(int(np.round(ds/dt)), 1)
+    if recordedObsVars is None:
+        obsIdx = np.arange(neuronalModel.numObsVars())
+    else:
+        obsIdx = np.asarray(recordedObsVars, dtype=np.int64)
+    return stride, obsIdx, recordReduction == 'mean'
+
+
 # # @jit(nopython=True)
-def initBookkeeping(N, tmax):
+def initBookkeeping(N, tmax, trialShape=()):
     # global curr_xn, curr_rn, nn
     # global curr_obsVars
     # curr_xn = np.zeros((int(tmax), N))
     # curr_rn = np.zeros((int(tmax), N))
-    obsVars = neuronalModel.numObsVars()
+    # trialShape is () for a single simulation, or (numTrials,) for an ensemble of trials
+    obsVars = neuronalModel.numObsVars() if recordedObsVars is None else len(recordedObsVars)
     timeElements = int(tmax/ds) + 1  # the last +1 because of isClose roundings...
-    return np.zeros((timeElements, obsVars, N))
+    return np.zeros((timeElements,) + trialShape + (obsVars, N), dtype=precision.floatType)
 
 
 @jit(nopython=True)
-def recordBookkeeping(t, obsVars, curr_obsVars):
+def recordBookkeeping(n, obsVars, curr_obsVars, stride, obsIdx, meanReduction):
     # global curr_obsVars
-    if iC.isInt(t/ds):
-        nn = int(np.round(t/ds))  # it is an int-ish...
-        curr_obsVars[nn,:,:] = obsVars[:,:]
+    # n is the integration step, and (stride, obsIdx, meanReduction) come from recordingSpec(dt)
+    if meanReduction:
+        curr_obsVars[n // stride] += obsVars[..., obsIdx, :] / stride
+    elif n % stride == 0:
+        curr_obsVars[n // stride] = obsVars[..., obsIdx, :]  # (obsVars, N) or (trials, obsVars, N)
     return curr_obsVars
 
 
@@ -77,59 +123,122 @@ def recordBookkeeping(t, obsVars, curr_obsVars):
 # sigma = 0.01
 clamping = True
 @jit(nopython=True)
-def integrationStep(simVars, dt, stimulus):  #, curr_obsVars, doBookkeeping):
+def integrationStep(dfun, simVars, dt, stimulus, parms):  #, curr_obsVars, doBookkeeping):
     # numSimVars = simVars.shape[0]; N = simVars.shape[1]
-    dvars_obsVars = neuronalModel.dfun(simVars, stimulus)
+    stateType = simVars.dtype  # the model constants are double precision, so we go back to the state precision at the end
+    dvars_obsVars = dfun(simVars, stimulus, parms)  # the model dfun is passed at run time
     dvars = dvars_obsVars[0]; obsVars = dvars_obsVars[1]  # cannot use unpacking in numba...
     simVars = simVars + dt * dvars  # Euler integration for S^E (9).
     if clamping:
         simVars = np.where(simVars > 1., 1., simVars)  # clamp values to 0..1
         simVars = np.where(simVars < 0., 0., simVars)
-    return simVars, obsVars
+    return simVars.astype(stateType), obsVars
 
 
 # # @jit(nopython=True)
-def integrationLoop(dt, Tmaxneuronal, simVars, doBookkeeping, curr_obsVars):
+def integrationLoop(dt, Tmaxneuronal, simVars, doBookkeeping, curr_obsVars, parms):
     # Variables:
     # dt = integration time step in milliseconds
     # Tmaxneuronal = total time to integrate in milliseconds
-    for t in np.arange(0, Tmaxneuronal, dt):
-        stimulus = allStimuli[int(t / dt)]
-        simVars_obsVars = integrationStep(simVars, dt, stimulus)
+    # parms = the model parameters, as returned by neuronalModel.getRuntimeParms()
+    recording = recordingSpec(dt)
+    for firstStep, stimuliValues in stimuliChunks():
+        simVars, curr_obsVars = integrateSteps(dt, simVars, doBookkeeping, curr_obsVars, stimuliValues, firstStep, 0,
+                                               parms, recording)
+    return simVars, curr_obsVars
+
+
+# Integrates the steps firstStep, firstStep+1, ... (one per stimuliValues entry), recording them in
+# curr_obsVars from the step firstRecordedStep on.
+def integrateSteps(dt, simVars, doBookkeeping, curr_obsVars, stimuliValues, firstStep, firstRecordedStep, parms, recording):
+    jitCache.cacheFunctions(globals()); jitCache.cacheFunctions(neuronalModel)  # before anything gets compiled
+    parallelKernels.applyNumThreads()
+    dfun = parallelKernels.parallelVersion(neuronalModel.dfun) if parallelKernels.enabled else neuronalModel.dfun
+    record = recorder(curr_obsVars, recordBookkeeping)
+    for n in range(firstStep, firstStep + len(stimuliValues)):
+        simVars_obsVars = integrationStep(dfun, simVars, dt, stimuliValues[n - firstStep], parms)
         simVars = simVars_obsVars[0]; obsVars = simVars_obsVars[1]  # cannot use unpacking in numba...
         if doBookkeeping:
-            curr_obsVars = recordBookkeeping(t, obsVars, curr_obsVars)
+            curr_obsVars = record(n - firstRecordedStep, obsVars, curr_obsVars, recording[0], recording[1], recording[2])
     return simVars, curr_obsVars
 
 
+# Online BOLD: the TR-sampled BOLD signal computed along with the integration, instead of the recorded
+# observation vars (see the comments at HeunStochastic.integrate)
+onlineBOLD = None
+def recorder(curr_obsVars, recordObsVars):
+    return onlineBOLD.recorder() if isinstance(curr_obsVars, tuple) else recordObsVars
+
+
 # # @jit(nopython=True)
 def integrate(dt, Tmaxneuronal, simVars, doBookkeeping = True):
     # numSimVars = simVars.shape[0]
-    N = simVars.shape[1]  # N = neuronalModel.SC.shape[0]  # size(C,1) #N = CFile["Order"].shape[1]
-    curr_obsVars = initBookkeeping(N, Tmaxneuronal)
-    return integrationLoop(dt, Tmaxneuronal, simVars, doBookkeeping, curr_obsVars)
+    N = simVars.shape[-1]  # N = neuronalModel.SC.shape[0]  # size(C,1) #N = CFile["Order"].shape[1]
+    if doBookkeeping and onlineBOLD is not None:
+        recording = onlineBOLD.initRecording(simVars.shape[:-2] + (N,), int(Tmaxneuronal/ds) + 1, ds)
+        simVars, recording = integrationLoop(dt, Tmaxneuronal, simVars, doBookkeeping, recording,
+                                             neuronalModel.getRuntimeParms())
+        return simVars, onlineBOLD.result(recording, simVars.shape[:-2] + (N,))
+    # Without bookkeeping, we just need a (dummy) single time element...
+    curr_obsVars = initBookkeeping(N, Tmaxneuronal if doBookkeeping else 0., simVars.shape[:-2])
+    return integrationLoop(dt, Tmaxneuronal, simVars, doBookkeeping, curr_obsVars,
+                           neuronalModel.getRuntimeParms())
+
+
+# Streaming integration: yields the recorded observables in blocks of (at most) blockSize time samples,
+# carrying the state from block to block (see the comments at HeunStochastic.integrateChunks)
+streamState = None
+def integrateChunks(dt, Tmaxneuronal, simVars, blockSize):
+    global allStimuli, stimuliDt, numStimuliSteps, streamState
+    allStimuli = None; stimuliDt = dt
+    numStimuliSteps = len(np.arange(0, Tmaxneuronal, dt))
+    recording = recordingSpec(dt)
+    parms = neuronalModel.getRuntimeParms()
+    stride = recording[0]
+    for firstStep in range(0, numStimuliSteps, blockSize * stride):
+        numSteps = min(blockSize * stride, numStimuliSteps - firstStep)
+        block = np.zeros((-(-numSteps // stride),) + simVars.shape[:-2] + (len(recording[1]), simVars.shape[-1]),
+                         dtype=precision.floatType)
+        simVars, block = integrateSteps(dt, simVars, True, block, generateStimuli(firstStep, numSteps), firstStep, firstStep,
+                                        parms, recording)
+        streamState = simVars
+        yield block
 
 
 # ==========================================================================
 # ==========================================================================
 # ==========================================================================
-def simulate(dt, Tmaxneuronal):
+# Initial values for the simulation. With numTrials, we get an ensemble of numTrials independent
+# trials, stacked along a new leading axis (trials, vars, N), that are integrated all together...
+def initSimVars(numTrials=None):
+    N = neuronalModel.getParm('SC').shape[0]  # size(C,1) #N = CFile["Order"].shape[1]
+    simVars = neuronalModel.initSim(N).astype(precision.floatType)
+    if numTrials is not None:
+        simVars = np.repeat(simVars[np.newaxis], numTrials, axis=0)
+    return simVars
+
+
+def simulate(dt, Tmaxneuronal, numTrials=None):
     if verbose:
         print("Simulating...", flush=True)
-    N = neuronalModel.getParm('SC').shape[0]  # size(C,1) #N = CFile["Order"].shape[1]
-    simVars = neuronalModel.initSim(N)
+    simVars = initSimVars(numTrials)
     initStimuli(dt, Tmaxneuronal)
     simVars, obsVars = integrate(dt, Tmaxneuronal, simVars)
     return obsVars
 
 
-def warmUpAndSimulate(dt, Tmaxneuronal, TWarmUp=10000):
-    N = neuronalModel.getParm('SC').shape[0]  # size(C,1) #N = CFile["Order"].shape[1]
-    simVars = neuronalModel.initSim(N)
+# The warm-up starts from initialSimVars, if given (e.g., a previously warmed-up state, see
+# WholeBrain.Utils.warmStateCache), or from initSimVars otherwise. The state reached at the end of
+# the warm-up is kept in warmState.
+warmState = None
+def warmUpAndSimulate(dt, Tmaxneuronal, TWarmUp=10000, numTrials=None, initialSimVars=None):
+    global warmState
+    simVars = initSimVars(numTrials) if initialSimVars is None else initialSimVars
     if verbose:
         print("Warming Up...", end=" ", flush=True)
     initStimuli(dt, TWarmUp)
     simVars, obsVars = integrate(dt, TWarmUp, simVars, doBookkeeping=False)
+    warmState = simVars
     if verbose:
         print("and simulating!!!", flush=True)
     initStimuli(dt, Tmaxneuronal)
@@ -150,11 +259,13 @@ if __name__ == '__main__':
         def __init__(self):
             pass
         # we will use the differential equation y'(t) = y(t).
-        def dfun(self, simVars, p):
+        def dfun(self, simVars, p, parms):
             y = simVars
             return y, y
         def recompileSignatures(self):
             pass
+        def getRuntimeParms(self):
+            return ()
         def numObsVars(self):
             return 1
 
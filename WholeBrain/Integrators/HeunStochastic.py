@@ -19,9 +19,12 @@
 # --------------------------------------------------------------------------
 # --------------------------------------------------------------------------
 import numpy as np
+import WholeBrain.Utils.noiseStreams as noiseStreams
 from WholeBrain.Utils.randn2 import randn2
-from WholeBrain.Utils import numTricks as iC
-from numba import jit
+import WholeBrain.Utils.parallelKernels as parallelKernels
+import WholeBrain.Utils.jitCache as jitCache
+from WholeBrain.Utils import precision
+from numba import jit, prange
 
 print("Going to use the Heun Integrator...")
 
@@ -29,6 +32,16 @@ neuronalModel = None  # To be able to choose the model externally...
 verbose = True
 
 
+# Matlab compatible definitions
+# --------------------------------------------------------------------------
+# With MatlabCompatibility = True, the noise of each step is drawn with randn2 (uniform samples from
+# NumPy's rand, turned into normal ones by inverse transform sampling) instead of coming from the noise
+# streams below, to compare against Matlab runs. It is checked at run time, and uses the Python loop.
+MatlabCompatibility = False
+def randn(*shape):
+    return randn2(*shape)
+
+
 def recompileSignatures():
     # Recompile all existing signatures. Since compiling isn’t cheap, handle with care...
     # However, this is "infinitely" cheaper than all the other computations we make around here ;-)
@@ -36,31 +49,49 @@ def recompileSignatures():
     neuronalModel.recompileSignatures()
     recordBookkeeping.recompile()
     integrationStep.recompile()
+    integrationLoopKernel.recompile()
+    integrationStepInPlace.recompile()
+    integrationStepInPlaceParallel.recompile()
+    integrationLoopKernelInPlace.recompile()
     pass
 
 
-# Matlab compatible definitions
-# --------------------------------------------------------------------------
-MatlabCompatibility = False
-if MatlabCompatibility:
-    def randn(vars,N):
-        ra = randn2(vars,N)
-        return ra #.reshape(-1)
-else:
-    from numpy.random import randn
-
-
 # Functions to convert the stimulus from a function to an array
 # --------------------------------------------------------------------------
+# Stimuli modules with a vectorized stimulusSamples(tValues) generate the whole (time, regions) array with
+# a single call. Otherwise, we fall back to calling stimulus(t) once per time step. For long runs, set
+# stimuliChunkSize to generate (and integrate) the stimuli lazily, stimuliChunkSize time steps at a time.
 stimuli = None  # To add some stimuli, if needed...
+stimuliChunkSize = None
+stimuliRegionMap = None  # per-region weights of the stimuli, passed to them (None = the same stimulus at all the regions)
 allStimuli = None
+stimuliDt = None
+numStimuliSteps = 0
 def initStimuli(dt, Tmaxneuronal):
-    global allStimuli
-    tValues = np.arange(0, Tmaxneuronal, dt)
-    if stimuli is not None:
-        allStimuli = np.array(list(map(stimuli.stimulus, tValues)))
+    global allStimuli, stimuliDt, numStimuliSteps
+    stimuliDt = dt
+    numStimuliSteps = len(np.arange(0, Tmaxneuronal, dt))
+    allStimuli = generateStimuli(0, numStimuliSteps) if stimuliChunkSize is None else None
+
+
+def generateStimuli(firstStep, numSteps):
+    tValues = np.arange(firstStep, firstStep + numSteps) * stimuliDt
+    if stimuli is None:
+        return np.zeros(numSteps)
+    if hasattr(stimuli, 'stimulusSamples'):
+        return stimuli.stimulusSamples(tValues, stimuliRegionMap)
+    if stimuliRegionMap is None:  # also works with stimuli that do not know about region maps
+        return np.array(list(map(stimuli.stimulus, tValues)))
+    return np.array([stimuli.stimulus(t, stimuliRegionMap) for t in tValues])
+
+
+# Yields (firstStep, stimuli values) for consecutive chunks of the stimuli set up by initStimuli
+def stimuliChunks():
+    if allStimuli is not None:
+        yield 0, allStimuli
     else:
-        allStimuli = np.zeros(len(tValues))
+        for firstStep in range(0, numStimuliSteps, stimuliChunkSize):
+            yield firstStep, generateStimuli(firstStep, min(stimuliChunkSize, numStimuliSteps - firstStep))
 
 
 # bookkeeping vars & methods -> Just forward them to the neuronal model we are using...
@@ -69,24 +100,43 @@ def initStimuli(dt, Tmaxneuronal):
 # ==========================================================================
 # Bookkeeping variables of interest...
 # --------------------------------------------------------------------------
+# What we record is given by a recording spec: which observation vars we keep (recordedObsVars, None for
+# all of them), the downsampling stepsize ds (converted to an integer stride of integration steps) and an
+# optional on-the-fly reduction over each stride (recordReduction = 'mean' stores the mean of all the steps
+# in each ds window instead of a single sample). E.g., if only the first observation var is used
+# afterwards, set recordedObsVars = [0] and the memory needed drops accordingly.
 ds = 1  # downsampling stepsize
+recordedObsVars = None
+recordReduction = None
+def recordingSpec(dt):
+    stride = max(int(np.round(ds/dt)), 1)
+    if recordedObsVars is None:
+        obsIdx = np.arange(neuronalModel.numObsVars())
+    else:
+        obsIdx = np.asarray(recordedObsVars, dtype=np.int64)
+    return stride, obsIdx, recordReduction == 'mean'
+
+
 # # @jit(nopython=True)
-def initBookkeeping(N, tmax):
+def initBookkeeping(N, tmax, trialShape=()):
     # global curr_xn, curr_rn, nn
     # global curr_obsVars
     # curr_xn = np.zeros((int(tmax), N))
     # curr_rn = np.zeros((int(tmax), N))
-    obsVars = neuronalModel.numObsVars()
+    # trialShape is () for a single simulation, or (numTrials,) for an ensemble of trials
+    obsVars = neuronalModel.numObsVars() if recordedObsVars is None else len(recordedObsVars)
     timeElements = int(tmax/ds) + 1  # the last +1 because of isClose roundings...
-    return np.zeros((timeElements, obsVars, N))
+    return np.zeros((timeElements,) + trialShape + (obsVars, N), dtype=precision.floatType)
 
 
 @jit(nopython=True)
-def recordBookkeeping(t, obsVars, curr_obsVars):
+def recordBookkeeping(n, obsVars, curr_obsVars, stride, obsIdx, meanReduction):
     # global curr_obsVars
-    if iC.isInt(t/ds):
-        nn = int(np.round(t/ds))  # it is an int-ish...
-        curr_obsVars[nn,:,:] = obsVars[:,:]
+    # n is the integration step, and (stride, obsIdx, meanReduction) come from recordingSpec(dt)
+    if meanReduction:
+        curr_obsVars[n // stride] += obsVars[..., obsIdx, :] / stride
+    elif n % stride == 0:
+        curr_obsVars[n // stride] = obsVars[..., obsIdx, :]  # (obsVars, N) or (trials, obsVars, N)
     return curr_obsVars
 
 
@@ -95,77 +145,308 @@ def recordBookkeeping(t, obsVars, curr_obsVars):
 # ==========================================================================
 # Heun Stochastic Integration
 # --------------------------------------------------------------------------
+# The model dfun, its parameters (parms, from neuronalModel.getRuntimeParms()) and the noise amplitude
+# (sigma) are passed at run time, so changing them does not need any recompilation (numba just
+# specializes the code once for each model). Only clamping is a compile-time setting (see
+# recompileIfNeeded below).
 sigma = 0.01
 clamping = False
 @jit(nopython=True)
-def integrationStep(simVars, dt, stimulus):  #, curr_obsVars, doBookkeeping):
+def integrationStep(dfun, simVars, dt, stimulus, parms, sigma, stdNoise):  #, curr_obsVars, doBookkeeping):
     def doClamping(simVariables):
         if clamping:
             simVariables = np.where(simVariables < 0., 0., simVariables)
         return simVariables
 
-    numSimVars = simVars.shape[0]; N = simVars.shape[1]
-    dvars_obsVars = neuronalModel.dfun(simVars, stimulus)
+    stateType = simVars.dtype  # the model constants are double precision, so we go back to the state precision at the end
+    dvars_obsVars = dfun(simVars, stimulus, parms)
     dvars = dvars_obsVars[0]; obsVars = dvars_obsVars[1]  # cannot use unpacking in numba...
 
-    noise = np.sqrt(dt) * sigma * randn(numSimVars,N)
+    noise = np.sqrt(dt) * sigma * stdNoise  # independent noise for each trial, if any
 
     inter = simVars + dt * dvars + noise
-    inter = doClamping(inter)
+    inter = doClamping(inter).astype(stateType)
 
-    dvars_obsVars = neuronalModel.dfun(inter, stimulus)
+    dvars_obsVars = dfun(inter, stimulus, parms)
     dvars2 = dvars_obsVars[0]; obsVars = dvars_obsVars[1]  # cannot use unpacking in numba...
     dX = (dvars + dvars2) * dt / 2.0
 
     simVars = simVars + dX + noise
-    simVars = doClamping(simVars)
+    simVars = doClamping(simVars).astype(stateType)
 
     return simVars, obsVars
 
 
 # # @jit(nopython=True)
-def integrationLoop(dt, Tmaxneuronal, simVars, doBookkeeping, curr_obsVars):
+def integrationLoop(dt, Tmaxneuronal, simVars, doBookkeeping, curr_obsVars, parms):
     # Variables:
     # dt = integration time step in milliseconds
     # Tmaxneuronal = total time to integrate in milliseconds
-    for t in np.arange(0, Tmaxneuronal, dt):
-        stimulus = allStimuli[int(t / dt)]
-        simVars_obsVars = integrationStep(simVars, dt, stimulus)
+    # parms = the model parameters, as returned by neuronalModel.getRuntimeParms()
+    recording = recordingSpec(dt)
+    noise = initNoise(simVars.shape, numStimuliSteps)
+    for firstStep, stimuliValues in stimuliChunks():
+        simVars, curr_obsVars = integrateSteps(dt, simVars, doBookkeeping, curr_obsVars, stimuliValues, firstStep, 0,
+                                               parms, recording, noise)
+    return simVars, curr_obsVars
+
+
+# Integrates the steps firstStep, firstStep+1, ... (one per stimuliValues entry), recording them in
+# curr_obsVars from the step firstRecordedStep on.
+def integrateSteps(dt, simVars, doBookkeeping, curr_obsVars, stimuliValues, firstStep, firstRecordedStep, parms, recording, noise):
+    jitCache.cacheFunctions(globals()); jitCache.cacheFunctions(neuronalModel)  # before anything gets compiled
+    parallelKernels.applyNumThreads()
+    if nopythonLoop and not MatlabCompatibility and inPlaceKernels and hasattr(neuronalModel, 'dfunInPlace'):
+        simVars = simVars.copy()  # the state is updated in place, do not overwrite the caller's array
+        if parallelKernels.enabled:
+            stepInPlace = integrationStepInPlaceParallel
+            dfunInPlace = getattr(neuronalModel, 'dfunInPlaceParallel', neuronalModel.dfunInPlace)
+        else:
+            stepInPlace = integrationStepInPlace
+            dfunInPlace = neuronalModel.dfunInPlace
+        return integrationLoopKernelInPlace(stepInPlace, dfunInPlace, dt, simVars, doBookkeeping, curr_obsVars,
+                                            stimuliValues, firstStep, firstRecordedStep, parms, sigma, recording, noise,
+                                            initInPlaceBuffers(simVars), recorder(curr_obsVars, recordBookkeepingInPlace))
+    if nopythonLoop and not MatlabCompatibility:
+        dfun = parallelKernels.parallelVersion(neuronalModel.dfun) if parallelKernels.enabled else neuronalModel.dfun
+        return integrationLoopKernel(dfun, dt, simVars, doBookkeeping, curr_obsVars,
+                                     stimuliValues, firstStep, firstRecordedStep, parms, sigma, recording, noise,
+                                     recorder(curr_obsVars, recordBookkeeping))
+    record = recorder(curr_obsVars, recordBookkeeping)
+    keys, noiseOffset, noiseBlock, stepsNoise = noise
+    blockSteps = noiseBlock.shape[0]
+    for n in range(firstStep, firstStep + len(stimuliValues)):
+        if MatlabCompatibility:
+            stdNoise = randn(*simVars.shape)
+        else:
+            if n == firstStep or n % blockSteps == 0:
+                noiseStreams.fillNormals(noiseBlock, keys, noiseOffset + n - n % blockSteps)
+            stdNoise = stepsNoise[n % blockSteps]
+        simVars_obsVars = integrationStep(neuronalModel.dfun, simVars, dt, stimuliValues[n - firstStep], parms, sigma, stdNoise)
+        simVars = simVars_obsVars[0]; obsVars = simVars_obsVars[1]  # cannot use unpacking in numba...
+        if doBookkeeping:
+            curr_obsVars = record(n - firstRecordedStep, obsVars, curr_obsVars, recording[0], recording[1], recording[2])
+    return simVars, curr_obsVars
+
+
+# Whole-loop integration: the time loop itself (stimulus lookup, predictor/corrector, noise, clamping
+# and recording) runs inside a single compiled kernel, so we do not cross the Python/numba boundary
+# at every time step. Requires a neuronal model with a compiled (@jit) dfun. Set nopythonLoop = False
+# to go back to the Python loop above (e.g., for debugging a non-compiled model).
+# --------------------------------------------------------------------------
+nopythonLoop = True
+@jit(nopython=True)
+def integrationLoopKernel(dfun, dt, simVars, doBookkeeping, curr_obsVars, stimuliValues, firstStep, firstRecordedStep, parms, sigma, recording, noise, record):
+    # stimuliValues has one entry per time step, starting at the step firstStep (see stimuliChunks),
+    # so the step index directly gives us the stimulus (and the time, n * dt)...
+    stride = recording[0]; obsIdx = recording[1]; meanReduction = recording[2]
+    keys = noise[0]; noiseOffset = noise[1]; noiseBlock = noise[2]; stepsNoise = noise[3]
+    blockSteps = noiseBlock.shape[0]
+    for n in range(firstStep, firstStep + stimuliValues.shape[0]):
+        if n == firstStep or n % blockSteps == 0:
+            noiseStreams.fillNormals(noiseBlock, keys, noiseOffset + n - n % blockSteps)
+        simVars_obsVars = integrationStep(dfun, simVars, dt, stimuliValues[n - firstStep], parms, sigma, stepsNoise[n % blockSteps])
         simVars = simVars_obsVars[0]; obsVars = simVars_obsVars[1]  # cannot use unpacking in numba...
         if doBookkeeping:
-            curr_obsVars = recordBookkeeping(t, obsVars, curr_obsVars)
+            curr_obsVars = record(n - firstRecordedStep, obsVars, curr_obsVars, stride, obsIdx, meanReduction)
     return simVars, curr_obsVars
 
 
+# In-place integration: for models that provide a dfunInPlace (which writes the derivatives, and the
+# observation vars only when asked to, into caller-provided buffers), the whole integration step works on
+# pre-allocated buffers and updates the state in place, so the time loop does not allocate anything.
+# Results are the same as with the regular kernel. Set inPlaceKernels = False to always use dfun.
+# --------------------------------------------------------------------------
+inPlaceKernels = True
+def initInPlaceBuffers(simVars):
+    N = simVars.shape[-1]
+    obsVars = np.empty(simVars.shape[:-2] + (neuronalModel.numObsVars(), N), dtype=simVars.dtype)
+    coupling = np.empty((int(np.prod(simVars.shape[:-2])), N), dtype=simVars.dtype)
+    return np.empty_like(simVars), np.empty_like(simVars), np.empty_like(simVars), obsVars, coupling
+
+
+@jit(nopython=True)
+def integrationStepInPlace(dfunInPlace, simVars, dt, stimulus, parms, sigma, stdNoise, buffers, computeObs):
+    dvars = buffers[0]; dvars2 = buffers[1]; inter = buffers[2]; obsVars = buffers[3]; coupling = buffers[4]
+    state = simVars.reshape(-1); derivs = dvars.reshape(-1); derivs2 = dvars2.reshape(-1)
+    interState = inter.reshape(-1); noise = stdNoise.reshape(-1)
+    noiseScale = np.sqrt(dt) * sigma
+
+    dfunInPlace(simVars, stimulus, parms, dvars, obsVars, False, coupling)
+    for i in prange(state.shape[0]):
+        value = state[i] + dt * derivs[i] + noiseScale * noise[i]
+        if clamping and value < 0.:
+            value = 0.
+        interState[i] = value
+
+    dfunInPlace(inter, stimulus, parms, dvars2, obsVars, computeObs, coupling)
+    for i in prange(state.shape[0]):
+        value = state[i] + (derivs[i] + derivs2[i]) * dt / 2.0 + noiseScale * noise[i]
+        if clamping and value < 0.:
+            value = 0.
+        state[i] = value
+# the same step, with its loops spread across threads (see WholeBrain.Utils.parallelKernels)
+integrationStepInPlaceParallel = jit(nopython=True, parallel=True)(integrationStepInPlace.py_func)
+
+
+@jit(nopython=True)
+def recordBookkeepingInPlace(n, obsVars, curr_obsVars, stride, obsIdx, meanReduction):
+    N = obsVars.shape[-1]
+    obs = obsVars.reshape((-1, obsVars.shape[-2], N))
+    record = curr_obsVars[n // stride].reshape((-1, obsIdx.shape[0], N))
+    for bb in range(obs.shape[0]):
+        for k in range(obsIdx.shape[0]):
+            for i in range(N):
+                if meanReduction:
+                    record[bb, k, i] += obs[bb, obsIdx[k], i] / stride
+                else:
+                    record[bb, k, i] = obs[bb, obsIdx[k], i]
+
+
+@jit(nopython=True)
+def integrationLoopKernelInPlace(stepInPlace, dfunInPlace, dt, simVars, doBookkeeping, curr_obsVars, stimuliValues, firstStep, firstRecordedStep, parms, sigma, recording, noise, buffers, recordInPlace):
+    stride = recording[0]; obsIdx = recording[1]; meanReduction = recording[2]
+    keys = noise[0]; noiseOffset = noise[1]; noiseBlock = noise[2]; stepsNoise = noise[3]
+    blockSteps = noiseBlock.shape[0]
+    for n in range(firstStep, firstStep + stimuliValues.shape[0]):
+        if n == firstStep or n % blockSteps == 0:
+            noiseStreams.fillNormals(noiseBlock, keys, noiseOffset + n - n % blockSteps)
+        record = doBookkeeping and (meanReduction or (n - firstRecordedStep) % stride == 0)
+        stepInPlace(dfunInPlace, simVars, dt, stimuliValues[n - firstStep], parms, sigma, stepsNoise[n % blockSteps], buffers, record)
+        if record:
+            recordInPlace(n - firstRecordedStep, buffers[3], curr_obsVars, stride, obsIdx, meanReduction)
+    return simVars, curr_obsVars
+
+
+# Noise generation
+# --------------------------------------------------------------------------
+# The noise comes from counter-based streams (see WholeBrain.Utils.noiseStreams), generated in blocks of
+# noiseBlockSize values instead of one small array per step. Each trial has its own stream (trial k uses
+# stream k, unless noiseStreamIds says otherwise), so its noise does not depend on how many trials are
+# integrated together, or on how they are distributed among threads or processes.
+# With noiseSeed = None, each integrate call draws a new seed from NumPy's global RNG (so, np.random.seed
+# still makes runs reproducible). Use seedNoise(seed) to fix it: then the streams go on across calls,
+# i.e., a warm-up followed by a simulation gets the same noise as a single longer integration.
+noiseSeed = None
+noiseStreamIds = None
+noiseBlockSize = 2**18
+noiseCounter = 0
+def seedNoise(seed, streamIds=None):
+    global noiseSeed, noiseStreamIds, noiseCounter
+    noiseSeed = seed
+    noiseStreamIds = streamIds
+    noiseCounter = 0
+
+
+def initNoise(shape, numSteps):
+    global noiseCounter
+    if noiseSeed is None:  # with MatlabCompatibility the streams are not used, and NumPy's RNG is left to randn2
+        seed = 0 if MatlabCompatibility else np.random.randint(2**62); firstStep = 0
+    else:
+        seed = noiseSeed; firstStep = noiseCounter
+        noiseCounter += numSteps
+    keys, noiseBlock, stepsNoise = noiseStreams.initNoiseBlock(seed, noiseStreamIds, shape, numSteps, noiseBlockSize,
+                                                               dtype=precision.floatType)
+    return keys, firstStep, noiseBlock, stepsNoise
+
+
+# Numba freezes global values at compile time, so we only need to recompile when one of the
+# compile-time settings has changed since the last compilation. The model, its parameters and sigma
+# are passed at run time, so a model is compiled once and parameter sweeps do not recompile anything.
+compiledSettings = None
+def recompileIfNeeded():
+    global compiledSettings
+    currentSettings = (clamping,)
+    if compiledSettings is not None and currentSettings != compiledSettings:
+        recompileSignatures()
+    compiledSettings = currentSettings
+
+
+# Online BOLD: with onlineBOLD = WholeBrain.Utils.BOLD.onlineBOLD (with its BOLDModel and TR set), integrate
+# (with bookkeeping) advances the hemodynamic state along with the neural one, from the first recorded
+# observation var, and returns the TR-sampled BOLD signal, (samples, [trials,] N), instead of the recorded
+# observation vars. So, the neural history is never stored. The recording is then a tuple with the BOLD
+# state, its kernels and its result, and its recorder (onlineBOLD.recordOnline) replaces recordBookkeeping.
+onlineBOLD = None
+def recorder(curr_obsVars, recordObsVars):
+    return onlineBOLD.recorder() if isinstance(curr_obsVars, tuple) else recordObsVars
+
+
 # # @jit(nopython=True)
 def integrate(dt, Tmaxneuronal, simVars, doBookkeeping = True):
     # numSimVars = simVars.shape[0]
-    recompileSignatures()
-    N = simVars.shape[1]  # N = neuronalModel.SC.shape[0]  # size(C,1) #N = CFile["Order"].shape[1]
-    curr_obsVars = initBookkeeping(N, Tmaxneuronal)
-    return integrationLoop(dt, Tmaxneuronal, simVars, doBookkeeping, curr_obsVars)
+    recompileIfNeeded()
+    N = simVars.shape[-1]  # N = neuronalModel.SC.shape[0]  # size(C,1) #N = CFile["Order"].shape[1]
+    if doBookkeeping and onlineBOLD is not None:
+        recording = onlineBOLD.initRecording(simVars.shape[:-2] + (N,), int(Tmaxneuronal/ds) + 1, ds)
+        simVars, recording = integrationLoop(dt, Tmaxneuronal, simVars, doBookkeeping, recording,
+                                             neuronalModel.getRuntimeParms())
+        return simVars, onlineBOLD.result(recording, simVars.shape[:-2] + (N,))
+    # Without bookkeeping, we just need a (dummy) single time element...
+    curr_obsVars = initBookkeeping(N, Tmaxneuronal if doBookkeeping else 0., simVars.shape[:-2])
+    return integrationLoop(dt, Tmaxneuronal, simVars, doBookkeeping, curr_obsVars,
+                           neuronalModel.getRuntimeParms())
+
+
+# Streaming integration: instead of returning the whole recorded history at the end, yields the recorded
+# observables in blocks of (at most) blockSize time samples, (samples, [trials,] obsVars, N), as soon as
+# each one is ready, carrying the state from block to block. So, memory is bounded by the block size, not
+# by Tmaxneuronal. Concatenating all the blocks gives the same samples integrate records. Once the
+# generator is exhausted, the final state is available at streamState.
+streamState = None
+def integrateChunks(dt, Tmaxneuronal, simVars, blockSize):
+    global allStimuli, stimuliDt, numStimuliSteps, streamState
+    recompileIfNeeded()
+    allStimuli = None; stimuliDt = dt
+    numStimuliSteps = len(np.arange(0, Tmaxneuronal, dt))
+    recording = recordingSpec(dt)
+    noise = initNoise(simVars.shape, numStimuliSteps)
+    parms = neuronalModel.getRuntimeParms()
+    stride = recording[0]
+    for firstStep in range(0, numStimuliSteps, blockSize * stride):
+        numSteps = min(blockSize * stride, numStimuliSteps - firstStep)
+        block = np.zeros((-(-numSteps // stride),) + simVars.shape[:-2] + (len(recording[1]), simVars.shape[-1]),
+                         dtype=precision.floatType)
+        simVars, block = integrateSteps(dt, simVars, True, block, generateStimuli(firstStep, numSteps), firstStep, firstStep,
+                                        parms, recording, noise)
+        streamState = simVars
+        yield block
 
 
 # ==========================================================================
 # ==========================================================================
 # ==========================================================================
-def simulate(dt, Tmaxneuronal):
+# Initial values for the simulation. With numTrials, we get an ensemble of numTrials independent
+# trials, stacked along a new leading axis (trials, vars, N), that are integrated all together...
+def initSimVars(numTrials=None):
+    N = neuronalModel.getParm('SC').shape[0]  # size(C,1) #N = CFile["Order"].shape[1]
+    simVars = neuronalModel.initSim(N).astype(precision.floatType)
+    if numTrials is not None:
+        simVars = np.repeat(simVars[np.newaxis], numTrials, axis=0)
+    return simVars
+
+
+def simulate(dt, Tmaxneuronal, numTrials=None):
     if verbose:
         print("Simulating...", flush=True)
-    N = neuronalModel.getParm('SC').shape[0]  # size(C,1) #N = CFile["Order"].shape[1]
-    simVars = neuronalModel.initSim(N)
+    simVars = initSimVars(numTrials)
     initStimuli(dt, Tmaxneuronal)
     simVars, obsVars = integrate(dt, Tmaxneuronal, simVars)
     return obsVars
 
 
-def warmUpAndSimulate(dt, Tmaxneuronal, TWarmUp=10000):
-    N = neuronalModel.getParm('SC').shape[0]  # size(C,1) #N = CFile["Order"].shape[1]
-    simVars = neuronalModel.initSim(N)
+# The warm-up starts from initialSimVars, if given (e.g., a previously warmed-up state, see
+# WholeBrain.Utils.warmStateCache), or from initSimVars otherwise. The state reached at the end of
+# the warm-up is kept in warmState.
+warmState = None
+def warmUpAndSimulate(dt, Tmaxneuronal, TWarmUp=10000, numTrials=None, initialSimVars=None):
+    global warmState
+    simVars = initSimVars(numTrials) if initialSimVars is None else initialSimVars
     if verbose:
         print("Warming Up...", end=" ", flush=True)
     initStimuli(dt, TWarmUp)
     simVars, obsVars = integrate(dt, TWarmUp, simVars, doBookkeeping=False)
+    warmState = simVars
     if verbose:
         print("and simulating!!!", flush=True)
     initStimuli(dt, Tmaxneuronal)
@@ -189,7 +470,7 @@ if __name__ == '__main__':
         # This is written as
         #     y" = v' -> y' = v
         #                v' = -y
-        def dfun(self, simVars, p):
+        def dfun(self, simVars, p, parms):
             y = simVars[0]
             v = simVars[1]
             dy = v
@@ -197,10 +478,13 @@ if __name__ == '__main__':
             return np.stack((dy,dv)), np.stack((y, v))
         def recompileSignatures(self):
             pass
+        def getRuntimeParms(self):
+            return ()
         def numObsVars(self):
             return 2
 
     neuronalModel = dummyNeuronalModel()
+    nopythonLoop = False  # the dummy model is not compiled...
 
     # The analytic solution is y = sin(t) because we initialize at 0.0.
     def asol(t):
@@ -12,8 +12,10 @@
 #
 # ==========================================================================
 import numpy as np
-from numba import jit
+from numba import jit, prange
 from scipy.integrate import odeint
+from WholeBrain.Utils.numTricks import toRuntimeParm, parmAt
+from WholeBrain.Utils.sparseCoupling import toRuntimeSC, couple, coupleInto, coupleIntoParallel
 
 print("Going to use model Chen and Campbell...")
 
@@ -21,6 +23,9 @@ def recompileSignatures():
     # Recompile all existing signatures. Since compiling isn’t cheap, handle with care...
     # However, this is "infinitely" cheaper than all the other computations we make around here ;-)
     dfun.recompile()
+    dfunInPlace.recompile()
+    dfunInPlaceParallel.recompile()
+    nodeDerivatives.recompile()
 
 # ==========================================================================
 # ==========================================================================
@@ -88,6 +93,8 @@ def numObsVars():  # Returns the number of observation vars used
 
 # --------------------------------------------------------------------------
 # Set the parameters for this model
+# G and J can also be given as per-row columns (rows, 1) to simulate a batch of parameter values at once
+# (one row per batch element of a (rows, 8, N) state), see ParmSweep.distanceForAll_Parms_Batched
 def setParms(modelParms):
     global G, J, SC, N
     if 'we' in modelParms or 'G' in modelParms:
@@ -110,13 +117,24 @@ def getParm(parmList):
         return N
     return None
 
+
+# The parameters that can be changed with setParms are passed to the compiled dfun at run time,
+# packed in a tuple. Thus, dfun is compiled only once and changing a parameter costs nothing.
+def getRuntimeParms():
+    return (toRuntimeParm(G), toRuntimeParm(J), toRuntimeSC(SC))
+
 # ----------------- Whole-Brain version of Chen and Campbell's model ----------------------
+# simVars can be (8, N) for a single simulation, or (trials, 8, N) for an ensemble of trials
+# integrated together: the variables are always taken along the second to last axis.
 @jit(nopython=True)
-def dfun(simVars, I):
+def dfun(simVars, I, parms):
+    G = parms[0]; J = parms[1]; SC = parms[2]  # see getRuntimeParms()
 
-    [r_exc, v_exc, w_exc, s_exc, r_inh, v_inh, w_inh, s_inh] = simVars
+    r_exc = simVars[..., 0, :]; v_exc = simVars[..., 1, :]; w_exc = simVars[..., 2, :]; s_exc = simVars[..., 3, :]
+    r_inh = simVars[..., 4, :]; v_inh = simVars[..., 5, :]; w_inh = simVars[..., 6, :]; s_inh = simVars[..., 7, :]
 
-    I_exc = (k * gsyn * s_exc - J*(1-k) * gsyn * s_inh + gsyn * G * (SC @ s_exc)) * (er - v_exc)
+    coupling = couple(SC, s_exc)  # = SC @ s_exc, for each trial (a single GEMM for ensembles, or a sparse product)
+    I_exc = (k * gsyn * s_exc - J*(1-k) * gsyn * s_inh + gsyn * G * coupling) * (er - v_exc)
     I_inh = (k * gsyn * s_exc - (1-k) * gsyn * s_inh) * (er - v_inh)
 
     rm_exc = hw / np.pi + 2 * r_exc * v_exc - r_exc * (gsyn * s_exc + alpha)
@@ -129,7 +147,62 @@ def dfun(simVars, I):
     wm_inh = a_inh * (b * v_inh - w_inh) + wjump_inh * r_inh
     sm_inh = -s_inh / tsyn + sjump * r_inh
 
-    return np.stack((rm_exc, vm_exc, wm_exc, sm_exc, rm_inh, vm_inh, wm_inh, sm_inh)), np.stack((r_exc, v_exc, w_exc, r_inh, v_inh, w_inh))
+    return np.stack((rm_exc, vm_exc, wm_exc, sm_exc, rm_inh, vm_inh, wm_inh, sm_inh), axis=-2), \
+           np.stack((r_exc, v_exc, w_exc, r_inh, v_inh, w_inh), axis=-2)
+
+
+# In-place version of dfun: the same equations, fused into a single pass per node, writing the
+# derivatives into dvars (with the shape of simVars) and, only if computeObs, the observation vars into
+# obsVars. coupling is a (trials, N) work buffer (a single row for a (8, N) state). Nothing is allocated,
+# so the integrators use it (see HeunStochastic) to get allocation-free integration steps.
+@jit(nopython=True)
+def dfunInPlace(simVars, I, parms, dvars, obsVars, computeObs, coupling):
+    G = parms[0]; J = parms[1]; SC = parms[2]  # see getRuntimeParms()
+    N = simVars.shape[-1]
+    state = simVars.reshape((-1, 8, N)); derivs = dvars.reshape((-1, 8, N)); obs = obsVars.reshape((-1, 6, N))
+
+    for bb in range(state.shape[0]):
+        coupleInto(SC, state[bb, 3], coupling[bb])  # = SC @ s_exc
+        for i in range(N):
+            nodeDerivatives(state, derivs, obs, bb, i, G, J, coupling, computeObs)
+
+
+# Parallel version of dfunInPlace, for large networks (see WholeBrain.Utils.parallelKernels): the rows
+# of the coupling product and the node updates are spread across threads.
+@jit(nopython=True, parallel=True)
+def dfunInPlaceParallel(simVars, I, parms, dvars, obsVars, computeObs, coupling):
+    G = parms[0]; J = parms[1]; SC = parms[2]  # see getRuntimeParms()
+    N = simVars.shape[-1]
+    state = simVars.reshape((-1, 8, N)); derivs = dvars.reshape((-1, 8, N)); obs = obsVars.reshape((-1, 6, N))
+
+    for bb in range(state.shape[0]):
+        coupleIntoParallel(SC, state[bb, 3], coupling[bb])  # = SC @ s_exc
+        for i in prange(N):
+            nodeDerivatives(state, derivs, obs, bb, i, G, J, coupling, computeObs)
+
+
+# The derivatives (and, if computeObs, the observation vars) of the node i of the batch element bb
+@jit(nopython=True)
+def nodeDerivatives(state, derivs, obs, bb, i, G, J, coupling, computeObs):
+    r_exc = state[bb, 0, i]; v_exc = state[bb, 1, i]; w_exc = state[bb, 2, i]; s_exc = state[bb, 3, i]
+    r_inh = state[bb, 4, i]; v_inh = state[bb, 5, i]; w_inh = state[bb, 6, i]; s_inh = state[bb, 7, i]
+
+    I_exc = (k * gsyn * s_exc - parmAt(J, bb, i)*(1-k) * gsyn * s_inh + gsyn * parmAt(G, bb, i) * coupling[bb, i]) * (er - v_exc)
+    I_inh = (k * gsyn * s_exc - (1-k) * gsyn * s_inh) * (er - v_inh)
+
+    derivs[bb, 0, i] = hw / np.pi + 2 * r_exc * v_exc - r_exc * (gsyn * s_exc + alpha)
+    derivs[bb, 1, i] = v_exc ** 2 - alpha * v_exc + gsyn * s_exc * (er - v_exc) - np.pi ** 2 * r_exc ** 2 - w_exc + mu + I_exc
+    derivs[bb, 2, i] = a_exc * (b * v_exc - w_exc) + wjump_exc * r_exc
+    derivs[bb, 3, i] = -s_exc / tsyn + sjump * r_exc
+
+    derivs[bb, 4, i] = hw / np.pi + 2 * r_inh * v_inh - r_inh * (gsyn * s_inh + alpha)
+    derivs[bb, 5, i] = v_inh ** 2 - alpha * v_inh + gsyn * s_inh * (er - v_inh) - np.pi ** 2 * r_inh ** 2 - w_inh + mu + I_inh
+    derivs[bb, 6, i] = a_inh * (b * v_inh - w_inh) + wjump_inh * r_inh
+    derivs[bb, 7, i] = -s_inh / tsyn + sjump * r_inh
+
+    if computeObs:
+        obs[bb, 0, i] = r_exc; obs[bb, 1, i] = v_exc; obs[bb, 2, i] = w_exc
+        obs[bb, 3, i] = r_inh; obs[bb, 4, i] = v_inh; obs[bb, 5, i] = w_inh
 
 # ==========================================================================
 # ==========================================================================
@@ -9,6 +9,9 @@
 # ==========================================================================
 import numpy as np
 from numba import jit
+from WholeBrain.Utils.numTricks import toRuntimeParm
+from WholeBrain.Utils.sparseCoupling import toRuntimeSC, couple
+import WholeBrain.Utils.transferFunctions as transferFunctions
 
 print("Going to use the Dynamic Mean Field (DMF) neuronal model...")
 
@@ -19,6 +22,9 @@ def recompileSignatures():
     phie.recompile()
     phii.recompile()
     dfun.recompile()
+    phieGain.recompile()
+    phiiGain.recompile()
+    dfunGain.recompile()
 
 # ==========================================================================
 # ==========================================================================
@@ -39,6 +45,8 @@ SC = None       # Structural connectivity (should be provided externally)
 
 # transfer WholeBrain:
 # --------------------------------------------------------------------------
+# y/(1-exp(-d*y)) is evaluated by transferFunctions.rate, which handles y=0 (where it is 1/d), at the
+# same speed as the plain expression (see WholeBrain.Utils.transferFunctions)
 # transfer function: excitatory
 ae = 310.  # [nC^{-1}], g_E in the paper
 be = 125.  # = g_E * I^{(E)_{thr}} in the paper = 310 * .403 [nA] = 124.93
@@ -48,10 +56,7 @@ def phie(x):
     # in the paper this was g_E * (I^{(E)_n} - I^{(E)_{thr}})
     # Here, we distribute as g_E * I^{(E)_n} - g_E * I^{(E)_{thr}}, thus...
     y = (ae*x-be)
-    # if (y != 0):
-    return y/(1.-np.exp(-de*y))
-    # else:
-    #     return 0
+    return transferFunctions.rate(y, de)
 
 # transfer function: inhibitory
 ai = 615.  # [nC^{-1}], g_I in the paper
@@ -62,10 +67,7 @@ def phii(x):
     # in the paper this was g_I * (I^{(I)_n} - I^{(I)_{thr}}).
     # Apply same distributing as above...
     y = (ai*x-bi)
-    # if (y != 0):
-    return y/(1.-np.exp(-di*y))
-    # else:
-    #     return 0
+    return transferFunctions.rate(y, di)
 
 # transfer WholeBrain used by the simulation...
 He = phie
@@ -98,6 +100,8 @@ def numObsVars():  # Returns the number of observation vars used, here xn and rn
 
 # --------------------------------------------------------------------------
 # Set the parameters for this model
+# we and J can also be given per row of a batched (rows, 2, N) state, as (rows, 1) columns
+# or, for per-node J values, as (rows, N) matrices. See ParmSweep.distanceForAll_Parms_Batched
 def setParms(modelParms):
     global we, J, SC
     if 'we' in modelParms or 'G' in modelParms:  # I've made this mistake too many times...
@@ -122,18 +126,59 @@ def getParm(parmList):
     return None
 
 
+# The parameters that can be changed with setParms are passed to the compiled dfun at run time,
+# packed in a tuple. Thus, dfun is compiled only once and changing a parameter costs nothing.
+def getRuntimeParms():
+    return (toRuntimeParm(we), toRuntimeParm(J), toRuntimeSC(SC))
+
+
 # ----------------- Dynamic Mean Field (a.k.a., reducedWongWang) ----------------------
+# simVars is (2, N), or (trials, 2, N) to integrate an ensemble of trials at once.
 @jit(nopython=True)
-def dfun(simVars, I_external):
+def dfun(simVars, I_external, parms):
     # global xn, rn
-    sn = simVars[0]; sg = simVars[1]  # should be [sn, sg] = simVars
-    xn = I0 * Jexte + w * J_NMDA * sn + we * J_NMDA * (SC @ sn) - J * sg + I_external  # Eq for I^E (5). I_external = 0 => resting state condition.
+    we = parms[0]; J = parms[1]; SC = parms[2]  # see getRuntimeParms()
+    sn = simVars[..., 0, :]; sg = simVars[..., 1, :]  # should be [sn, sg] = simVars
+    coupling = couple(SC, sn)  # = SC @ sn, for each trial (dense or sparse SC)
+    xn = I0 * Jexte + w * J_NMDA * sn + we * J_NMDA * coupling - J * sg + I_external  # Eq for I^E (5). I_external = 0 => resting state condition.
     xg = I0 * Jexti + J_NMDA * sn - sg  # Eq for I^I (6). \lambda = 0 => no long-range feedforward inhibition (FFI)
     rn = He(xn)  # Calls He(xn). r^E = H^E(I^E) in the paper (7)
     rg = Hi(xg)  # Calls Hi(xg). r^I = H^I(I^I) in the paper (8)
     dsn = -sn / taon + (1. - sn) * gamma_e * rn
     dsg = -sg / taog + rg * gamma_i
-    return np.stack((dsn, dsg)), np.stack((xn, rn))
+    return np.stack((dsn, dsg), axis=-2), np.stack((xn, rn), axis=-2)
+
+
+# ----------------- Gain-modulated Dynamic Mean Field ----------------------
+# The kernel shared by the DMF variants with regional gain maps (serotonin2A, Transcriptional), where the
+# transfer functions become H^E((a_E*I^E - b_E) * gainE) and H^I((a_I*I^I - b_I) * gainI). The gains are
+# passed at run time, appended to the DMF parameters: parms = (we, J, SC, gainE, gainI), each one a scalar,
+# a per-node (N,) vector or, for batched sweeps, a (rows, 1) column or (rows, N) matrix. So, changing a
+# receptor map or a gain does not recompile anything, and He/Hi (i.e., the plain DMF) are left untouched.
+@jit(nopython=True)
+def phieGain(x, gain):
+    y = (ae*x-be)*gain
+    return transferFunctions.rate(y, de)
+
+
+@jit(nopython=True)
+def phiiGain(x, gain):
+    y = (ai*x-bi)*gain
+    return transferFunctions.rate(y, di)
+
+
+@jit(nopython=True)
+def dfunGain(simVars, I_external, parms):
+    we = parms[0]; J = parms[1]; SC = parms[2]; gainE = parms[3]; gainI = parms[4]
+    sn = simVars[..., 0, :]; sg = simVars[..., 1, :]
+    coupling = couple(SC, sn)
+    xn = I0 * Jexte + w * J_NMDA * sn + we * J_NMDA * coupling - J * sg + I_external
+    xg = I0 * Jexti + J_NMDA * sn - sg
+    rn = phieGain(xn, gainE)
+    rg = phiiGain(xg, gainI)
+    dsn = -sn / taon + (1. - sn) * gamma_e * rn
+    dsg = -sg / taog + rg * gamma_i
+    return np.stack((dsn, dsg), axis=-2), np.stack((xn, rn), axis=-2)
 
 
 # ==========================================================================
@@ -40,9 +40,20 @@
 # ==========================================================================
 # ==========================================================================
 import numpy as np
+from numba import jit
+from WholeBrain.Utils.numTricks import toRuntimeParm
+from WholeBrain.Utils.sparseCoupling import toRuntimeSC, couple
 
 print("Going to use the Jansen-Rit + FIC neuronal model...")
 
+
+def recompileSignatures():
+    # Recompile all existing signatures. Since compiling isn’t cheap, handle with care...
+    # However, this is "infinitely" cheaper than all the other computations we make around here ;-)
+    sigm.recompile()
+    dfun.recompile()
+
+
 # ==========================================================================
 # Jansen and Rit Model Constants
 # --------------------------------------------------------------------------
@@ -64,36 +75,77 @@ a_2 = 0.8       # C2 = a_2 * C. Average probability of synaptic contacts in the
 a_3 = 0.25      # C3 = a_3 * C. Average probability of synaptic contacts in the feedback inhibitory loop.
 a_4 = 0.25      # C4 = a_4 * C. Average probability of synaptic contacts in the slow feedback inhibitory loop.
 we = 2.1
-C = np.identity(1)  # Structural connectivity
+SC = None       # Structural connectivity (should be provided externally). It used to be C = np.identity(1),
+                # which shadowed the number of synapses C above
+J = 1.          # Feedback inhibition control: a scalar or a per-node (N,) vector, usually set by a FIC procedure
 
 # --------------------------------------------------------------------------
 # Simulation variables
 def initSim(N):
-    y0 = 0.001 * np.zeros(N)  # Initialize y0
-    y1 = 0.001 * np.zeros(N)  # Initialize y1
-    y2 = 0.001 * np.zeros(N)  # Initialize y2
-    y3 = 0.001 * np.zeros(N)  # Initialize y3
-    y4 = 0.001 * np.zeros(N)  # Initialize y4
-    y5 = 0.001 * np.zeros(N)  # Initialize y5
-    return [y0, y1, y2, y3, y4, y5]
+    y0_5 = 0.001 * np.zeros((6, N))  # Initialize y0..y5
+    return y0_5
 
 
-J = None    # WARNING: In general, J must be initialized outside!
 def initJ(N):  # A bit silly, I know...
     global J
     J = np.ones(N)
 
 
 # Variables of interest, needed for bookkeeping tasks...
-v = None
+def numObsVars():  # v = y1 - y2
+    return 1
+
+
+# --------------------------------------------------------------------------
+# Set the parameters for this model
+def setParms(modelParms):
+    global we, C, SC, J, A, B, a, b
+    if 'we' in modelParms:
+        we = modelParms['we']
+    if 'SC' in modelParms:
+        SC = modelParms['SC']
+    if 'J' in modelParms:
+        J = modelParms['J']
+    if 'C' in modelParms:
+        C = modelParms['C']
+    if 'A' in modelParms:
+        A = modelParms['A']
+    if 'B' in modelParms:
+        B = modelParms['B']
+    if 'a' in modelParms:
+        a = modelParms['a']
+    if 'b' in modelParms:
+        b = modelParms['b']
+
+
+def getParm(parmList):
+    if 'we' in parmList:
+        return we
+    if 'J' in parmList:
+        return J
+    if 'SC' in parmList:
+        return SC
+    return None
+
+
+# The parameters that can be changed with setParms are passed to the compiled dfun at run time,
+# packed in a tuple. Thus, dfun is compiled only once and changing a parameter costs nothing.
+def getRuntimeParms():
+    return (toRuntimeParm(we), toRuntimeSC(SC), toRuntimeParm(J), toRuntimeParm(C),
+            toRuntimeParm(A), toRuntimeParm(B), toRuntimeParm(a), toRuntimeParm(b))
+
 
 # ----------------- Jansen and Rit model ----------------------
+@jit(nopython=True)
 def sigm(y):
     return 2.0 * e_0 / (1.0 + np.exp(r * (v0 - y)))
 
-def dfun(simVars, p):  # p is the stimulus
-    global v
-    [y0, y1, y2, y3, y4, y5] = simVars
+# simVars is (6, N), or (trials, 6, N) to integrate an ensemble of trials at once.
+@jit(nopython=True)
+def dfun(simVars, p, parms):  # p is the stimulus
+    we = parms[0]; SC = parms[1]; J = parms[2]; C = parms[3]; A = parms[4]; B = parms[5]; a = parms[6]; b = parms[7]  # see getRuntimeParms()
+    y0 = simVars[..., 0, :]; y1 = simVars[..., 1, :]; y2 = simVars[..., 2, :]
+    y3 = simVars[..., 3, :]; y4 = simVars[..., 4, :]; y5 = simVars[..., 5, :]
     # V is the variable of interest and it is y1 - y2
     v = y1 - y2
     # excitatory pyramidal cells
@@ -101,48 +153,14 @@ def dfun(simVars, p):  # p is the stimulus
     dy3 = A * a * sigm(y1-y2) - 2.0 * a * y3 - a**2 * y0
     # excitatory stellate cells
     dy1 = y4
-    dy4 = A * a * (p + we * C @ sigm(v) + a_2*C * sigm(a_1*C*y0)) - 2.0 * a * y4 - a**2 * y1
+    coupling = couple(SC, sigm(v))  # = SC @ sigm(v), for each trial
+    dy4 = A * a * (p + we * coupling + a_2*C * sigm(a_1*C*y0)) - 2.0 * a * y4 - a**2 * y1
     # inhibitory cells
     dy2 = y5
     dy5 = B * b * (J*a_4*C * sigm(a_3*C*y0)) - 2.0 * b * y5 - b**2 * y2
-    return [dy0, dy1, dy2, dy3, dy4, dy5]
-
-
-# ==========================================================================
-# ==========================================================================
-# ==========================================================================
-# Bookkeeping variables of interest...
-# --------------------------------------------------------------------------
-curr_v = None
-nn = 0
-
-
-def initBookkeeping(N, tmax):
-    global curr_v, nn
-    curr_v = np.zeros((int(tmax/ds), N))
-    nn = 0
-
-
-def resetBookkeeping():
-    global nn
-    nn = 0
+    return np.stack((dy0, dy1, dy2, dy3, dy4, dy5), axis=-2), np.stack((v,), axis=-2)
 
 
-ds = 1  # downsampling stepsize
-def recordBookkeeping(t):
-    global curr_v, nn
-    t2 = int(t * 100000)
-    ds2 = int(ds * 100000)
-    if np.mod(t2, ds2) == 0:
-        # print(t,ds,nn)
-        curr_v[nn] = v
-        nn = nn + 1
-
-
-def returnBookkeeping():
-    return curr_v
-
-
-# ==========================================================================
 # ==========================================================================
 # ==========================================================================
+# ==========================================================================EOF
@@ -45,6 +45,8 @@
 # ==========================================================================
 import numpy as np
 from numba import jit
+from WholeBrain.Utils.numTricks import toRuntimeParm
+from WholeBrain.Utils.sparseCoupling import toRuntimeSC, couple
 
 print("Going to use the Jansen-Rit neuronal model...")
 
@@ -133,23 +135,34 @@ def getParm(parmList):
     return None
 
 
+# The parameters that can be changed with setParms are passed to the compiled dfun at run time,
+# packed in a tuple. Thus, dfun is compiled only once and changing a parameter costs nothing.
+def getRuntimeParms():
+    return (toRuntimeParm(we), toRuntimeSC(SC), toRuntimeParm(C),
+            toRuntimeParm(A), toRuntimeParm(B), toRuntimeParm(a), toRuntimeParm(b))
+
+
 # ----------------- Jansen and Rit model ----------------------
 @jit(nopython=True)
 def sigm(y):
     return 2.0 * e_0 / (1.0 + np.exp(r * (v0 - y)))
 
+# simVars is (6, N), or (trials, 6, N) to integrate an ensemble of trials at once.
 @jit(nopython=True)
-def dfun(simVars, p):  # p is the stimulus
+def dfun(simVars, p, parms):  # p is the stimulus
     # global v
-    y0 = simVars[0]; y1=simVars[1]; y2=simVars[2]; y3=simVars[3]; y4=simVars[4]; y5=simVars[5]
+    we = parms[0]; SC = parms[1]; C = parms[2]; A = parms[3]; B = parms[4]; a = parms[5]; b = parms[6]  # see getRuntimeParms()
+    y0 = simVars[..., 0, :]; y1 = simVars[..., 1, :]; y2 = simVars[..., 2, :]
+    y3 = simVars[..., 3, :]; y4 = simVars[..., 4, :]; y5 = simVars[..., 5, :]
     v = y1 - y2
     dy0 = y3
     dy3 = A * a * sigm(y1-y2) - 2.0 * a * y3 - a**2 * y0
     dy1 = y4
-    dy4 = A * a * (p + we * SC @ sigm(v) + a_2*C * sigm(a_1*C*y0)) - 2.0 * a * y4 - a**2 * y1
+    coupling = couple(SC, sigm(v))  # = SC @ sigm(v), for each trial
+    dy4 = A * a * (p + we * coupling + a_2*C * sigm(a_1*C*y0)) - 2.0 * a * y4 - a**2 * y1
     dy2 = y5
     dy5 = B * b * (a_4*C * sigm(a_3*C*y0)) - 2.0 * b * y5 - b**2 * y2
-    return np.stack((dy0, dy1, dy2, dy3, dy4, dy5)), np.stack((v,))
+    return np.stack((dy0, dy1, dy2, dy3, dy4, dy5), axis=-2), np.stack((v,), axis=-2)
 
 
 # ==========================================================================
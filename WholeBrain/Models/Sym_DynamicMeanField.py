@@ -58,6 +58,13 @@ Hi = phii
 
 J = None    # WARNING: In general, J must be initialized outside!
 
+# This is a symbolic (sympy) version of the model, to derive expressions (e.g., Jacobians), and cannot be
+# compiled: the integrators work with WholeBrain.Models.DynamicMeanField, whose parameters are passed to
+# the compiled dfun at run time (see its getRuntimeParms). Fail loudly if this one is used instead.
+def getRuntimeParms():
+    raise NotImplementedError("Sym_DynamicMeanField is symbolic and cannot be integrated: use WholeBrain.Models.DynamicMeanField")
+
+
 # ----------------- Dynamic Mean Field (a.k.a., reducedWongWang) ----------------------
 def dfun(simVars, I_external):
     [sn, sg] = simVars
@@ -21,6 +21,7 @@
 import numpy as np
 from numba import jit
 import WholeBrain.Models.DynamicMeanField as DMF
+from WholeBrain.Utils.numTricks import toRuntimeParm
 
 
 print("Going to use the Dynamic Mean Field (DMF) neuronal model...")
@@ -41,27 +42,11 @@ alpha = 0.
 beta = 0.
 ratio = 0.
 
-# transfer function: excitatory
-ae = 310.  # [nC^{-1}], g_E in the paper
-be = 125.  # = g_E * I^{(E)_{thr}} in the paper = 310 * .403 [nA] = 124.93
-de = 0.16
-@jit(nopython=True)
-def phie_gain(x):
-    gain=1+alpha+beta*ratio
-    y = (ae*x-be)*gain
-    return y/(1-np.exp(-de*y))
-
-
-# transfer function: inhibitory
-ai = 615  # [nC^{-1}], g_I in the paper
-bi = 177  # = g_I * I^{(I)_{thr}} in the paper = 615 * .288 [nA] = 177.12
-di = 0.087
-@jit(nopython=True)
-def phii_gain(x):
-    # Apply same distributing as above...
-    gain=1+alpha+beta*ratio
-    y = (ai*x-bi)*gain
-    return y/(1-np.exp(-di*y))
+# The same gain, 1+alpha+beta*ratio, multiplies (a*x-b) in both the excitatory and inhibitory transfer
+# functions. It is passed at run time to the gain-modulated DMF kernel (DMF.dfunGain), so fitting alpha
+# and beta does not need any recompilation.
+def gain():
+    return 1. + np.add(alpha, np.multiply(beta, ratio))
 
 
 # --------------------------------------------------------------------------
@@ -83,30 +68,37 @@ def numObsVars():  # Returns the number of observation vars used, here xn and rn
 # --------------------------------------------------------------------------
 # Set the parameters for this model (and pass the rest to the DMF)
 def setParms(modelParms):
-    global alpha, beta
+    global alpha, beta, ratio
     if 'alpha' in modelParms:
         alpha = modelParms['alpha']
     if 'beta' in modelParms:
         beta = modelParms['beta']
+    if 'ratio' in modelParms:
+        ratio = modelParms['ratio']
     DMF.setParms(modelParms)
 
 
+# Model parameters passed at run time to the compiled gain-modulated DMF dfun: the DMF ones plus the
+# excitatory and inhibitory gains (see DMF.dfunGain)
+def getRuntimeParms():
+    g = toRuntimeParm(gain())
+    return DMF.getRuntimeParms() + (g, g)
+
+
 def getParm(parmList):
     if 'alpha' in parmList:
         return alpha
     if 'beta' in parmList:
         return beta
+    if 'ratio' in parmList:
+        return ratio
     return DMF.getParm(parmList)
 
 
-# ----------------- Call the Dynamic Mean Field (a.k.a., reducedWongWang) ----------------------
+# ----------------- Call the gain-modulated Dynamic Mean Field (a.k.a., reducedWongWang) ----------------------
 @jit(nopython=True)
-def dfun(simVars, I_external):
-    return DMF.dfun(simVars, I_external)
-
-
-DMF.He = phie_gain
-DMF.Hi = phii_gain
+def dfun(simVars, I_external, parms):
+    return DMF.dfunGain(simVars, I_external, parms)
 # ==========================================================================
 # ==========================================================================
 # ==========================================================================EOF
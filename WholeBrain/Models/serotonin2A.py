@@ -27,6 +27,7 @@
 import numpy as np
 from numba import jit
 import WholeBrain.Models.DynamicMeanField as DMF
+from WholeBrain.Utils.numTricks import toRuntimeParm
 
 print("Going to use the serotonin 2A receptor (5-HT_{2A}R) transfer WholeBrain!")
 
@@ -34,7 +35,8 @@ print("Going to use the serotonin 2A receptor (5-HT_{2A}R) transfer WholeBrain!"
 def recompileSignatures():
     # Recompile all existing signatures. Since compiling isn’t cheap, handle with care...
     # However, this is "infinitely" cheaper than all the other computations we make around here ;-)
-    phie.recompile(); phii.recompile()
+    DMF.recompileSignatures()
+    dfun.recompile()
 
 
 # Regional Drug Receptor Modulation (RDRM) constants for their transfer WholeBrain:
@@ -48,37 +50,13 @@ wgaine = 0.
 
 # transfer WholeBrain:
 # --------------------------------------------------------------------------
-# transfer function: excitatory
-# in the paper, the wgaini is always set to 0, so in practice only wgaine is used... (0=Placebo, 0.2=LSD)
-ae = 310.  # [nC^{-1}], g_E in the paper
-be = 125.  # = g_E * I^{(E)_{thr}} in the paper = 310 * .403 [nA] = 124.93
-de = 0.16
-@jit(nopython=True)
-def phie(x):
-    # in the paper this was g_E * (I^{(E)_n} - I^{(E)_{thr}}) * (1 - receptor * gain_E)
-    # Here, we distribute the first part as g_E * I^{(E)_n} - g_E * I^{(E)_{thr}}, thus...
-    y = (ae*x-be)*(1+Receptor*wgaine)  # for LSD
-    # if (y != 0):
-    return y/(1-np.exp(-de*y))
-    # else:
-    #     return 0
-
-
-# transfer function: inhibitory
-# in the paper, the wgaini is always set to 0, so in practice only wgaine is used... (wgaini=0)
-ai = 615  # [nC^{-1}], g_I in the paper
-bi = 177  # = g_I * I^{(I)_{thr}} in the paper = 615 * .288 [nA] = 177.12
-di = 0.087
-@jit(nopython=True)
-def phii(x):
-    # in the paper this was g_I * (I^{(I)_n} - I^{(I)_{thr}}), without a
-    # receptor part because inhibitory connections are not changed.
-    # Apply same distributing as above...
-    y = (ai*x-bi)*(1+Receptor*wgaini)  # for LSD
-    # if (y != 0):
-    return y/(1-np.exp(-di*y))
-    # else:
-    #     return 0
+# in the paper this was g_E * (I^{(E)_n} - I^{(E)_{thr}}) * (1 + receptor * gain_E) for the excitatory
+# transfer function, and the same for the inhibitory one with gain_I (always 0 in the paper, so in
+# practice only wgaine is used... 0=Placebo, 0.2=LSD). These per-node gains are passed at run time to
+# the gain-modulated DMF kernel (DMF.dfunGain), so changing the receptor map or the gains does not need
+# any recompilation. With a (rows, 1) column of S_E (or S_I) values, they broadcast to (rows, N).
+def gains():
+    return 1. + np.multiply(Receptor, wgaine), 1. + np.multiply(Receptor, wgaini)
 
 
 # --------------------------------------------------------------------------
@@ -100,29 +78,37 @@ def numObsVars():  # Returns the number of observation vars used, here xn and rn
 # --------------------------------------------------------------------------
 # Set the parameters for this model
 def setParms(modelParms):
-    global wgaine, wgaini
+    global wgaine, wgaini, Receptor
     if 'S_E' in modelParms:
         wgaine = modelParms['S_E']
     if 'S_I' in modelParms:
         wgaini = modelParms['S_I']
+    if 'Receptor' in modelParms:
+        Receptor = modelParms['Receptor']
     DMF.setParms(modelParms)
 
 
+# Model parameters passed at run time to the compiled gain-modulated DMF dfun: the DMF ones plus the
+# excitatory and inhibitory gains (see DMF.dfunGain)
+def getRuntimeParms():
+    gainE, gainI = gains()
+    return DMF.getRuntimeParms() + (toRuntimeParm(gainE), toRuntimeParm(gainI))
+
+
 def getParm(parmList):
     if 'S_E' in parmList:
         return wgaine
     if 'S_I' in parmList:
         return wgaini
+    if 'Receptor' in parmList:
+        return Receptor
     return DMF.getParm(parmList)
 
 
-# ----------------- Call the Dynamic Mean Field (a.k.a., reducedWongWang) ----------------------
+# ----------------- Call the gain-modulated Dynamic Mean Field (a.k.a., reducedWongWang) ----------------------
 @jit(nopython=True)
-def dfun(simVars, I_external):
-    return DMF.dfun(simVars, I_external)
-
-DMF.He = phie
-DMF.Hi = phii
+def dfun(simVars, I_external, parms):
+    return DMF.dfunGain(simVars, I_external, parms)
 
 
 # ==========================================================================
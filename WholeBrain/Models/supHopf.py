@@ -32,6 +32,8 @@
 # ==========================================================================
 import numpy as np
 from numba import jit
+from WholeBrain.Utils.numTricks import toRuntimeParm
+from WholeBrain.Utils.sparseCoupling import toRuntimeSC, couple
 
 print("Going to use the supercritical Hopf bifurcation neuronal model...")
 
@@ -61,7 +63,7 @@ def initSim(N):
     global SCT, ink
     SCT = SC.T
     if conservative:
-        ink = SCT.sum(axis=1)   # Careful: component 2 in Matlab is component 1 in Python
+        ink = np.asarray(SCT.sum(axis=1)).ravel()   # Careful: component 2 in Matlab is component 1 in Python (ravel, for sparse SCs)
     else:
         ink = 0
     x = initialValueX * np.ones(N)  # Initialize x
@@ -77,6 +79,8 @@ def numObsVars():  # Returns the number of observation vars used, here xn and rn
 
 # --------------------------------------------------------------------------
 # Set the parameters for this model
+# G (we) can also be given as a per-row column (rows, 1), to simulate a batch of values at once with a
+# (rows, 2, N) state. See ParmSweep.distanceForAll_Parms_Batched
 def setParms(modelParms):
     global G, SC, a, omega
     if 'we' in modelParms:
@@ -95,13 +99,29 @@ def getParm(parmList):
         return G
     if 'SC' in parmList:
         return SC
+    if 'omega' in parmList:  # before 'a', which is in 'omega'...
+        return omega
+    if 'a' in parmList:
+        return a
     return None
 
 
+# The parameters that can be changed with setParms are passed to the compiled dfun at run time,
+# packed in a tuple. Thus, dfun is compiled only once and changing a parameter costs nothing.
+# ink is computed here from the current SC, which may have been assigned directly (without initSim)
+def getRuntimeParms():
+    if SC is None:
+        raise ValueError("supHopf.SC is not set: provide it with setParms({'SC': SC})")
+    runtimeInk = np.asarray(SC.sum(axis=0)).ravel() if conservative else 0.  # = SCT.sum(axis=1), as in initSim
+    return (toRuntimeParm(a), toRuntimeParm(omega), toRuntimeParm(G), toRuntimeSC(SC.T), toRuntimeParm(runtimeInk))
+
+
 # ----------------- supercritical Hopf bifurcation model ----------------------
+# simVars is (2, N), or (trials, 2, N) to integrate an ensemble of trials at once.
 @jit(nopython=True)
-def dfun(simVars, p):  # p is the stimulus...?
-    x = simVars[0]; y = simVars[1]
+def dfun(simVars, p, parms):  # p is the stimulus...?
+    a = parms[0]; omega = parms[1]; G = parms[2]; SCT = parms[3]; ink = parms[4]  # see getRuntimeParms()
+    x = simVars[..., 0, :]; y = simVars[..., 1, :]
     pC = p + 0j
     # --------------------- From Gus' original code:
     # First, we need to compute the term (in pseudo-LaTeX notation):
@@ -122,12 +142,12 @@ def dfun(simVars, p):  # p is the stimulus...?
     #    =  x *(+omega)    y          y * y     x * x               #        y   y                     (y)
     # ---------------------
     # Calculate the input to nodes due to couplings
-    xcoup = np.dot(SCT,x) - ink * x  # sum(Cij*xi) - sum(Cij)*xj
-    ycoup = np.dot(SCT,y) - ink * y  #
+    xcoup = couple(SCT, x) - ink * x  # sum(Cij*xi) - sum(Cij)*xj, i.e., np.dot(SCT,x) for each trial
+    ycoup = couple(SCT, y) - ink * y  #
     # Integration step
     dx = (a - x**2 - y**2) * x - omega * y + G * xcoup + pC.real
     dy = (a - x**2 - y**2) * y + omega * x + G * ycoup + pC.imag
-    return np.stack((dx, dy)), np.stack((x, y))
+    return np.stack((dx, dy), axis=-2), np.stack((x, y), axis=-2)
 
 
 # ==========================================================================
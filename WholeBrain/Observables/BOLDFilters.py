@@ -31,7 +31,7 @@ def BandPassFilter(boldSignal, removeStrongArtefacts=True):
     Wn = [flp/fnq, fhi/fnq]                                   # butterworth bandpass non-dimensional frequency
     bfilt, afilt = butter(k,Wn, btype='band', analog=False)   # construct the filter
     # bfilt = bfilt_afilt[0]; afilt = bfilt_afilt[1]  # numba doesn't like unpacking...
-    signal_filt = np.zeros(boldSignal.shape)
+    signal_filt = np.zeros(boldSignal.shape, dtype=boldSignal.dtype)
     for seed in range(N):
         if not np.isnan(boldSignal[seed, :]).any():  # No problems, go ahead!!!
             ts = demean.demean(detrend(boldSignal[seed, :]))  # Probably, we do not need to demean here, detrend already does the job...
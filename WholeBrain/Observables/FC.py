@@ -9,6 +9,7 @@ import warnings
 import numpy as np
 # from numba import jit
 from WholeBrain.Observables import BOLDFilters
+from WholeBrain.Utils import precision
 
 print("Going to use Functional Connectivity (FC)...")
 
@@ -23,7 +24,7 @@ def from_fMRI(signal, applyFilters=True, removeStrongArtefacts=True):
             sfiltT = signal_filt.T
         else:
             sfiltT = signal.T
-        cc = np.corrcoef(sfiltT, rowvar=False)  # Pearson correlation coefficients
+        cc = np.corrcoef(sfiltT, rowvar=False, dtype=signal.dtype)  # Pearson correlation coefficients, in the precision of the signal
         return cc
     else:
         warnings.warn('############ Warning!!! FC.from_fMRI: NAN found ############')
@@ -63,7 +64,7 @@ def distance(FC1, FC2):  # FC similarity, convenience function
 
 
 def init(S, N):
-    return np.zeros((S, N, N))
+    return np.zeros((S, N, N), dtype=precision.floatType)
 
 
 def accumulate(FCs, nsub, signal):
@@ -75,8 +76,8 @@ def postprocess(FCs):
     return np.squeeze(np.mean(FCs, axis=0))
 
 
-def findMinMax(arrayValues):
-    return np.max(arrayValues), np.argmax(arrayValues)
+def findMinMax(arrayValues):  # NaN entries (e.g., points not simulated) are ignored
+    return np.nanmax(arrayValues), np.nanargmax(arrayValues)
 
 # ================================================================================================================
 # ================================================================================================================
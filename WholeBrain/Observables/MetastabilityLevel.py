@@ -124,8 +124,8 @@ def postprocess(Mets):
     return Mets  # nothing to do here
 
 
-def findMinMax(arrayValues):
-    return np.min(arrayValues), np.argmin(arrayValues)
+def findMinMax(arrayValues):  # NaN entries (e.g., points not simulated) are ignored
+    return np.nanmin(arrayValues), np.nanargmin(arrayValues)
 
 # ================================================================================================================
 # ================================================================================================================
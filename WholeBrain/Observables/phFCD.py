@@ -185,8 +185,8 @@ def postprocess(FCDs):
     return FCDs  # nothing to do here
 
 
-def findMinMax(arrayValues):
-    return np.min(arrayValues), np.argmin(arrayValues)
+def findMinMax(arrayValues):  # NaN entries (e.g., points not simulated) are ignored
+    return np.nanmin(arrayValues), np.nanargmin(arrayValues)
 
 
 # --------------------------------------------------------------------------------------
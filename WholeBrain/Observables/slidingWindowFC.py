@@ -0,0 +1,170 @@
+# --------------------------------------------------------------------------
+# --------------------------------------------------------------------------
+#  Sliding-window FC engine: the FCs (or covariances) of all the windows of a signal, from running sums
+#
+#  Consecutive windows share most of their samples (90% with swFCD's windowSize=30 and windowStep=3), so
+#  instead of building each window FC from scratch, O(windowLength*N^2) per window, we keep the sums of the
+#  samples and of their cross products over the current window and, to move to the next one, add the
+#  windowStep samples that enter it and remove the windowStep samples that leave it. So, all the windows
+#  cost O(T*N^2), plus writing the results. When windowStep >= windowLength there is nothing to reuse, and
+#  each window is summed from scratch.
+#
+#  To keep the running sums accurate in long sessions (e.g., 1200+ TR HCP ones), they are recomputed from
+#  scratch every resyncEvery windows, so the rounding errors of the additions and removals cannot
+#  accumulate, and they are sums of the samples minus the mean of the window where they were last
+#  recomputed, so slow drifts of the signal do not cause cancellations when we subtract the products of
+#  the means.
+#
+#  The windows are all the full windows of windowLength samples, starting at 0, windowStep, ..., i.e.,
+#  windowStarts(Tmax, windowLength, windowStep). For swFCD, windowLength = windowSize+1.
+#
+#  Use it with
+#     covariances(signal, windowLength, windowStep)     -> (..., N_windows, N, N)
+#     correlations(signal, windowLength, windowStep)    -> (..., N_windows, N, N), the window FCs
+#     lowerTriangles(signal, windowLength, windowStep)  -> (..., N_windows, N*(N-1)/2), the entries of the
+#                                                          window FCs below the diagonal, in the order of
+#                                                          np.tril_indices(N, k=-1)
+#  for a (..., N, Tmax) signal (e.g., a batch of subjects). As the other observables, the results keep the
+#  precision of the signal (e.g., float32, see WholeBrain.Utils.precision), while the running sums are always
+#  accumulated in float64.
+# --------------------------------------------------------------------------
+# --------------------------------------------------------------------------
+import numpy as np
+from numba import jit
+
+resyncEvery = 16  # windows between recomputations of the running sums from scratch
+
+
+def windowStarts(Tmax, windowLength, windowStep):
+    return np.arange(0, Tmax - windowLength + 1, windowStep)
+
+
+# ==================================================================
+# Running sums
+# ==================================================================
+# Adds (sign=1) or removes (sign=-1) the samples first..last-1 of x, (T, N), minus shift, to the sums of
+# the samples and to the lower triangle (diagonal included) of the sums of their cross products
+@jit(nopython=True)
+def addSamples(x, first, last, sign, shift, sums, cross):
+    N = x.shape[1]
+    centered = np.empty(N)
+    for t in range(first, last):
+        for i in range(N):
+            centered[i] = x[t, i] - shift[i]
+        for i in range(N):
+            xi = sign * centered[i]
+            sums[i] += xi
+            for j in range(i + 1):
+                cross[i, j] += xi * centered[j]
+
+
+# Moves the running sums from window w-1 to window w (or computes them, for the first one and every
+# resync windows)
+@jit(nopython=True)
+def advanceWindow(x, w, windowLength, windowStep, resync, shift, sums, cross):
+    start = w * windowStep
+    if w % resync == 0 or windowStep >= windowLength:
+        for i in range(x.shape[1]):
+            shift[i] = np.mean(x[start:start + windowLength, i])
+        sums[:] = 0.
+        cross[:, :] = 0.
+        addSamples(x, start, start + windowLength, 1., shift, sums, cross)
+    else:
+        previous = start - windowStep
+        addSamples(x, previous + windowLength, start + windowLength, 1., shift, sums, cross)  # entering samples
+        addSamples(x, previous, start, -1., shift, sums, cross)  # leaving samples
+
+
+@jit(nopython=True)
+def covarianceKernel(x, windowLength, windowStep, resync, out):  # out: (N_windows, N, N)
+    N = x.shape[1]
+    shift = np.zeros(N); sums = np.zeros(N); cross = np.zeros((N, N))
+    for w in range(out.shape[0]):
+        advanceWindow(x, w, windowLength, windowStep, resync, shift, sums, cross)
+        for i in range(N):
+            for j in range(i + 1):
+                out[w, i, j] = (cross[i, j] - sums[i] * sums[j] / windowLength) / (windowLength - 1)
+                out[w, j, i] = out[w, i, j]
+
+
+@jit(nopython=True)
+def lowerCorrelationKernel(x, windowLength, windowStep, resync, out):  # out: (N_windows, N*(N-1)/2)
+    N = x.shape[1]
+    shift = np.zeros(N); sums = np.zeros(N); cross = np.zeros((N, N)); std = np.zeros(N)
+    for w in range(out.shape[0]):
+        advanceWindow(x, w, windowLength, windowStep, resync, shift, sums, cross)
+        for i in range(N):
+            std[i] = np.sqrt(cross[i, i] - sums[i] * sums[i] / windowLength)
+        p = 0
+        for i in range(1, N):
+            for j in range(i):
+                out[w, p] = (cross[i, j] - sums[i] * sums[j] / windowLength) / (std[i] * std[j])
+                p += 1
+
+
+# ==================================================================
+# Main entry points
+# ==================================================================
+# Runs kernel for each (N, Tmax) signal of the batch, into an (..., N_windows) + outShape result
+def slide(kernel, signal, windowLength, windowStep, outShape):
+    (N, Tmax) = signal.shape[-2:]
+    dtype = signal.dtype if np.issubdtype(signal.dtype, np.floating) else np.float64
+    numWindows = len(windowStarts(Tmax, windowLength, windowStep))
+    batch = signal.reshape((-1, N, Tmax))
+    result = np.empty((batch.shape[0], numWindows) + outShape, dtype=dtype)
+    for b in range(batch.shape[0]):
+        x = np.ascontiguousarray(batch[b].T, dtype=dtype)
+        kernel(x, windowLength, windowStep, resyncEvery, result[b])
+    return result.reshape(signal.shape[:-2] + (numWindows,) + outShape)
+
+
+def covariances(signal, windowLength, windowStep):
+    N = signal.shape[-2]
+    return slide(covarianceKernel, signal, windowLength, windowStep, (N, N))
+
+
+def correlations(signal, windowLength, windowStep):
+    cov = covariances(signal, windowLength, windowStep)
+    std = np.sqrt(np.diagonal(cov, axis1=-2, axis2=-1))
+    return cov / (std[..., :, np.newaxis] * std[..., np.newaxis, :])
+
+
+def lowerTriangles(signal, windowLength, windowStep):
+    N = signal.shape[-2]
+    return slide(lowerCorrelationKernel, signal, windowLength, windowStep, (N * (N - 1) // 2,))
+
+
+# ======================================================================
+# Test code: the running sums against the FC of each window computed from scratch, for a short session with
+# the swFCD windows, a long (HCP-like) one, and windows that do not overlap, plus the timing for the long one
+# ======================================================================
+if __name__ == '__main__':
+    import time
+
+    def direct(signal, windowLength, windowStep):
+        Isubdiag = np.tril_indices(signal.shape[0], k=-1)
+        return np.array([np.corrcoef(signal[:, t:t + windowLength])[Isubdiag]
+                         for t in windowStarts(signal.shape[1], windowLength, windowStep)])
+
+    rng = np.random.default_rng(42)
+    for (N, Tmax, windowLength, windowStep) in [(90, 220, 31, 3), (90, 1200, 31, 3), (20, 300, 10, 15), (20, 300, 60, 1)]:
+        signal = 100. + np.cumsum(rng.standard_normal((N, Tmax)), axis=1)  # drifting, with a large offset
+        lowerTriangles(signal[:, :windowLength + windowStep], windowLength, windowStep)  # compile...
+        t0 = time.perf_counter()
+        fcs = lowerTriangles(signal, windowLength, windowStep)
+        tRunning = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        reference = direct(signal, windowLength, windowStep)
+        tDirect = time.perf_counter() - t0
+        Isubdiag = np.tril_indices(N, k=-1)
+        fullDiff = np.max(np.abs(correlations(signal, windowLength, windowStep)[:, Isubdiag[0], Isubdiag[1]] - reference))
+        print(f"N={N}, Tmax={Tmax}, window={windowLength}, step={windowStep}: {fcs.shape[0]} windows, running sums {tRunning*1e3:.1f}ms,"
+              f" from scratch {tDirect*1e3:.1f}ms, max diff={np.max(np.abs(fcs - reference)):.2e} (full matrices {fullDiff:.2e})")
+    batch = rng.standard_normal((3, 2, 20, 100))
+    print(f"batch {batch.shape} -> {lowerTriangles(batch, 31, 3).shape}, max diff="
+          f"{max(np.max(np.abs(lowerTriangles(batch, 31, 3)[a, b] - direct(batch[a, b], 31, 3))) for a in range(3) for b in range(2)):.2e}")
+    single = lowerTriangles(batch[0, 0].astype(np.float32), 31, 3)
+    print(f"float32 signal -> {single.dtype}, max diff={np.max(np.abs(single - direct(batch[0, 0], 31, 3))):.2e}")
+# ======================================================================
+# ======================================================================
+# ======================================================================EOF
@@ -10,6 +10,8 @@ import numpy as np
 # from numba import jit
 from scipy import stats
 from WholeBrain.Observables import BOLDFilters
+from WholeBrain.Observables import slidingWindowFC
+from WholeBrain.Utils import precision
 
 print("Going to use Sliding Windows Functional Connectivity Dynamics (swFCD)...")
 
@@ -62,44 +64,60 @@ def pearson_r(x, y):
 
 
 # ==================================================================
+# The FCD entry of two windows is the Pearson correlation of their FCs (upper triangles), so each window FC is
+# computed only once, as a z-normalised vector (zero mean, unit norm), and then the whole FCD is a single
+# matrix product of these vectors, instead of two corrcoef calls (plus a third one in pearson_r) per pair
+# of windows. The window FCs come from the running sums of slidingWindowFC, so they cost O(Tmax*N^2) in total.
 # ==================================================================
 windowSize = 30
 windowStep = 3
-def from_fMRI(signal, applyFilters=True, removeStrongArtefacts=True):  # Compute the FCD of an input BOLD signal
-    (N, Tmax) = signal.shape
-    lastWindow = Tmax - windowSize  # 190 = 220 - 30
-    N_windows = calc_length(0, lastWindow, windowStep)  # N_windows = len(np.arange(0, lastWindow, windowStep))
-
-    if not np.isnan(signal).any():  # No problems, go ahead!!!
+subjectChunk = 8  # subjects processed at once by from_fMRI with a (subjects, N, Tmax) signal, to bound the memory
+
+
+def zNormalize(vectors):  # each row, to zero mean and unit norm
+    centered = vectors - vectors.mean(axis=-1, keepdims=True)
+    return centered / np.linalg.norm(centered, axis=-1, keepdims=True)
+
+
+# FCs of the sliding windows between t and t+windowSize (included), t = 0, windowStep, ..., < Tmax-windowSize,
+# as z-normalised vectors with the entries below their diagonal: (..., N_windows, N*(N-1)/2) for a
+# (..., N, Tmax) signal
+def windowFCs(signal):
+    return zNormalize(slidingWindowFC.lowerTriangles(signal, windowSize + 1, windowStep))
+
+
+# The upper triangular part (in row order) of the FCD of each set of window FCs, (..., N_windows*(N_windows-1)/2)
+def FCDFromWindowFCs(fcs):
+    Iupper = np.triu_indices(fcs.shape[-2], k=1)  # Only keep the upper triangular part
+    fcd = fcs @ np.swapaxes(fcs, -1, -2)  # Correlation between each pair of FCs
+    return fcd[..., Iupper[0], Iupper[1]]
+
+
+# Compute the FCD of an input BOLD signal, (N, Tmax), or of a batch of subjects (with the same Tmax),
+# (subjects, N, Tmax), giving (subjects, N_windows*(N_windows-1)/2). For a batch, the subjects with NaNs
+# get a row of NaNs.
+def from_fMRI(signal, applyFilters=True, removeStrongArtefacts=True):
+    if signal.ndim == 2:
+        if np.isnan(signal).any():
+            warnings.warn('############ Warning!!! swFCD.from_fMRI: NAN found ############')
+            return np.nan
+        return from_fMRI(signal[np.newaxis], applyFilters=applyFilters, removeStrongArtefacts=removeStrongArtefacts)[0]
+
+    (S, N, Tmax) = signal.shape
+    N_windows = calc_length(0, Tmax - windowSize, windowStep) if Tmax > windowSize else 0
+    cotsampling = np.full((S, int(N_windows*(N_windows-1)/2)), np.nan, dtype=signal.dtype)
+    valid = ~np.isnan(signal).any(axis=(1, 2))
+    if not valid.all():
+        warnings.warn(f'############ Warning!!! swFCD.from_fMRI: NAN found at subjects {np.nonzero(~valid)[0]} ############')
+    subjects = np.nonzero(valid)[0]
+    for first in range(0, len(subjects), subjectChunk):
+        chunk = subjects[first:first + subjectChunk]
         if applyFilters:  # Filters seem to be always applied...
-            signal_filt = BOLDFilters.BandPassFilter(signal, removeStrongArtefacts=removeStrongArtefacts)  # zero phase filter the data
+            signal_filt = np.stack([BOLDFilters.BandPassFilter(signal[s], removeStrongArtefacts=removeStrongArtefacts) for s in chunk])  # zero phase filter the data
         else:
-            signal_filt = signal
-        Isubdiag = np.tril_indices(N, k=-1)  # Indices of triangular lower part of matrix
-
-        # For each pair of sliding windows calculate the FC at t and t2 and
-        # compute the correlation between the two.
-        cotsampling = np.zeros((int(N_windows*(N_windows-1)/2)))
-        kk = 0
-        ii2 = 0
-        for t in range(0, lastWindow, windowStep):
-            jj2 = 0
-            sfilt = (signal_filt[:, t:t+windowSize+1]).T  # Extracts a (sliding) window between t and t+windowSize (included)
-            cc = np.corrcoef(sfilt, rowvar=False)  # Pearson correlation coefficients
-            for t2 in range(0, lastWindow, windowStep):
-                sfilt2 = (signal_filt[:, t2:t2+windowSize+1]).T  # Extracts a (sliding) window between t2 and t2+windowSize (included)
-                cc2 = np.corrcoef(sfilt2, rowvar=False)  # Pearson correlation coefficients
-                ca = pearson_r(cc[Isubdiag],cc2[Isubdiag])  # Correlation between both FC
-                if jj2 > ii2:  # Only keep the upper triangular part
-                    cotsampling[kk] = ca
-                    kk = kk+1
-                jj2 = jj2+1
-            ii2 = ii2+1
-
-        return cotsampling
-    else:
-        warnings.warn('############ Warning!!! swFCD.from_fMRI: NAN found ############')
-        return np.nan
+            signal_filt = signal[chunk]
+        cotsampling[chunk] = FCDFromWindowFCs(windowFCs(signal_filt))
+    return cotsampling
 
 
 # ==================================================================
@@ -123,11 +141,11 @@ def distance(FCD1, FCD2):  # FCD similarity, convenience function
 
 
 def init(S, N):
-    return np.array([], dtype=np.float64)
+    return np.array([], dtype=precision.floatType)
 
 
 def accumulate(FCDs, nsub, signal):
-    FCDs = np.concatenate((FCDs, signal))  # Compute the FCD correlations
+    FCDs = np.concatenate((FCDs, np.ravel(signal)))  # Compute the FCD correlations (of one subject or of a batch)
     return FCDs
 
 
@@ -135,17 +153,56 @@ def postprocess(FCDs):
     return FCDs  # nothing to do here
 
 
-def findMinMax(arrayValues):
-    return np.min(arrayValues), np.argmin(arrayValues)
+def findMinMax(arrayValues):  # NaN entries (e.g., points not simulated) are ignored
+    return np.nanmin(arrayValues), np.nanargmin(arrayValues)
 
 
 # --------------------------------------------------------------------------------------
 # Test code
 # --------------------------------------------------------------------------------------
 if __name__ == '__main__':
+    import os
+    import time
     import scipy.io as sio
     import matplotlib.pyplot as plt
 
+    def from_fMRI_loop(signal):  # the original implementation (unfiltered): one corrcoef per window and pair
+        (N, Tmax) = signal.shape
+        lastWindow = Tmax - windowSize
+        Isubdiag = np.tril_indices(N, k=-1)
+        cotsampling = []
+        for ii2, t in enumerate(range(0, lastWindow, windowStep)):
+            cc = np.corrcoef(signal[:, t:t+windowSize+1].T, rowvar=False, dtype=signal.dtype)
+            for jj2, t2 in enumerate(range(0, lastWindow, windowStep)):
+                cc2 = np.corrcoef(signal[:, t2:t2+windowSize+1].T, rowvar=False, dtype=signal.dtype)
+                if jj2 > ii2:
+                    cotsampling.append(pearson_r(cc[Isubdiag], cc2[Isubdiag]))
+        return np.array(cotsampling, dtype=signal.dtype)
+
+    rng = np.random.default_rng(42)
+    S = 10; N = 90; Tmax = 220
+    signals = np.cumsum(rng.standard_normal((S, N, Tmax)), axis=-1)  # some structure in time...
+    from_fMRI(signals[0, :, :windowSize + 2*windowStep], applyFilters=False)  # compile the window FCs...
+    t0 = time.perf_counter()
+    reference = np.stack([from_fMRI_loop(s) for s in signals])
+    tLoop = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    single = np.stack([from_fMRI(s, applyFilters=False) for s in signals])
+    tSingle = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    batch = from_fMRI(signals, applyFilters=False)
+    tBatch = time.perf_counter() - t0
+    print(f"swFCD of {S} subjects ({N}x{Tmax}): original {tLoop:.2f}s, window FCs {tSingle:.3f}s, batched {tBatch:.3f}s; "
+          f"max diff={np.max(np.abs(single - reference)):.2e} (batched {np.max(np.abs(batch - reference)):.2e})")
+    single32 = from_fMRI(signals[0].astype(np.float32), applyFilters=False)
+    print(f"   float32: {single32.dtype}, max diff={np.max(np.abs(single32 - from_fMRI_loop(signals[0].astype(np.float32)))):.2e}")
+    session = np.cumsum(rng.standard_normal((N, 1200)), axis=-1)
+    t0 = time.perf_counter()
+    fcd = from_fMRI(session, applyFilters=False)
+    print(f"   one {N}x1200 session (HCP-like): {time.perf_counter() - t0:.3f}s, {fcd.shape[0]} FCD entries")
+    if not os.path.exists("../../Data_Raw/all_SC_FC_TC_76_90_116.mat"):
+        quit()
+
     from WholeBrain.Observables import BOLDFilters
     BOLDFilters.flp = 0.008
     BOLDFilters.fhi = 0.08
@@ -78,7 +78,6 @@ class WholeBrainOptimizee(Optimizee):
     def simulate_(self):
         print("   Going to eval:", self.x, flush=True)
         self.setupFunc(self.x)  # Use either the defaultSetupFunc or the one provided by the user...
-        integrator.recompileSignatures()
         measureValues = measure.init(trials, N)
         for i in range(trials):
             bds = simulateBOLD.simulateSingleSubject().T
@@ -0,0 +1,152 @@
+# ==========================================================================
+# ==========================================================================
+# Linear-stability pre-screen for parameter sweeps
+#
+# Each point of a sweep (e.g., the we values of Prepro_fgain_CC.py) costs NumSimSubjects full stochastic
+# simulations, but most of the interesting changes in the dynamics happen close to bifurcations of the
+# noise-free network. So, for each candidate set of parameters we compute the fixed point of the model
+# (WholeBrain.Utils.steadyState, following the branch from one point to the next) and the spectrum of its
+# Jacobian there, which takes a fraction of a second per point. Then we flag
+#   * Hopf bifurcations: the leading eigenvalue pair crosses the imaginary axis (Re changes sign, Im != 0),
+#   * folds: a real leading eigenvalue crosses 0,
+#   * branch jumps: the fixed point changes abruptly (the followed branch disappeared),
+#   * points without a fixed point (the solver did not converge),
+# and keep, as worth simulating, the points around them (marginPoints at each side), plus those close to
+# criticality (max Re(eig) > -criticalRate, i.e., with slow dynamics), if criticalRate is given. If nothing
+# is flagged, we keep the points closest to instability.
+#
+# Works with any model with a (trials, vars, N)-capable dfun (Chen_Campbell_Whole_Brain_version,
+# DynamicMeanField, supHopf, ...). Use it with ParmSweep.prescreen = stabilityPrescreen, or directly with
+# prescreen(model, modelParms).
+# ==========================================================================
+# ==========================================================================
+import numpy as np
+import WholeBrain.Utils.steadyState as steadyState
+
+verbose = True
+marginPoints = 1      # points kept at each side of a flagged point
+criticalRate = None   # also keep the points with max Re(eig) > -criticalRate
+imagTol = 1e-8        # leading eigenvalues with |Im| below this are considered real
+jumpTol = 0.1         # relative change of the fixed point between consecutive points considered a jump
+
+
+# Fixed point, eigenvalues of the Jacobian there, and whether the fixed point was found, for the
+# current parameters of the model (starting the search at simVars, if given)
+def linearize(model, simVars=None):
+    fixedPoint = steadyState.solve(model, simVars).astype(np.float64)
+    eigenvalues = np.linalg.eigvals(steadyState.jacobian(model, fixedPoint))
+    return fixedPoint, eigenvalues, steadyState.converged
+
+
+# The values the model has for the parameters in modelParms (the ones not set yet have nothing to restore)
+def currentParms(model, modelParms):
+    saved = {}
+    for key in {key for parms in modelParms for key in parms}:
+        try:
+            value = model.getParm(key)
+        except NameError:  # never set
+            continue
+        if value is not None:
+            saved[key] = value
+    return saved
+
+
+# modelParms is a list of dicts, one for each point of the sweep, as in ParmSweep.distanceForAll_Parms.
+# Returns a dict with, for each point: maxRe (largest real part of the spectrum), leadingImag (|Im| of
+# that eigenvalue), converged, stable; the list of flagged transitions as (pos, kind) pairs, where the
+# transition happens between pos-1 and pos; and the boolean mask worthSimulating. The model keeps its
+# parameters (the ones in modelParms are restored afterwards).
+def prescreen(model, modelParms):
+    numPoints = len(modelParms)
+    maxRe = np.full(numPoints, np.nan); leadingImag = np.full(numPoints, np.nan)
+    converged = np.zeros(numPoints, dtype=bool)
+    fixedPoints = []
+    simVars = None
+    savedParms = currentParms(model, modelParms)
+    try:
+        for pos, parms in enumerate(modelParms):
+            model.setParms(parms)
+            fixedPoint, eigenvalues, converged[pos] = linearize(model, simVars)
+            if converged[pos]:
+                simVars = fixedPoint  # follow the branch...
+            leading = np.argmax(eigenvalues.real)
+            maxRe[pos] = eigenvalues[leading].real
+            leadingImag[pos] = np.abs(eigenvalues[leading].imag)
+            fixedPoints.append(fixedPoint)
+            if verbose:
+                print(f"   prescreen #{pos}/{numPoints}: converged={converged[pos]}, max Re(eig)={maxRe[pos]:.4e}, Im={leadingImag[pos]:.4e}")
+    finally:
+        model.setParms(savedParms)
+    stable = converged & (maxRe < 0.)
+
+    bifurcations = []
+    for pos in range(1, numPoints):
+        if converged[pos] != converged[pos - 1]:
+            bifurcations.append((pos, 'no fixed point'))
+        elif not converged[pos]:
+            continue
+        elif stable[pos] != stable[pos - 1]:
+            unstable = pos if not stable[pos] else pos - 1
+            bifurcations.append((pos, 'Hopf' if leadingImag[unstable] > imagTol else 'fold'))
+        else:
+            change = np.max(np.abs(fixedPoints[pos] - fixedPoints[pos - 1]))
+            if change > jumpTol * max(np.max(np.abs(fixedPoints[pos - 1])), 1e-12):
+                bifurcations.append((pos, 'branch jump'))
+
+    worth = np.zeros(numPoints, dtype=bool)
+    for pos, kind in bifurcations:
+        worth[max(pos - 1 - marginPoints, 0):min(pos + 1 + marginPoints, numPoints)] = True
+    if criticalRate is not None:
+        worth |= converged & (maxRe > -criticalRate)
+    if not worth.any():  # nothing changes: keep the points closest to instability
+        closest = int(np.nanargmax(np.where(converged, maxRe, -np.inf))) if converged.any() else 0
+        worth[max(closest - marginPoints, 0):closest + marginPoints + 1] = True
+    if verbose:
+        print(f"Prescreen: transitions={bifurcations}, simulating {worth.sum()}/{numPoints} points")
+    return {'maxRe': maxRe, 'leadingImag': leadingImag, 'converged': converged, 'stable': stable,
+            'bifurcations': bifurcations, 'worthSimulating': worth}
+
+
+def worthSimulating(model, modelParms):
+    return prescreen(model, modelParms)['worthSimulating']
+
+
+# The (first, last) values of parmValues worth simulating, i.e., the sub-range to sweep
+def subRange(result, parmValues):
+    selected = np.asarray(parmValues)[result['worthSimulating']]
+    return selected.min(), selected.max()
+
+
+# ======================================================================
+# Test code: supHopf, sweeping the local bifurcation parameter a (the network loses stability when the
+# largest eigenvalue of a*I + G*(SC^T - diag(ink)) crosses 0), and Chen and Campbell over the we range of
+# Prepro_fgain_CC.py
+# ======================================================================
+if __name__ == '__main__':
+    import time
+    import WholeBrain.Optimizers.stabilityPrescreen as stabilityPrescreen  # the module steadyState sees (not __main__)
+    stabilityPrescreen.verbose = False
+    rng = np.random.default_rng(42)
+    N = 80
+    SC = rng.random((N, N)) * 0.2 / N
+
+    import WholeBrain.Models.supHopf as Hopf
+    Hopf.setParms({'SC': SC, 'we': 1., 'omega': 0.3 * np.ones(N), 'a': -0.02 * np.ones(N)})
+    As = np.linspace(-0.2, 0.1, 31)
+    t0 = time.perf_counter()
+    result = stabilityPrescreen.prescreen(Hopf, [{'a': a * np.ones(N)} for a in As])
+    print(f"supHopf ({len(As)} points, {time.perf_counter() - t0:.2f}s): transitions={result['bifurcations']}, "
+          f"worth simulating a in {stabilityPrescreen.subRange(result, As)}")
+    assert np.array_equal(Hopf.getParm('a'), -0.02 * np.ones(N))  # the model keeps its own a
+
+    import WholeBrain.Models.Chen_Campbell_Whole_Brain_version as CN
+    CN.setParms({'SC': SC, 'J': 1.})
+    WEs = np.arange(700., 701.8 + 0.02, 0.02)
+    t0 = time.perf_counter()
+    result = stabilityPrescreen.prescreen(CN, [{'we': we} for we in WEs])
+    print(f"Chen-Campbell ({len(WEs)} points, {time.perf_counter() - t0:.2f}s): transitions={result['bifurcations']}, "
+          f"max Re(eig) in [{np.nanmin(result['maxRe']):.3e}, {np.nanmax(result['maxRe']):.3e}], "
+          f"worth simulating we in {stabilityPrescreen.subRange(result, WEs)}")
+# ==========================================================================
+# ==========================================================================
+# ==========================================================================EOF
@@ -0,0 +1,37 @@
+# ==========================================================================
+# ==========================================================================
+# ==========================================================================
+# a set of different external stimuli to add to our simulations...
+#
+# By Gustavo Patow, heavily "inspired" by PyRates
+import numpy as np
+
+print("Going to use a Lorentzian external stimulus...")
+
+# A transient input with the shape of a Lorentzian (Cauchy) function of time, peaking at center with
+# height amp and half width at half maximum gamma: amp * gamma^2 / ((t - center)^2 + gamma^2)
+center = 300.0
+gamma = 10.0
+amp = 1.0
+N = 1
+# regionMap: per-region weights of the stimulus, passed by the integrator (see its stimuliRegionMap), or
+# None for the same stimulus at all the N regions
+def regionWeights(regionMap=None):
+    return np.ones(N) if regionMap is None else np.asarray(regionMap, dtype=float)
+
+
+def profile(t):  # works for scalars and arrays of times
+    return amp * gamma**2 / ((t - center)**2 + gamma**2)
+
+
+def stimulus(t, regionMap=None):
+    return profile(t) * regionWeights(regionMap)
+
+
+# Vectorized version: the stimulus at all the times in tValues, as a (len(tValues), N) array
+def stimulusSamples(tValues, regionMap=None):
+    return profile(np.asarray(tValues, dtype=float))[:, np.newaxis] * regionWeights(regionMap)
+
+# ==========================================================================
+# ==========================================================================
+# ==========================================================================
@@ -8,14 +8,24 @@ import numpy as np
 
 print("Going to use a constant external stimulus...")
 
-N = 1
 onset = 300.0
 amp = 0
-def stimulus(t):
-    if t < onset: return np.zeros(N)  # nothing before the onset
+N = 1
+# regionMap: per-region weights of the stimulus, passed by the integrator (see its stimuliRegionMap), or
+# None for the same stimulus at all the N regions
+def regionWeights(regionMap=None):
+    return np.ones(N) if regionMap is None else np.asarray(regionMap, dtype=float)
+
+
+def stimulus(t, regionMap=None):
+    if t < onset: return np.zeros(len(regionWeights(regionMap)))  # nothing before the onset
     # we start just at the onset: t-onset is our initial time
-    return amp * np.ones(N)
+    return amp * regionWeights(regionMap)
+
 
+# Vectorized version: the stimulus at all the times in tValues, as a (len(tValues), N) array
+def stimulusSamples(tValues, regionMap=None):
+    return np.where(np.asarray(tValues)[:, np.newaxis] < onset, 0., amp * regionWeights(regionMap))
 
 # ==========================================================================
 # ==========================================================================
@@ -0,0 +1,38 @@
+# ==========================================================================
+# ==========================================================================
+# ==========================================================================
+# a set of different external stimuli to add to our simulations...
+#
+# By Gustavo Patow, heavily "inspired" by PyRates
+import numpy as np
+
+print("Going to use a pulse train external stimulus...")
+
+onset = 30.0
+period = 100.0        # time between the starts of two consecutive pulses
+width = 10.0          # duration of each pulse
+termination = None    # no more pulses from this time on (None = until the end of the simulation)
+amp = 1.0
+N = 1
+# regionMap: per-region weights of the stimulus, passed by the integrator (see its stimuliRegionMap), or
+# None for the same stimulus at all the N regions
+def regionWeights(regionMap=None):
+    return np.ones(N) if regionMap is None else np.asarray(regionMap, dtype=float)
+
+
+def pulseOn(t):  # works for scalars and arrays of times
+    on = (t >= onset) & (np.mod(t - onset, period) < width)
+    return on if termination is None else on & (t < termination)
+
+
+def stimulus(t, regionMap=None):
+    return amp * regionWeights(regionMap) * pulseOn(t)
+
+
+# Vectorized version: the stimulus at all the times in tValues, as a (len(tValues), N) array
+def stimulusSamples(tValues, regionMap=None):
+    return np.where(pulseOn(np.asarray(tValues))[:, np.newaxis], amp * regionWeights(regionMap), 0.)
+
+# ==========================================================================
+# ==========================================================================
+# ==========================================================================
@@ -8,15 +8,31 @@ import numpy as np
 
 print("Going to use an external uniform.randn (standard normal) stimulus...")
 
-N = 1
 onset = 30.0
 mu = 0.0
 sigma = 1.0
-def stimulus(t):
-    if t < onset: return np.zeros(N)  # nothing before the onset
+N = 1
+# regionMap: per-region weights of the stimulus, passed by the integrator (see its stimuliRegionMap), or
+# None for the same stimulus at all the N regions
+def regionWeights(regionMap=None):
+    return np.ones(N) if regionMap is None else np.asarray(regionMap, dtype=float)
+
+
+def stimulus(t, regionMap=None):
+    weights = regionWeights(regionMap)
+    if t < onset: return np.zeros(len(weights))  # nothing before the onset
     # we start just at the onset: t-onset is our initial time
-    return mu + np.random.randn(N) * sigma
+    return (mu + np.random.randn(len(weights)) * sigma) * weights
+
 
+# Vectorized version: the stimulus at all the times in tValues, as a (len(tValues), N) array. Random
+# values are drawn in the same order as successive stimulus(t) calls, so both give the same samples.
+def stimulusSamples(tValues, regionMap=None):
+    weights = regionWeights(regionMap)
+    after = np.asarray(tValues) >= onset
+    samples = np.zeros((len(after), len(weights)))
+    samples[after] = mu + np.random.randn(np.count_nonzero(after), len(weights)) * sigma
+    return samples * weights
 
 # ==========================================================================
 # ==========================================================================
@@ -0,0 +1,38 @@
+# ==========================================================================
+# ==========================================================================
+# ==========================================================================
+# a set of different external stimuli to add to our simulations...
+#
+# By Gustavo Patow, heavily "inspired" by PyRates
+import numpy as np
+
+print("Going to use an external uniform random stimulus...")
+
+onset = 30.0
+low = 0.0
+high = 1.0
+N = 1
+# regionMap: per-region weights of the stimulus, passed by the integrator (see its stimuliRegionMap), or
+# None for the same stimulus at all the N regions
+def regionWeights(regionMap=None):
+    return np.ones(N) if regionMap is None else np.asarray(regionMap, dtype=float)
+
+
+def stimulus(t, regionMap=None):
+    weights = regionWeights(regionMap)
+    if t < onset: return np.zeros(len(weights))  # nothing before the onset
+    return np.random.uniform(low, high, len(weights)) * weights
+
+
+# Vectorized version: the stimulus at all the times in tValues, as a (len(tValues), N) array. Random
+# values are drawn in the same order as successive stimulus(t) calls, so both give the same samples.
+def stimulusSamples(tValues, regionMap=None):
+    weights = regionWeights(regionMap)
+    after = np.asarray(tValues) >= onset
+    samples = np.zeros((len(after), len(weights)))
+    samples[after] = np.random.uniform(low, high, (np.count_nonzero(after), len(weights)))
+    return samples * weights
+
+# ==========================================================================
+# ==========================================================================
+# ==========================================================================
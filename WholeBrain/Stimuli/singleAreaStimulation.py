@@ -0,0 +1,40 @@
+# ==========================================================================
+# ==========================================================================
+# ==========================================================================
+# a set of different external stimuli to add to our simulations...
+#
+# By Gustavo Patow, heavily "inspired" by PyRates
+import numpy as np
+
+print("Going to use a single area stimulation...")
+
+# A constant input of amplitude amp into the area seed, between onset and termination
+seed = 0
+onset = 30.0
+termination = None  # None = until the end of the simulation
+amp = 1.0
+N = 1
+# regionMap: per-region weights, passed by the integrator (see its stimuliRegionMap). If given, it
+# scales the stimulus of the seed area (the rest of the areas get nothing anyway)
+def regionWeights(regionMap=None):
+    weights = np.zeros(N)
+    weights[seed] = 1.
+    return weights if regionMap is None else weights * np.asarray(regionMap, dtype=float)
+
+
+def active(t):  # works for scalars and arrays of times
+    on = t >= onset
+    return on if termination is None else on & (t < termination)
+
+
+def stimulus(t, regionMap=None):
+    return amp * regionWeights(regionMap) * active(t)
+
+
+# Vectorized version: the stimulus at all the times in tValues, as a (len(tValues), N) array
+def stimulusSamples(tValues, regionMap=None):
+    return np.where(active(np.asarray(tValues))[:, np.newaxis], amp * regionWeights(regionMap), 0.)
+
+# ==========================================================================
+# ==========================================================================
+# ==========================================================================
@@ -1,4 +1,7 @@
 import numpy as np
+from numba import jit
+from WholeBrain.Utils import precision
+import WholeBrain.Utils.BOLD.onlineBOLD as onlineBOLD
 
 print("Going to use Friston2003 BOLD model...")
 
@@ -6,6 +9,21 @@ t_min = 20  # (s)
 dt = 0.001  # (s)
 n_min = int(np.round(t_min / dt))
 
+# BOLD model parameters
+taus = 0.65    # 0.8;    % time unit (s)
+tauf = 0.41    # 0.4;    % time unit (s)
+tauo = 0.98    # 1;      % mean transit time (s)
+alpha = 0.33    #0.32; % 0.2;    % a stiffness exponent
+itaus = 1 / taus
+itauf = 1 / tauf
+itauo = 1 / tauo
+ialpha = 1 / alpha
+Eo = 0.34    # 0.8;    % resting oxygen extraction fraction  --> rho in the paper
+vo = 0.02    # --> V0, from Friston et al. 2003
+k1 = 7 * Eo # coeffs from Deco et al 2013
+k2 = 2
+k3 = 2 * Eo - 0.2
+
 
 def computeRequiredVectorLength(T):
     global t_min, dt, n_min
@@ -15,63 +33,120 @@ def computeRequiredVectorLength(T):
 
 
 def BOLDModel(T, r):
-    global t_min, dt, n_min
     # The Hemodynamic model with one simplified neural activity
     #     by Friston et al. 2003, Friston et al. 2000
     #
     # T          : total time (s)
-    # resolution : dt in (s)
+    # r          : the input neural activity
     #
     # Code from Deco et al. 2014
-
-    global itaus, itauf, itauo, ialpha
-
-    # BOLD model parameters
-    taus = 0.65    # 0.8;    % time unit (s)
-    tauf = 0.41    # 0.4;    % time unit (s)
-    tauo = 0.98    # 1;      % mean transit time (s)
-    alpha = 0.33    #0.32; % 0.2;    % a stiffness exponent
-    itaus = 1 / taus
-    itauf = 1 / tauf
-    itauo = 1 / tauo
-    ialpha = 1 / alpha
-    Eo = 0.34    # 0.8;    % resting oxygen extraction fraction  --> rho in the paper
-    vo = 0.02    # --> V0, from Friston et al. 2003
-    k1 = 7 * Eo # coeffs from Deco et al 2013
-    k2 = 2
-    k3 = 2 * Eo - 0.2
-
-    # dt = resolution    # (s)
-    #t0 = np.arange(0,T,dt).reshape(-1,1)
-    #n_t = t0.size
-    n_t = int(T/dt)
-
-    # t_min = tmin
+    #
+    # Euler method, from the initial conditions x0 = [0, 1, 1, 1] for [s, f, v, q], and the
+    # Balloon-Windkessel model from Buxton et al. 1998 for the signal, from t_min on (see the
+    # all-regions kernel below, which does the actual work)
+    return BOLDModelAllRegions(T, r[:, np.newaxis], 1)[:, 0]
+
+
+# --------------------------------------------------------------------------
+# All regions at once, TR-sampled output
+# --------------------------------------------------------------------------
+# The model for all the columns (regions, or trials*regions) of the neural activity x (n_t, N) together,
+# on a (4, N) state, in a single compiled call, storing only the samples at n_min + step-1,
+# n_min + 2*step-1, ... (with step = 1, the whole signal from t_min on, as BOLDModel). The state is kept in
+# the precision of x. The same steps are used by the integrators to compute the BOLD signal online (see
+# WholeBrain.Utils.BOLD.onlineBOLD, which does the stepping and sampling).
+
+
+# The state: s, f, v, q, starting at x0 = [0, 1, 1, 1]
+def initOnlineState(M, dtype=precision.floatType):
+    state = np.ones((4, M), dtype=dtype)
+    state[0] = 0.
+    return state
+
+
+@jit(nopython=True)
+def stepAllRegions(state, x, dt):
+    s = state[0]; f = state[1]; v = state[2]; q = state[3]
+    for i in range(x.shape[0]):
+        sNew = s[i] + dt * (x[i] - itaus * s[i] - itauf * (f[i] - 1))
+        fNew = f[i] + dt * s[i]
+        fv = v[i] ** ialpha
+        vNew = v[i] + dt * itauo * (f[i] - fv)
+        q[i] = q[i] + dt * itauo * (f[i] * (1 - (1 - Eo) ** (1 / f[i])) / Eo - fv * q[i] / v[i])
+        s[i] = sNew; f[i] = fNew; v[i] = vNew
+
+
+@jit(nopython=True)
+def signalAllRegions(state, out):  # the Balloon-Windkessel model from Buxton et al. 1998, as in BOLDModel
+    v = state[2]; q = state[3]
+    for i in range(out.shape[0]):
+        out[i] = 100 / Eo * vo * (k1 * (1 - q[i]) + k2 * (1 - q[i] / v[i]) + k3 * (1 - v[i]))
+
+
+# T: total time (s), x: the neural activity of all the regions (n_t, N), step: TR / dt
+def BOLDModelAllRegions(T, x, step):
+    return onlineBOLD.allRegions(T, x, step, dt, t_min, initOnlineState(x.shape[1], x.dtype), stepAllRegions, signalAllRegions)
+
+
+# ======================================================================
+# Regression test: the compiled all-regions model against two independent integrations of the same equations,
+# the original per-sample Euler loop (Deco et al. 2014) in plain numpy, and the continuous-time solution
+# (scipy's solve_ivp, with tight tolerances) for a smooth input, plus the cost of the three Balloon-Windkessel
+# models (Friston2003, Stephan2007, Stephan2008) for all the regions of a subject
+# ======================================================================
+if __name__ == '__main__':
+    import time
+    from scipy.integrate import solve_ivp
+    import WholeBrain.Utils.BOLD.BOLDHemModel_Friston2003 as Friston2003  # the module we test (not __main__)
+    import WholeBrain.Utils.BOLD.BOLDHemModel_Stephan2007 as Stephan2007
+    import WholeBrain.Utils.BOLD.BOLDHemModel_Stephan2008 as Stephan2008
+    rng = np.random.default_rng(42)
+    N = 6; T = 80.; TR = 2.
+    step = int(np.round(TR / dt))
+    freqs = rng.uniform(0.01, 0.5, (4, N)); phases = rng.uniform(0., 2. * np.pi, (4, N))
+    def inputAt(t):  # a smooth neural input for each region
+        return 0.5 + 0.075 * np.sum(np.sin(2. * np.pi * freqs * np.asarray(t)[..., np.newaxis, np.newaxis] + phases), axis=-2)
+    x = inputAt(np.arange(int(T / dt) + 1) * dt)
+
+    def reference(T, r):  # the original loop, with an explicit time axis
+        n_t = int(T / dt); n_min = int(np.round(t_min / dt))
+        xs = np.zeros([n_t, 4]); xs[0, :] = np.array([0, 1, 1, 1])
+        for n in range(n_t - 1):
+            xs[n + 1, 0] = xs[n, 0] + dt * (r[n] - itaus * xs[n, 0] - itauf * (xs[n, 1] - 1))
+            xs[n + 1, 1] = xs[n, 1] + dt * xs[n, 0]
+            xs[n + 1, 2] = xs[n, 2] + dt * itauo * (xs[n, 1] - xs[n, 2] ** ialpha)
+            xs[n + 1, 3] = xs[n, 3] + dt * itauo * (xs[n, 1] * (1 - (1 - Eo) ** (1 / xs[n, 1])) / Eo - (xs[n, 2] ** ialpha) * xs[n, 3] / xs[n, 2])
+        q = xs[n_min:n_t, 3]; v = xs[n_min:n_t, 2]
+        return 100 / Eo * vo * (k1 * (1 - q) + k2 * (1 - q / v) + k3 * (1 - v))
+
+    euler = np.stack([reference(T, x[:, n]) for n in range(N)], axis=1)
+    full = np.stack([Friston2003.BOLDModel(T, x[:, n]) for n in range(N)], axis=1)
+    sampled = Friston2003.BOLDModelAllRegions(T, x, step)
+    errFull = np.max(np.abs(full - euler)); errTR = np.max(np.abs(sampled - euler[step-1::step]))
+    print(f"Friston2003 vs. the original Euler loop: max diff={errFull:.2e} (full resolution), {errTR:.2e} (TR samples)")
+    assert errFull < 1e-10 and errTR < 1e-10
+
+    def rhs(t, y):
+        s, f, v, q = y.reshape(4, N)
+        return np.concatenate((inputAt(t) - itaus * s - itauf * (f - 1), s, itauo * (f - v ** ialpha),
+                               itauo * (f * (1 - (1 - Eo) ** (1 / f)) / Eo - (v ** ialpha) * q / v)))
     n_min = int(np.round(t_min / dt))
-
-    # Initial conditions
-    x0 = np.array([0, 1, 1, 1])
-
-    # Euler method
-    t = t0
-    x = np.zeros([n_t, 4])
-    x[0,:] = x0
-    for n in range(n_t-1):
-        x[n + 1, 0] = x[n, 0] + dt * (r[n] - itaus * x[n, 0] - itauf * (x[n, 1] - 1))
-        x[n + 1, 1] = x[n, 1] + dt * x[n, 0]
-        x[n + 1, 2] = x[n, 2] + dt * itauo * (x[n, 1] - x[n, 2] ** ialpha)
-        x[n + 1, 3] = x[n, 3] + dt * itauo * (x[n, 1] * (1 - (1 - Eo) ** (1 / x[n, 1])) / Eo - (x[n, 2] ** ialpha) * x[n, 3] / x[n, 2])
-
-    # The Balloon-Windkessel model from Buxton et al. 1998:
-    t = t[n_min:t.size]
-    s = x[n_min:n_t, 0]
-    fi = x[n_min:n_t, 1]
-    v = x[n_min:n_t, 2]
-    q = x[n_min:n_t, 3]
-    b = 100 / Eo * vo * (k1 * (1 - q) + k2 * (1 - q / v) + k3 * (1 - v))
-    #clear(x)
-
-    time = (np.arange(1,b.size+1)) * resolution + t_min * resolution
-
-    return b  #, time
-
+    tSamples = (n_min + step - 1 + step * np.arange(sampled.shape[0])) * dt
+    y0 = np.concatenate((np.zeros(N), np.ones(3 * N)))
+    solution = solve_ivp(rhs, (0., tSamples[-1]), y0, t_eval=tSamples, rtol=1e-10, atol=1e-12).y.reshape(4, N, -1)
+    v = solution[2].T; q = solution[3].T
+    continuous = 100 / Eo * vo * (k1 * (1 - q) + k2 * (1 - q / v) + k3 * (1 - v))
+    relErr = np.max(np.abs(sampled - continuous)) / np.max(np.abs(continuous - continuous.mean(axis=0)))
+    print(f"Friston2003 vs. the continuous-time solution: max error={relErr:.2e} of the signal range (Euler, dt={dt}s)")
+    assert relErr < 1e-2
+
+    N = 80; T = 412.
+    x = (0.4 + 0.05 * rng.standard_normal((int(T / dt) + 1, N)))
+    for model in [Friston2003, Stephan2007, Stephan2008]:
+        model.BOLDModelAllRegions(T, x[:1000], step)  # compile...
+        t0 = time.perf_counter()
+        model.BOLDModelAllRegions(T, x, step)
+        print(f"{model.__name__.split('.')[-1]}: {N} regions x {T}s in {time.perf_counter() - t0:.2f}s")
+# ======================================================================
+# ======================================================================
+# ======================================================================EOF
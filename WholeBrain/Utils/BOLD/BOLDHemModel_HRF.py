@@ -0,0 +1,224 @@
+# ----------------------------------------
+# ----------------------------------------
+# BOLD signal as the convolution of the neural activity with a hemodynamic response function (HRF)
+#
+# A linear, fast alternative to the (nonlinear) Balloon-Windkessel models (Stephan2007, Stephan2008,
+# Friston2003), for coarse passes of parameter sweeps: the BOLD signal of each region is x * h, with h
+#   * the canonical HRF of SPM, a difference of two gamma densities (a peak at ~5s and an undershoot at
+#     ~15s) [Friston_1998, Glover_1999], normalized to unit sum (so, a constant input gives the same
+#     constant output), scaled by amplitude, or
+#   * any other kernel sampled at dt, set with setKernel, e.g., the impulse response of one of the
+#     Balloon-Windkessel models around the mean neural activity (kernelFromBOLDModel), which is their
+#     linearization, and gives much closer FCs than the canonical HRF (see the report below).
+# For all the regions at once (in chunks of columnChunk regions), the full-resolution convolution is computed
+# with batched FFTs, while at TR resolution we only compute the samples at the TR points: cutting the kernel
+# and the signal in blocks of one TR, each sample is the sum of the products of a few kernel blocks with the
+# signal blocks before it, i.e., a single matrix product for all the samples and regions. This is exact (the
+# same values as the FFT, up to rounding), and for HRF lengths of a few TRs, much cheaper than transforming
+# the whole signal.
+#
+# Same interface as the other BOLD models: computeRequiredVectorLength(T) and BOLDModel(T, x) for a single
+# region at full resolution, and BOLDModelAllRegions(T, x, step) for all of them at TR resolution (used by
+# WholeBrain.Utils.simulate_SimAndBOLD).
+#
+# [Friston_1998] K.J. Friston, P. Fletcher, O. Josephs, A. Holmes, M.D. Rugg, R. Turner, Event-related fMRI:
+#                characterizing differential responses, NeuroImage 7 (1998) 30-40
+# [Glover_1999] G.H. Glover, Deconvolution of impulse response in event-related BOLD fMRI,
+#               NeuroImage 9 (1999) 416-429
+# ----------------------------------------
+# ----------------------------------------
+import numpy as np
+from scipy import fft, special
+import WholeBrain.Utils.BOLD.onlineBOLD as onlineBOLD
+
+print("Going to use the HRF convolution BOLD model...")
+
+t_min = 0  # (s)
+dt = 0.001  # (s)
+
+def computeRequiredVectorLength(T):
+    global t_min, dt
+    n_min = int(np.round(t_min / dt))
+    n_t = int(T/dt)
+    return n_t - n_min
+
+# Canonical HRF parameters (the defaults of SPM's spm_hrf), in seconds
+# ----------------------------------------
+peakDelay = 6.             # delay of the response (relative to onset)
+undershootDelay = 16.      # delay of the undershoot
+peakDispersion = 1.        # dispersion of the response
+undershootDispersion = 1.  # dispersion of the undershoot
+undershootRatio = 6.       # ratio of the response to the undershoot
+kernelLength = 32.         # length of the kernel
+amplitude = 1.
+
+kernel = None      # a user-provided kernel, sampled at dt (see setKernel), instead of the canonical HRF
+columnChunk = 32   # regions convolved together
+
+
+def gammaDensity(t, shape, scale):
+    with np.errstate(divide='ignore'):
+        return np.where(t > 0., np.exp((shape - 1.) * np.log(t) - t / scale - special.gammaln(shape) - shape * np.log(scale)), 0.)
+
+
+def canonicalHRF(t):
+    h = gammaDensity(t, peakDelay / peakDispersion, peakDispersion) - \
+        gammaDensity(t, undershootDelay / undershootDispersion, undershootDispersion) / undershootRatio
+    return h / np.sum(h)
+
+
+def HRF():
+    h = canonicalHRF(np.arange(0., kernelLength, dt)) if kernel is None else kernel
+    return amplitude * h
+
+
+def setKernel(h):  # None goes back to the canonical HRF
+    global kernel
+    kernel = None if h is None else np.asarray(h, dtype=np.float64)
+
+
+# The impulse response of the (single region) BOLDModel of the module BOLDHemModel, linearized around a
+# constant neural activity baseline (e.g., the mean of the simulated activity): the response to a small
+# pulse, after letting the model settle at the baseline for settleTime seconds.
+def kernelFromBOLDModel(BOLDHemModel, baseline=0., length=kernelLength, settleTime=60., pulse=1e-3):
+    BOLDHemModel.dt = dt
+    nSettle = int(np.round(settleTime / dt)); n = int(np.round(length / dt))
+    T = (nSettle + n + 1) * dt
+    x = np.full(int(T / dt) + 1, baseline, dtype=np.float64)
+    b0 = BOLDHemModel.BOLDModel(T, x.copy())
+    x[nSettle] += pulse / dt  # an impulse of area pulse
+    b1 = BOLDHemModel.BOLDModel(T, x)
+    n_min = int(np.round(BOLDHemModel.t_min / dt))
+    return (b1 - b0)[nSettle - n_min:nSettle - n_min + n] * dt / pulse
+
+
+# x * h at the time points given by indices, for the columns of x (n_t, M), computed with FFTs of a
+# length that avoids the circular wrap-around
+def convolveAt(x, h, indices):
+    n_t = x.shape[0]
+    nfft = fft.next_fast_len(n_t + h.shape[0] - 1, real=True)
+    H = fft.rfft(h, nfft)
+    result = np.empty((len(indices), x.shape[1]), dtype=x.dtype)
+    for first in range(0, x.shape[1], columnChunk):
+        cols = slice(first, min(first + columnChunk, x.shape[1]))
+        X = fft.rfft(np.ascontiguousarray(x[:, cols].T, dtype=np.float64), nfft, axis=-1, workers=-1)
+        X *= H
+        result[:, cols] = fft.irfft(X, nfft, axis=-1, workers=-1)[:, indices].T
+    return result
+
+
+# x * h at the time points first, first + step, ..., (numSamples of them), for the columns of x (n_t, M).
+# With hBlocks[b, i] = h[b*step + step-1-i] and X_J the J-th block of step samples of x (the one ending at
+# first - step + J*step, with zeros before the start of x), the sample m is sum_b hBlocks[b] . X_{m-b-1+nb}.
+def convolveAtTR(x, h, first, step, numSamples):
+    cols = x.shape[1]
+    result = np.zeros((numSamples, cols), dtype=x.dtype)
+    if numSamples == 0:
+        return result
+    nb = -(-h.shape[0] // step)  # number of kernel blocks
+    hBlocks = np.zeros(nb * step); hBlocks[:h.shape[0]] = h
+    hBlocks = hBlocks.reshape(nb, step)[:, ::-1]
+    numRows = numSamples - 1 + nb
+    J0 = max(0, nb - (first + 1) // step)  # the blocks from J0 on are entirely within x
+    start = (J0 - nb) * step + first + 1
+    for c0 in range(0, cols, columnChunk):
+        c1 = min(c0 + columnChunk, cols)
+        products = np.empty((nb, numRows, c1 - c0))
+        body = np.asarray(x[start:start + (numRows - J0) * step, c0:c1], dtype=np.float64)
+        products[:, J0:] = np.tensordot(hBlocks, body.reshape(numRows - J0, step, c1 - c0), axes=([1], [1]))
+        for J in range(J0):  # the blocks that start before x, padded with zeros
+            block = np.zeros((step, c1 - c0)); blockStart = (J - nb) * step + first + 1
+            if blockStart + step > 0:
+                block[max(0, -blockStart):] = x[max(0, blockStart):blockStart + step, c0:c1]
+            products[:, J] = hBlocks @ block
+        y = np.zeros((numSamples, c1 - c0))
+        for b in range(nb):
+            y += products[b, nb - b - 1:nb - b - 1 + numSamples]
+        result[:, c0:c1] = y
+    return result
+
+
+def BOLDModel(T, x):
+    # T          : total time (s)
+    # x          : the input neural activity
+    n_min = int(np.round(t_min / dt))
+    n_t = int(T/dt)
+    return convolveAt(x[:n_t, np.newaxis], HRF(), np.arange(n_min, n_t))[:, 0]
+
+
+# T: total time (s), x: the neural activity of all the regions (n_t, N), step: TR / dt. Returns the BOLD
+# signal at n_min + step-1, n_min + 2*step-1, ... (as BOLDModel(T, x)[step-1::step] for each region, and
+# as the other BOLD models, see onlineBOLD.numTRSamples)
+def BOLDModelAllRegions(T, x, step):
+    n_min = int(np.round(t_min / dt))
+    n_t = int(T/dt)
+    return convolveAtTR(x[:n_t], HRF(), n_min + step - 1, step, onlineBOLD.numTRSamples(n_t, n_min, step))
+
+
+# ======================================================================
+# Benchmark and report: the time to compute the BOLD signal of all the regions of a subject, and how much
+# the FC and swFCD (and their fitting of a we sweep of the DMF) change w.r.t. Stephan2008, for the
+# canonical HRF and for the linearization of Stephan2008 (kernelFromBOLDModel)
+# ======================================================================
+if __name__ == '__main__':
+    import time
+    import WholeBrain.Utils.BOLD.BOLDHemModel_HRF as HRFModel  # the module we configure (not __main__)
+    import WholeBrain.Utils.BOLD.BOLDHemModel_Stephan2008 as Stephan2008
+    import WholeBrain.Models.DynamicMeanField as DMF
+    import WholeBrain.Integrators.HeunStochastic as integrator
+    from WholeBrain.Observables import FC, swFCD, BOLDFilters
+    rng = np.random.default_rng(42)
+    TR = 2.; step = int(np.round(TR / dt))
+
+    def timeIt(f):
+        f()
+        t0 = time.perf_counter(); f()
+        return time.perf_counter() - t0
+
+    N = 80; T = 412.  # (176 + 30) TRs of 2s, as in simulate_SimAndBOLD
+    x = (0.4 + 0.05 * rng.standard_normal((int(T / dt) + 1, N))).astype(np.float64)
+    tLoop = timeIt(lambda: [Stephan2008.BOLDModel(T, x[:, n])[step-1::step] for n in range(N)])
+    tAll = timeIt(lambda: Stephan2008.BOLDModelAllRegions(T, x, step))
+    tHRF = timeIt(lambda: HRFModel.BOLDModelAllRegions(T, x, step))
+    tFFT = timeIt(lambda: HRFModel.convolveAt(x[:int(T / dt)], HRFModel.HRF(), np.arange(step - 1, int(T / dt), step)))
+    print(f"BOLD of {N} regions x {T}s: Stephan2008 per region {tLoop:.2f}s, all regions {tAll:.2f}s; "
+          f"HRF convolution at TR {tHRF:.3f}s (with FFTs {tFFT:.2f}s, max diff="
+          f"{np.max(np.abs(HRFModel.convolveAt(x[:int(T / dt)], HRFModel.HRF(), np.arange(step - 1, int(T / dt), step)) - HRFModel.BOLDModelAllRegions(T, x, step))):.1e})")
+
+    # DMF simulations of a few subjects for a we sweep, with both BOLD models applied to the same neural activity
+    N = 40; numSubjects = 4; Tsim = 300.  # (s)
+    SC = rng.random((N, N)) * (rng.random((N, N)) < 0.2); SC = (SC + SC.T) / 2.; SC = SC / SC.max() * 0.2
+    DMF.setParms({'SC': SC, 'J': np.ones(N)})
+    integrator.neuronalModel = DMF; integrator.verbose = False; integrator.ds = 1.
+    BOLDFilters.TR = TR; swFCD.windowSize = 30; swFCD.windowStep = 3
+    WEs = [0.5, 1.0, 1.5, 2.0, 2.5]
+    iu = np.tril_indices(N, -1)
+    results = {'Stephan2008': [], 'canonical HRF': [], 'fitted HRF': []}
+    for we in WEs:
+        DMF.setParms({'we': we})
+        integrator.seedNoise(1)
+        neuro = integrator.warmUpAndSimulate(0.1, Tsim * 1000., TWarmUp=10000., numTrials=numSubjects)[:, :, 0, :]
+        HRFModel.setKernel(kernelFromBOLDModel(Stephan2008, baseline=float(np.mean(neuro))))
+        fitted = [HRFModel.BOLDModelAllRegions(Tsim, neuro[:, s, :], step) for s in range(numSubjects)]
+        HRFModel.setKernel(None)
+        canonical = [HRFModel.BOLDModelAllRegions(Tsim, neuro[:, s, :], step) for s in range(numSubjects)]
+        balloon = [Stephan2008.BOLDModelAllRegions(Tsim, neuro[:, s, :], step) for s in range(numSubjects)]
+        for name, bds in [('Stephan2008', balloon), ('canonical HRF', canonical), ('fitted HRF', fitted)]:
+            # unfiltered: BOLDFilters.BandPassFilter needs WholeBrain.Observables.demean, which is empty in this tree
+            results[name].append((np.mean([FC.from_fMRI(b.T, applyFilters=False) for b in bds], axis=0),
+                                  np.concatenate([swFCD.from_fMRI(b.T, applyFilters=False) for b in bds])))
+    reference = results['Stephan2008'][len(WEs) // 2]  # the "empirical" data: Stephan2008 at the middle we
+    for name in ['canonical HRF', 'fitted HRF']:
+        fcSimilarity = [FC.FC_Similarity(results[name][k][0], results['Stephan2008'][k][0]) for k in range(len(WEs))]
+        fcdKS = [swFCD.KolmogorovSmirnovStatistic(results[name][k][1], results['Stephan2008'][k][1]) for k in range(len(WEs))]
+        print(f"{name} vs. Stephan2008, for we={WEs}:")
+        print(f"   FC similarity (Pearson of the FCs): {np.round(fcSimilarity, 3)}")
+        print(f"   swFCD KS distance:                  {np.round(fcdKS, 3)}")
+    for name in results:
+        fcFit = [FC.distance(r[0], reference[0]) for r in results[name]]
+        fcdFit = [swFCD.distance(r[1], reference[1]) for r in results[name]]
+        print(f"fitting with {name:13s}: FC similarity {np.round(fcFit, 3)} (best we={WEs[int(np.argmax(fcFit))]}), "
+              f"swFCD KS {np.round(fcdFit, 3)} (best we={WEs[int(np.argmin(fcdFit))]})")
+# ======================================================================
+# ======================================================================
+# ======================================================================EOF
@@ -11,6 +11,8 @@
 # ----------------------------------------
 import numpy as np
 from numba import jit
+from WholeBrain.Utils import precision
+import WholeBrain.Utils.BOLD.onlineBOLD as onlineBOLD
 
 print("Going to use Stephan2007 BOLD model...")
 
@@ -18,6 +20,30 @@ t_min = 0  # (s)
 dt = 0.001  # (s)
 n_min = int(np.round(t_min / dt))
 
+# BOLD model parameters. In general, these values are from:
+# Dynamic causal modelling,
+# K.J. Friston, L. Harrison, and W. Penny,
+# NeuroImage 19 (2003) 1273–1302
+# ----------------------------------------
+taus = 0.65  # 0.8;    # time unit (s)  --> kappa in the paper
+tauf = 0.41  # 0.4;    # time unit (s)  --> gamma in the paper
+tauo = 0.98  # 1;      # mean transit time (s)  --> tau in the paper
+alpha = 0.32 # 0.2;    # a stiffness exponent   --> alpha in the paper
+itaus = 1. / taus
+itauf = 1. / tauf
+itauo = 1. / tauo
+ialpha = 1. / alpha
+
+Eo = 0.4  # This value is from Obata et al. (2004)
+TE = 0.04  # --> TE, from Stephan et al. 2007
+vo = 0.04  # ???
+r0 = 25  # (s)^-1 --> r0, from Stephan et al. 2007
+theta0 = 40.3  # (s)^-1
+# Part of equation (12) in Stephan et al. 2007:
+k1 = 4.3*theta0*Eo*TE
+k2 = r0*Eo*TE  # Shouldn't it be epsilon*r0*Eo*TE ???
+k3 = 1  # Shouldn't it be 1-epsilon ???
+
 
 def computeRequiredVectorLength(T):
     global t_min, dt, n_min
@@ -43,32 +69,7 @@ def BOLDModel(T, r):
     # NeuroImage 38 (2007) 387–401
 
     # global itaus, itauf, itauo, ialpha, Eo, dt
-
-    # BOLD model parameters. In general, these values are from:
-    # Dynamic causal modelling,
-    # K.J. Friston, L. Harrison, and W. Penny,
-    # NeuroImage 19 (2003) 1273–1302
-    # ----------------------------------------
-
-    # global t_min, dt, n_min
-    taus = 0.65  # 0.8;    # time unit (s)  --> kappa in the paper
-    tauf = 0.41  # 0.4;    # time unit (s)  --> gamma in the paper
-    tauo = 0.98  # 1;      # mean transit time (s)  --> tau in the paper
-    alpha = 0.32 # 0.2;    # a stiffness exponent   --> alpha in the paper
-    itaus = 1. / taus
-    itauf = 1. / tauf
-    itauo = 1. / tauo
-    ialpha = 1. / alpha
-
-    Eo = 0.4  # This value is from Obata et al. (2004)
-    TE = 0.04  # --> TE, from Stephan et al. 2007
-    vo = 0.04  # ???
-    r0 = 25  # (s)^-1 --> r0, from Stephan et al. 2007
-    theta0 = 40.3  # (s)^-1
-    # Part of equation (12) in Stephan et al. 2007:
-    k1 = 4.3*theta0*Eo*TE
-    k2 = r0*Eo*TE  # Shouldn't it be epsilon*r0*Eo*TE ???
-    k3 = 1  # Shouldn't it be 1-epsilon ???
+    # (the BOLD model parameters are at the top of this file)
 
     # dt = resolution    # (s)
     #t0 = np.arange(0,T,dt).reshape(-1,1)
@@ -113,3 +114,47 @@ def BOLDModel(T, r):
     #     print(f"NAN!!!")
 
     return b
+
+
+# --------------------------------------------------------------------------
+# All regions at once, TR-sampled output
+# --------------------------------------------------------------------------
+# The same Euler steps as BOLDModel, for all the columns (regions, or trials*regions) of the neural activity
+# x (n_t, N) together, on a (4, N) state, in a single compiled call, storing only the samples at
+# n_min + step-1, n_min + 2*step-1, ... (as BOLDModel(T, x)[step-1::step] for each region). The state is kept
+# in the precision of x. The same steps are used by the integrators to compute the BOLD signal online (see
+# WholeBrain.Utils.BOLD.onlineBOLD, which does the stepping and sampling).
+
+
+# The state: s, f, v, q, starting at x0 = [0, 1, 1, 1] (see BOLDModel)
+def initOnlineState(M, dtype=precision.floatType):
+    state = np.ones((4, M), dtype=dtype)
+    state[0] = 0.
+    return state
+
+
+@jit(nopython=True)
+def stepAllRegions(state, x, dt):
+    s = state[0]; f = state[1]; v = state[2]; q = state[3]
+    for i in range(x.shape[0]):
+        sNew = s[i] + dt * (x[i] - itaus * s[i] - itauf * (f[i] - 1))
+        fNew = f[i] + dt * s[i]
+        fv = v[i] ** ialpha
+        vNew = v[i] + dt * itauo * (f[i] - fv)
+        q[i] = q[i] + dt * itauo * (f[i] * (1-(1 - Eo)**(1/f[i]))/Eo - fv * q[i]/v[i])
+        s[i] = sNew; f[i] = fNew; v[i] = vNew
+
+
+@jit(nopython=True)
+def signalAllRegions(state, out):  # Equation (12) in Stephan et al. 2007, as in BOLDModel
+    v = state[2]; q = state[3]
+    for i in range(out.shape[0]):
+        out[i] = vo * (k1 * (1 - q[i]) + k2 * (1 - q[i] / v[i]) + k3 * (1 - v[i]))
+
+
+# T: total time (s), x: the neural activity of all the regions (n_t, N), step: TR / dt
+def BOLDModelAllRegions(T, x, step):
+    return onlineBOLD.allRegions(T, x, step, dt, t_min, initOnlineState(x.shape[1], x.dtype), stepAllRegions, signalAllRegions)
+# ==========================================================================
+# ==========================================================================
+# ==========================================================================EOF
@@ -19,6 +19,8 @@
 import numpy as np
 # from numba import vectorize, float64
 from numba import jit
+from WholeBrain.Utils import precision
+import WholeBrain.Utils.BOLD.onlineBOLD as onlineBOLD
 
 print("Going to use Stephan2008 BOLD model...")
 
@@ -86,11 +88,11 @@ def BOLDModel(T, x):
 
     n_t = int(T/dt)
 
-    # Euler method
-    s = np.zeros(n_t); #stilde = np.zeros(n_t)
-    f = np.zeros(n_t); ftilde = np.zeros(n_t)
-    v = np.zeros(n_t); vtilde = np.zeros(n_t)
-    q = np.zeros(n_t); qtilde = np.zeros(n_t)
+    # Euler method, in the precision of the input neural activity
+    s = np.zeros(n_t, dtype=x.dtype); #stilde = np.zeros(n_t)
+    f = np.zeros(n_t, dtype=x.dtype); ftilde = np.zeros(n_t, dtype=x.dtype)
+    v = np.zeros(n_t, dtype=x.dtype); vtilde = np.zeros(n_t, dtype=x.dtype)
+    q = np.zeros(n_t, dtype=x.dtype); qtilde = np.zeros(n_t, dtype=x.dtype)
     # Initial conditions x0 = np.array([0, 1, 1, 1]) <- they should have been all 0...
     s[0] = 1; f[0]=1; v[0]=1; q[0]=1
     ftilde[0]=0; vtilde[0]=0; qtilde[0]=0; # stilde[0] = 0
@@ -155,6 +157,61 @@ def BOLDModel(T, x):
     vv[isclose(vv, 0.)] = 1e-8
     b = vo * (k1 * (1 - qq) + k2 * (1 - qq / vv) + k3 * (1 - vv))  # Equation (12) in Stephan et al. 2007
 
-    return b
+    return b.astype(x.dtype)
 
 
+# --------------------------------------------------------------------------
+# All regions at once, TR-sampled output
+# --------------------------------------------------------------------------
+# The same integration as BOLDModel, for all the columns (regions, or trials*regions) of the neural activity
+# x (n_t, N) together, on an (N,) state, and storing only the samples the pipeline keeps, i.e., the BOLD
+# signal at the time points n_min + step-1, n_min + 2*step-1, ... (as BOLD[step-1::step] with the output of
+# BOLDModel). So, instead of the eight (n_t,) arrays per region of BOLDModel, we only need O(N) for the
+# state plus the (n_t/step, N) result, in a single compiled call. The state is kept in the precision of x,
+# exactly as in BOLDModel, so both give the same values. The same steps are used by the integrators to
+# compute the BOLD signal online (see WholeBrain.Utils.BOLD.onlineBOLD, which does the stepping and sampling).
+
+
+# The state, as a (7, M) array: s, f, ftilde, v, vtilde, q, qtilde, with s = f = v = q = 1 (see BOLDModel)
+def initOnlineState(M, dtype=precision.floatType):
+    state = np.zeros((7, M), dtype=dtype)
+    state[0] = 1.; state[1] = 1.; state[3] = 1.; state[5] = 1.
+    return state
+
+
+@jit(nopython=True)
+def stepAllRegions(state, x, dt):
+    s = state[0]; f = state[1]; ftilde = state[2]; v = state[3]; vtilde = state[4]; q = state[5]; qtilde = state[6]
+    ialpha = 1 / alpha
+    for i in range(x.shape[0]):  # one Euler step, see BOLDModel for the equations (and the order of the clamping of f)
+        sNew = s[i] + dt * (x[i] - kappa * s[i] - gamma * (f[i] - 1))
+        if f[i] < 1:
+            f[i] = 1.
+        fv = v[i]**ialpha
+        ff = (1-(1-Eo)**(1/f[i]))/Eo
+        ftilde[i] = ftilde[i] + dt * (s[i]/f[i])
+        vtilde[i] = vtilde[i] + dt * ((f[i]-fv)/(tau*v[i]))
+        qtilde[i] = qtilde[i] + dt * ((f[i] * ff - fv * q[i]/v[i])/(tau*q[i]))
+        s[i] = sNew
+        f[i] = np.exp(ftilde[i])
+        v[i] = np.exp(vtilde[i])
+        q[i] = np.exp(qtilde[i])
+
+
+@jit(nopython=True)
+def signalAllRegions(state, out):  # Equation (12) in [Stephan2007], as in BOLDModel
+    v = state[3]; q = state[5]
+    k1 = 4.3*theta0*Eo*TE; k2 = epsilon*r0*Eo*TE; k3 = 1-epsilon
+    for i in range(out.shape[0]):
+        vv = v[i]
+        if isclose(vv, 0.):
+            vv = 1e-8
+        out[i] = vo * (k1 * (1 - q[i]) + k2 * (1 - q[i] / vv) + k3 * (1 - vv))
+
+
+# T: total time (s), x: the neural activity of all the regions (n_t, N), step: TR / dt
+def BOLDModelAllRegions(T, x, step):
+    return onlineBOLD.allRegions(T, x, step, dt, t_min, initOnlineState(x.shape[1], x.dtype), stepAllRegions, signalAllRegions)
+# ==========================================================================
+# ==========================================================================
+# ==========================================================================EOF
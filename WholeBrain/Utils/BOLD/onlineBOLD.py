@@ -0,0 +1,160 @@
+# --------------------------------------------------------------------------
+# --------------------------------------------------------------------------
+# Online BOLD: the hemodynamic model fused into the neural integration
+#
+# Instead of recording the whole neural activity (at 1 kHz) and running the BOLD model over it afterwards
+# (simulate_SimAndBOLD.computeSubjectBOLD), the integrators can advance the hemodynamic state along with
+# the neural one: each time a sample of the recorded observation var is ready (every ds of neural time, see
+# the integrators' recordingSpec), we take one BOLD step with it and, every TR, store the BOLD signal. So,
+# the neural history is never materialised: the memory needed is the hemodynamic state, O(vars*N), plus
+# the TR-sampled result, and there is no second pass over the data.
+#
+# The BOLD models that support it (BOLDHemModel_Stephan2008, BOLDHemModel_Stephan2007,
+# BOLDHemModel_Friston2003) only provide their equations:
+#   * initOnlineState(M, dtype): their state for M regions (trials*N), as a (vars, M) array,
+#   * stepAllRegions(state, x, dt): one Euler step of all the regions with the input x (M,), in place,
+#   * signalAllRegions(state, out): the BOLD signal of the current state, into out (M,),
+# and this module does the rest, passing those two kernels to the compiled code as first-class functions
+# (as the integrators do with the models' dfun):
+#   * the TR sampling (numTRSamples, initCounters, sampleDue, stepDue) and advance, one BOLD time point,
+#   * allRegions: the offline BOLD signal of all the regions at TR resolution (their BOLDModelAllRegions),
+#   * recordOnline: the recorder the integrators call, i.e., accumulateInput + advance.
+# The BOLD steps and samples are the same in both cases, so the results are the same as recording the
+# neural activity and computing the BOLD signal afterwards.
+#
+# Use it with
+#     import WholeBrain.Utils.BOLD.onlineBOLD as onlineBOLD
+#     onlineBOLD.BOLDModel = Stephan2008; onlineBOLD.TR = 2.
+#     integrator.onlineBOLD = onlineBOLD
+# and then integrator.simulate (or warmUpAndSimulate) returns the BOLD signal, (samples, [trials,] N), or
+# with simulate_SimAndBOLD.onlineBOLD = onlineBOLD (the module) and simulate_SimAndBOLD.computeOnlineBOLD.
+# As offline, each recorded sample is one BOLD step of dtt, so the integrator must record every
+# ds = dtt*1000 ms (initRecording checks it).
+# --------------------------------------------------------------------------
+# --------------------------------------------------------------------------
+import numpy as np
+from numba import jit
+import WholeBrain.Utils.jitCache as jitCache
+from WholeBrain.Utils import precision
+
+BOLDModel = None  # import WholeBrain.Utils.BOLD.BOLDHemModel_Stephan2008 as Stephan2008
+TR = 2.           # sampling period of the BOLD signal (s)
+dtt = 1e-3        # BOLD integration step (s): one step per recorded neural sample, i.e., per ds = 1 ms
+
+
+# --------------------------------------------------------------------------
+# TR sampling, as in the offline pipeline: of the n_t BOLD time points, we keep n_min + step-1,
+# n_min + 2*step-1, ... (i.e., BOLD[step-1::step] of the signal from t_min on), with step = TR / dt
+# --------------------------------------------------------------------------
+def numTRSamples(n_t, n_min, step):
+    return max(0, (n_t - n_min - step) // step + 1)
+
+
+# counters = [BOLD steps done, samples stored, n_t, n_min, TR step, number of samples]
+def initCounters(n_t, n_min, step):
+    return np.array([0, 0, n_t, n_min, step, numTRSamples(n_t, n_min, step)], dtype=np.int64)
+
+
+@jit(nopython=True)
+def sampleDue(counters):  # the state after counters[0] steps is at n_min + step-1, n_min + 2*step-1, ...
+    return counters[1] < counters[5] and counters[0] == counters[3] + counters[4] - 1 + counters[1] * counters[4]
+
+
+@jit(nopython=True)
+def stepDue(counters):  # as in the offline models, n_t-1 steps at most
+    return counters[0] < counters[2] - 1
+
+
+# One BOLD time point: store the signal of the current state, if sampleDue, and then step it with x, if
+# stepDue. stepAllRegions and signalAllRegions are the BOLD model's kernels.
+@jit(nopython=True)
+def advance(stepAllRegions, signalAllRegions, state, x, out, counters, dt):
+    if sampleDue(counters):
+        signalAllRegions(state, out[counters[1]])
+        counters[1] += 1
+    if stepDue(counters):
+        stepAllRegions(state, x, dt)
+        counters[0] += 1
+
+
+# --------------------------------------------------------------------------
+# Offline: all the regions at once, TR-sampled output
+# --------------------------------------------------------------------------
+@jit(nopython=True)
+def integrateAllRegions(stepAllRegions, signalAllRegions, x, state, out, counters, dt):
+    for n in range(counters[2]):
+        advance(stepAllRegions, signalAllRegions, state, x[min(n, x.shape[0]-1)], out, counters, dt)
+    return out
+
+
+# The BOLD signal of all the columns (regions, or trials*regions) of the neural activity x (n_t, N) together,
+# at the TR samples, for the BOLD model with time step dt and t_min, its initial state (vars, N) and kernels.
+# T: total time (s), step: TR / dt
+def allRegions(T, x, step, dt, t_min, state, stepAllRegions, signalAllRegions):
+    counters = initCounters(int(T/dt), int(np.round(t_min / dt)), step)
+    return integrateAllRegions(stepAllRegions, signalAllRegions, x, state,
+                               np.empty((counters[5], x.shape[1]), dtype=x.dtype), counters, dt)
+
+
+# --------------------------------------------------------------------------
+# Online: the recording passed to the integrators instead of the observation vars array
+# --------------------------------------------------------------------------
+#   (state (vars, M), input x (M,), out (samples, M), counters, dt, stepAllRegions, signalAllRegions)
+# with the counters computed as in the offline pipeline for numRecorded neural samples, recorded every ds ms.
+def initRecording(shape, numRecorded, ds):
+    if not np.isclose(ds * 1e-3, dtt):
+        raise ValueError(f"onlineBOLD takes one BOLD step of dtt={dtt}s per recorded sample, but the integrator records every ds={ds}ms")
+    BOLDModel.dt = dtt
+    M = int(np.prod(shape))
+    T = np.round(numRecorded * dtt)
+    counters = initCounters(int(T/dtt), int(np.round(BOLDModel.t_min / dtt)), int(np.round(TR/dtt)))
+    state = BOLDModel.initOnlineState(M)
+    return (state, np.zeros(M, dtype=state.dtype), np.zeros((counters[5], M), dtype=precision.floatType), counters, dtt,
+            BOLDModel.stepAllRegions, BOLDModel.signalAllRegions)
+
+
+def recorder():
+    jitCache.cacheFunctions(BOLDModel)  # before anything gets compiled
+    return recordOnline
+
+
+# The BOLD signal recorded so far, (samples,) + shape
+def result(recording, shape):
+    state = recording[0]; out = recording[2]; counters = recording[3]
+    if sampleDue(counters):  # the last state, if it is a sample point
+        BOLDModel.signalAllRegions(state, out[counters[1]])
+        counters[1] += 1
+    return out[:counters[1]].reshape((-1,) + tuple(shape))
+
+
+# Takes the recorded observation var (the first one in obsIdx) at the integration step n into x. Returns
+# True once x holds the input for the next BOLD step: the sample at n % stride == 0 or, with meanReduction,
+# the mean over the stride steps of the window.
+@jit(nopython=True)
+def accumulateInput(n, obsVars, x, stride, obsIdx, meanReduction):
+    obs = obsVars.reshape((-1, obsVars.shape[-2], obsVars.shape[-1]))
+    N = obs.shape[2]
+    if meanReduction:
+        if n % stride == 0:
+            x[:] = 0.
+        for bb in range(obs.shape[0]):
+            for i in range(N):
+                x[bb * N + i] += obs[bb, obsIdx[0], i] / stride
+        return n % stride == stride - 1
+    if n % stride != 0:
+        return False
+    for bb in range(obs.shape[0]):
+        for i in range(N):
+            x[bb * N + i] = obs[bb, obsIdx[0], i]
+    return True
+
+
+# The recorder for the integrators, in place of their recordBookkeeping
+@jit(nopython=True)
+def recordOnline(n, obsVars, recording, stride, obsIdx, meanReduction):
+    if accumulateInput(n, obsVars, recording[1], stride, obsIdx, meanReduction):
+        advance(recording[5], recording[6], recording[0], recording[1], recording[2], recording[3], recording[4])
+    return recording
+# ==========================================================================
+# ==========================================================================
+# ==========================================================================EOF
@@ -153,8 +153,7 @@ def JOptim(N, warmUp = False):
     for k in range(1000):  # 5000 trials
         # integrator.resetBookkeeping()
         Tmaxneuronal = int((tmax+dt))  # (tmax+dt)/dt, but with steps of 1 unit...
-        integrator.neuronalModel.setParms({'J': currJ})
-        recompileSignatures()
+        integrator.neuronalModel.setParms({'J': currJ})  # passed at run time, no need to recompile
         if warmUp:
             curr_xn = integrator.warmUpAndSimulate(dt, Tmaxneuronal)[:,0,:]  # take the xn component of the observation variables...
         else:
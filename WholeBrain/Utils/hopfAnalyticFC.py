@@ -0,0 +1,205 @@
+# --------------------------------------------------------------------------
+# --------------------------------------------------------------------------
+# Analytic FC for the supercritical Hopf model (WholeBrain.Models.supHopf) in the linear-noise regime
+#
+# Below the bifurcation (a < 0), the noisy supHopf network fluctuates around its fixed point z = (x, y) = 0,
+# and the linearised system
+#     dz = A z dt + sigma dW,    A = [[diag(a) + G*L, -diag(omega)], [diag(omega), diag(a) + G*L]]
+# with L = SC^T - diag(ink) (the coupling of supHopf.dfun), has a stationary covariance C that solves the
+# continuous Lyapunov equation
+#     A C + C A^T + sigma^2 I = 0
+# and lagged covariances C(tau) = <z(t+tau) z(t)^T> = expm(A tau) C. The FC is the correlation matrix
+# of the x block of C [Deco_2017]. So, instead of minutes of stochastic simulation per parameter point,
+# we get the FC with one linear solve.
+#
+# When a and omega are the same for all nodes (the usual case in a G sweep), A is a*I plus G*L acting
+# on the two blocks plus a rotation of omega, so if L = U diag(d) U^-1, then
+#     C_xx = -sigma^2 U (P / (2a + G (d_i + conj(d_j)))) U^H,   P = U^-1 U^-H,   C_xy = 0
+# (independent of omega), and C_xx(tau) = exp(a tau) cos(omega tau) U exp(G diag(d) tau) U^-1 C_xx.
+# L is factorized once and each G value costs two matrix products (sweepFC). For heterogeneous a or
+# omega, we use scipy's Bartels-Stewart solver on A.
+#
+# [Deco_2017] G. Deco, M.L. Kringelbach, V.K. Jirsa, P. Ritter, The dynamics of resting fluctuations in the
+#             brain: metastability and its dynamical cortical core, Sci. Rep. 7 (2017), 3095
+# --------------------------------------------------------------------------
+# --------------------------------------------------------------------------
+import numpy as np
+from scipy import linalg
+import WholeBrain.Models.supHopf as Hopf
+
+verbose = True
+sigma = 0.01  # noise amplitude, as the integrators' sigma
+
+
+def couplingMatrix():  # L = SC^T - diag(ink), as in supHopf.dfun
+    SC = np.asarray(Hopf.SC.todense()) if hasattr(Hopf.SC, 'todense') else np.asarray(Hopf.SC, dtype=np.float64)
+    L = SC.T.copy()
+    if Hopf.conservative:
+        L -= np.diag(SC.T.sum(axis=1))
+    return L
+
+
+def nodeParms(N):
+    return np.broadcast_to(np.asarray(Hopf.a, dtype=np.float64), (N,)), np.broadcast_to(np.asarray(Hopf.omega, dtype=np.float64), (N,))
+
+
+def isHomogeneous(a, omega):
+    return np.all(a == a[0]) and np.all(omega == omega[0])
+
+
+def linearSystem(G=None):  # the Jacobian A at z = 0, (2N, 2N)
+    L = couplingMatrix()
+    N = L.shape[0]
+    a, omega = nodeParms(N)
+    G = Hopf.G if G is None else G
+    diagonal = np.diag(a) + G * L
+    return np.block([[diagonal, -np.diag(omega)], [np.diag(omega), diagonal]])
+
+
+def correlation(C):
+    std = np.sqrt(np.diag(C))
+    return C / np.outer(std, std)
+
+
+def unstable(N, G):
+    if verbose:
+        print(f"Hopf analytic FC: the linearised system is unstable at G={G}, there is no stationary covariance")
+    return np.full((N, N), np.nan)
+
+
+# --------------------------------------------------------------------------
+# Spectral factorization of L, shared by all G values (homogeneous a and omega)
+# --------------------------------------------------------------------------
+class CouplingFactorization:
+    def __init__(self, L):
+        if np.allclose(L, L.T):
+            self.d, self.U = np.linalg.eigh(L)
+            self.Uinv = self.U.T
+            self.P = None  # the identity
+        else:
+            self.d, self.U = np.linalg.eig(L)
+            self.Uinv = np.linalg.inv(self.U)
+            self.P = self.Uinv @ self.Uinv.conj().T
+
+    def covarianceXX(self, a, G, sig):
+        if np.max(a + G * self.d.real) >= 0.:
+            return None
+        if self.P is None:  # symmetric L: diagonal in the eigenbasis
+            return (self.U * (-sig**2 / (2. * a + 2. * G * self.d))) @ self.U.T
+        denominator = 2. * a + G * (self.d[:, np.newaxis] + self.d.conj()[np.newaxis, :])
+        return ((self.U @ (-sig**2 * self.P / denominator)) @ self.U.conj().T).real
+
+    def laggedXX(self, Cxx, a, omega, G, tau):
+        propagator = ((self.U * np.exp(G * self.d * tau)) @ self.Uinv).real
+        return np.exp(a * tau) * np.cos(omega * tau) * (propagator @ Cxx)
+
+
+# --------------------------------------------------------------------------
+# Main entry points
+# --------------------------------------------------------------------------
+# Stationary covariance of the x (and y) variables, (N, N), for the current supHopf parameters
+# (or the given G). NaNs if the fixed point is not stable.
+def covariance(G=None, factorization=None):
+    G = Hopf.G if G is None else G
+    L = couplingMatrix()
+    N = L.shape[0]
+    a, omega = nodeParms(N)
+    if isHomogeneous(a, omega):
+        factorization = CouplingFactorization(L) if factorization is None else factorization
+        Cxx = factorization.covarianceXX(a[0], G, sigma)
+        return unstable(N, G) if Cxx is None else Cxx
+    A = linearSystem(G)
+    if np.max(np.linalg.eigvals(A).real) >= 0.:
+        return unstable(N, G)
+    return linalg.solve_continuous_lyapunov(A, -sigma**2 * np.eye(2 * N))[:N, :N]
+
+
+def FC(G=None):
+    return correlation(covariance(G))
+
+
+# Lagged covariances <x(t+tau) x(t)^T>, (len(taus), N, N), in the time units of the model
+def laggedCovariances(taus, G=None):
+    G = Hopf.G if G is None else G
+    L = couplingMatrix()
+    N = L.shape[0]
+    a, omega = nodeParms(N)
+    if isHomogeneous(a, omega):
+        factorization = CouplingFactorization(L)
+        Cxx = factorization.covarianceXX(a[0], G, sigma)
+        if Cxx is None:
+            return np.stack([unstable(N, G) for tau in taus])
+        return np.stack([factorization.laggedXX(Cxx, a[0], omega[0], G, tau) for tau in taus])
+    A = linearSystem(G)
+    if np.max(np.linalg.eigvals(A).real) >= 0.:
+        return np.stack([unstable(N, G) for tau in taus])
+    C = linalg.solve_continuous_lyapunov(A, -sigma**2 * np.eye(2 * N))
+    return np.stack([(linalg.expm(A * tau) @ C)[:N, :N] for tau in taus])
+
+
+# FC for each of the G values, (len(Gs), N, N). With homogeneous a and omega, L is factorized only once.
+def sweepFC(Gs):
+    L = couplingMatrix()
+    N = L.shape[0]
+    a, omega = nodeParms(N)
+    factorization = CouplingFactorization(L) if isHomogeneous(a, omega) else None
+    result = np.empty((len(Gs), N, N))
+    for pos, G in enumerate(Gs):
+        result[pos] = correlation(covariance(G, factorization) if factorization is not None else covariance(G))
+    return result
+
+
+# ======================================================================
+# Test code: the spectral solution vs. scipy's Lyapunov solver and vs. the FC of a (long) stochastic
+# simulation, plus the timing of a G sweep
+# ======================================================================
+if __name__ == '__main__':
+    import time
+    import WholeBrain.Utils.hopfAnalyticFC as analytic  # the module we configure (not __main__)
+    import WholeBrain.Integrators.HeunStochastic as integrator
+    analytic.verbose = False
+    rng = np.random.default_rng(42)
+    N = 80
+    SC = rng.random((N, N)) * (rng.random((N, N)) < 0.1); SC = (SC + SC.T) * 0.5  # sparse, so the FC has some structure
+    Hopf.setParms({'SC': SC, 'we': 0.5, 'a': -0.05 * np.ones(N), 'omega': 0.3 * np.ones(N)})
+    analytic.sigma = 0.02
+    iu = np.triu_indices(N, 1)
+
+    A = analytic.linearSystem()
+    exact = linalg.solve_continuous_lyapunov(A, -analytic.sigma**2 * np.eye(2 * N))
+    print(f"spectral vs. Bartels-Stewart covariance: max diff={np.max(np.abs(analytic.covariance() - exact[:N, :N])):.2e}")
+    Hopf.SC = SC * (1. + 0.2 * rng.random((N, N)))  # non-symmetric SC
+    exact = linalg.solve_continuous_lyapunov(analytic.linearSystem(), -analytic.sigma**2 * np.eye(2 * N))
+    print(f"   (non-symmetric SC): max diff={np.max(np.abs(analytic.covariance() - exact[:N, :N])):.2e}")
+    tau = 3.
+    lagged = linalg.expm(analytic.linearSystem() * tau) @ exact
+    print(f"   lagged covariance (tau={tau}): max diff={np.max(np.abs(analytic.laggedCovariances([tau])[0] - lagged[:N, :N])):.2e}")
+    Hopf.setParms({'SC': SC})
+
+    integrator.neuronalModel = Hopf
+    integrator.verbose = False
+    integrator.sigma = analytic.sigma
+    dt = 0.1; T = 200000.
+    integrator.ds = 1.
+    integrator.seedNoise(1)
+    t0 = time.perf_counter()
+    x = integrator.simulate(dt, T)[1000:, 0, :]
+    tSim = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    fc = analytic.FC()
+    tFC = time.perf_counter() - t0
+    print(f"simulated ({tSim:.1f}s) vs. analytic ({tFC * 1e3:.1f}ms) FC: "
+          f"correlation={np.corrcoef(np.corrcoef(x.T)[iu], fc[iu])[0, 1]:.4f}, max diff={np.max(np.abs(np.corrcoef(x.T) - fc)):.3f}")
+
+    Gs = np.linspace(0., 4., 101)
+    t0 = time.perf_counter()
+    fcs = analytic.sweepFC(Gs)
+    tSweep = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for G in Gs:
+        linalg.solve_continuous_lyapunov(analytic.linearSystem(G), -analytic.sigma**2 * np.eye(2 * N))
+    tLyap = time.perf_counter() - t0
+    print(f"sweep of {len(Gs)} G values: {tSweep:.3f}s with the shared factorization, {tLyap:.3f}s solving each one")
+# ======================================================================
+# ======================================================================
+# ======================================================================EOF
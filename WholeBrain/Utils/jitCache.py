@@ -0,0 +1,356 @@
+# --------------------------------------------------------------------------
+# --------------------------------------------------------------------------
+# Disk-persisted compilation cache for the numba kernels of the models and the integrators
+#
+# Without it, every new process (a new run, each worker of a process pool, ...) compiles all the
+# @jit kernels again, which takes tens of seconds before the first simulated step. numba's own
+# cache=True does not work for us: the integrators receive the model's dfun as an argument, and
+# numba never finds those kernels in its cache from another process. Besides, it does not know about the
+# module globals numba freezes at compile time (e.g., HeunStochastic.clamping or the DMF constants),
+# so it would happily load a kernel compiled with other settings.
+#
+# So, each compiled kernel is stored under a key made of:
+#   * its signature, where the jitted functions received as arguments (e.g., the model's dfun) are
+#     described by name instead of by object identity,
+#   * the hash of the source files of the kernel, of all the jitted functions it calls or receives,
+#     and of the modules these come from (i.e., the model and integrator source),
+#   * the values of the module globals all these functions read (i.e., the parameter layout frozen
+#     at compile time).
+# Any change to the sources or to the settings gives a new key, and thus a new compilation, while
+# going back to a previous configuration (e.g., clamping on and off) finds it again on disk.
+#
+# The integrators call cacheFunctions on their own kernels and on the model ones. The cache is off by
+# default, because it is built on numba's (private) caching classes: set enabled = True (or
+# WHOLEBRAIN_JIT_CACHE=1 in the environment, which worker processes inherit) to use it. It is only
+# available (cacheSupported) with the numba versions it was checked against (numbaVersions) and, even
+# then, only if those classes have what we use: otherwise, everything is compiled as usual, so a numba
+# upgrade disables the cache instead of breaking the imports. The cache goes to cacheDir
+# (WHOLEBRAIN_JIT_CACHE_DIR), or to numba's default location (NUMBA_CACHE_DIR, or the __pycache__
+# folders) if it is None. Each function keeps its maxEntries most recent kernels: older ones (e.g.,
+# compiled from a previous version of the sources) are dropped from the index, together with their files.
+#
+# Run python -m WholeBrain.Utils.jitCache to compare the cold and warm start-up times.
+# --------------------------------------------------------------------------
+# --------------------------------------------------------------------------
+import os
+import io
+import sys
+import types
+import pickle
+import hashlib
+import inspect
+import functools
+import numpy as np
+import numba
+from numba.core.registry import CPUDispatcher
+from numba.np.ufunc.dufunc import DUFunc
+
+numbaVersions = ((0, 68), (0, 69))  # [first, last) numba versions whose caching classes this was checked against
+try:
+    from numba.core import serialize
+    from numba.core.caching import FunctionCache, CompileResultCacheImpl, IndexDataCacheFile, UserProvidedCacheLocator
+    cacheSupported = (numbaVersions[0] <= tuple(int(v) for v in numba.__version__.split('.')[:2]) < numbaVersions[1]
+                      and all(hasattr(IndexDataCacheFile, attr) for attr in ('save', '_load_index', '_save_index', '_data_path'))
+                      and hasattr(CompileResultCacheImpl, '_locator_classes') and hasattr(serialize, 'NumbaPickler'))
+except (ImportError, AttributeError, ValueError):  # numba's internals changed: no disk cache, just compile
+    cacheSupported = False
+
+enabled = os.environ.get('WHOLEBRAIN_JIT_CACHE', '0') == '1'
+cacheDir = os.environ.get('WHOLEBRAIN_JIT_CACHE_DIR')
+maxEntries = 32  # cached kernels kept per function
+
+dispatchers = {}  # name -> dispatcher, to restore the jitted functions referenced by the cached kernels
+
+
+def dispatcherName(dispatcher):
+    parallel = '[parallel]' if dispatcher.targetoptions.get('parallel') else ''
+    return f"{dispatcher.py_func.__module__}.{dispatcher.py_func.__qualname__}{parallel}"
+
+
+# Attaches the disk cache to all the jitted functions in namespace (a module's globals(), a model
+# module, ...). It has to be called before they are compiled; calling it again does nothing.
+def cacheFunctions(namespace):
+    if not isinstance(namespace, dict):
+        namespace = vars(namespace)
+    for value in list(namespace.values()):
+        if isinstance(value, CPUDispatcher):
+            cacheFunction(value)
+
+
+def cacheFunction(dispatcher):
+    if not (enabled and cacheSupported):
+        return dispatcher
+    dispatchers.setdefault(dispatcherName(dispatcher), dispatcher)
+    if not isinstance(getattr(dispatcher, '_cache', None), SettingsCache):
+        try:
+            dispatcher._cache = SettingsCache(dispatcher.py_func)
+        except (RuntimeError, AttributeError):  # no place to write the cache for this function (or a numba
+            pass                                # we do not know how to hook into): it will just be compiled
+    return dispatcher
+
+
+cacheFileTypes = ('.nbi', '.nbc')  # numba's index and data files
+
+
+# Whether folder only holds numba cache files (or nothing at all)
+def isCacheFolder(folder):
+    return all(name.endswith(cacheFileTypes) for _, _, names in os.walk(folder) for name in names)
+
+
+# Deletes the cache files in cacheDir, and nothing else
+def clear():
+    if cacheDir is None:
+        return
+    for root, _, names in os.walk(cacheDir):
+        for name in names:
+            if name.endswith(cacheFileTypes):
+                os.unlink(os.path.join(root, name))
+
+
+# --------------------------------------------------------------------------
+# Cache keys
+# --------------------------------------------------------------------------
+@functools.lru_cache(maxsize=None)
+def hashFile(path, mtime, size):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def sourceStamp(obj):
+    try:
+        path = inspect.getsourcefile(obj)
+        st = os.stat(path)
+    except (TypeError, OSError):
+        return None
+    return f"{path}:{hashFile(path, st.st_mtime, st.st_size)}"
+
+
+def codeNames(code):
+    names = set(code.co_names) | set(code.co_freevars)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= codeNames(const)
+    return names
+
+
+def valueStamp(value):  # a stable description of a value numba can freeze, or None for anything else
+    if value is None or isinstance(value, (bool, int, float, complex, str, bytes, np.generic, np.dtype, type)):
+        return repr(value)
+    if isinstance(value, tuple):
+        stamps = [valueStamp(v) for v in value]
+        return None if None in stamps else '(' + ','.join(stamps) + ')'
+    if isinstance(value, np.ndarray):
+        return f"array{value.shape}{value.dtype}:{hashlib.sha256(np.ascontiguousarray(value).tobytes()).hexdigest()}"
+    return None
+
+
+def isOurs(func):  # plain Python functions we follow: the ones in this package (e.g., @overload'ed helpers)
+    return getattr(func, '__module__', '') is not None and getattr(func, '__module__', '').split('.')[0] == __name__.split('.')[0]
+
+
+def collectStamps(func, stamps, seen):
+    if func in seen:
+        return
+    seen.add(func)
+    stamps.add(sourceStamp(func))
+    names = codeNames(func.__code__)
+    scope = dict(func.__globals__)
+    if func.__closure__ is not None:
+        scope.update(zip(func.__code__.co_freevars, [c.cell_contents for c in func.__closure__]))
+    for name in names:
+        if name in scope:
+            collectValueStamps(name, scope[name], names, stamps, seen)
+
+
+def collectValueStamps(name, value, names, stamps, seen):
+    if isinstance(value, CPUDispatcher):
+        stamps.add(dispatcherName(value))
+        collectStamps(value.py_func, stamps, seen)
+    elif isinstance(value, DUFunc):  # @vectorize'd functions (e.g., transferFunctions.rate)
+        stamps.add(f"{name}=ufunc:{value.__name__}")
+        collectStamps(value._dispatcher.py_func, stamps, seen)
+    elif isinstance(value, types.FunctionType):
+        if isOurs(value):
+            collectStamps(value, stamps, seen)
+    elif isinstance(value, types.ModuleType):
+        if isOurs(value):
+            stamps.add(sourceStamp(value))  # also covers the @overload implementations in the module
+        for attr in names:
+            if attr in vars(value) and (value, attr) not in seen:
+                seen.add((value, attr))
+                collectValueStamps(f"{value.__name__}.{attr}", vars(value)[attr], names, stamps, seen)
+    else:
+        stamp = valueStamp(value)
+        if stamp is not None:
+            stamps.add(f"{name}={stamp}")
+
+
+def typeStamp(numbaType, stamps, seen):
+    from numba.core import types as nbtypes
+    if isinstance(numbaType, nbtypes.Dispatcher):
+        dispatcher = numbaType.dispatcher
+        collectStamps(dispatcher.py_func, stamps, seen)
+        return f"dispatcher({dispatcherName(dispatcher)})"
+    if isinstance(numbaType, nbtypes.BaseTuple):
+        return '(' + ','.join(typeStamp(t, stamps, seen) for t in numbaType.types) + ')'
+    return str(numbaType)
+
+
+def settingsKey(py_func, sig):
+    stamps = set(); seen = set()
+    collectStamps(py_func, stamps, seen)
+    sigStamp = ','.join(typeStamp(t, stamps, seen) for t in sig)
+    stamps.discard(None)
+    return sigStamp, hashlib.sha256('\n'.join(sorted(stamps)).encode()).hexdigest()
+
+
+# --------------------------------------------------------------------------
+# numba cache classes
+# --------------------------------------------------------------------------
+if cacheSupported:
+    class Pickler(serialize.NumbaPickler):  # jitted functions are stored by name, and restored to the live ones
+        def persistent_id(self, obj):
+            if isinstance(obj, CPUDispatcher):
+                name = dispatcherName(obj)
+                if dispatchers.get(name) is not obj:
+                    raise pickle.PicklingError(f"{name} is not a cached function")
+                return name
+            return None
+
+
+    class Unpickler(pickle.Unpickler):
+        def persistent_load(self, name):
+            if name not in dispatchers:  # e.g., a model not registered yet in this process
+                module, _, qualname = name.replace('[parallel]', '').rpartition('.')
+                __import__(module)
+                cacheFunctions(sys.modules[module])
+            return dispatchers[name]
+
+
+    class CacheFile(IndexDataCacheFile):
+        def flush(self):  # numba drops the whole index when recompiling, but our keys tell settings apart
+            self.prune()
+
+        def save(self, key, data):
+            super().save(key, data)
+            self.prune()
+
+        # Drops the entries whose data file is gone and all but the maxEntries most recent ones
+        def prune(self):
+            overloads = self._load_index()
+            live = {key: name for key, name in overloads.items() if os.path.exists(self._data_path(name))}
+            for key in list(live)[:max(len(live) - maxEntries, 0)]:
+                try:
+                    os.unlink(self._data_path(live.pop(key)))
+                except OSError:
+                    pass
+            if len(live) != len(overloads):
+                self._save_index(live)
+
+        def _dump(self, obj):
+            with io.BytesIO() as buf:
+                Pickler(buf, protocol=4).dump(obj)
+                return buf.getvalue()
+
+        def _load_data(self, name):
+            with open(self._data_path(name), 'rb') as f:
+                return Unpickler(f).load()
+
+
+    class CacheLocator(UserProvidedCacheLocator):
+        def __init__(self, py_func, py_file):
+            super().__init__(py_func, py_file)
+            self._cache_path = os.path.join(cacheDir, self.get_suitable_cache_subpath(py_file))
+
+        @classmethod
+        def from_function(cls, py_func, py_file):
+            if cacheDir is None:
+                return
+            return super(UserProvidedCacheLocator, cls).from_function(py_func, py_file)
+
+
+    class CacheImpl(CompileResultCacheImpl):
+        _locator_classes = [CacheLocator] + CompileResultCacheImpl._locator_classes
+
+
+    class SettingsCache(FunctionCache):
+        _impl_class = CacheImpl
+
+        def __init__(self, py_func):
+            super().__init__(py_func)
+            self._cache_file = CacheFile(cache_path=self._cache_path, filename_base=self._impl.filename_base,
+                                         source_stamp=self._impl.locator.get_source_stamp())
+
+        def _index_key(self, sig, codegen):
+            return settingsKey(self._py_func, sig) + (codegen.magic_tuple(),)
+
+        def load_overload(self, sig, target_context):
+            if not enabled:
+                return None
+            try:
+                return super().load_overload(sig, target_context)
+            except Exception:  # unreadable or outdated entry: just compile it
+                return None
+
+        def save_overload(self, sig, data):
+            if not enabled:
+                return
+            try:
+                super().save_overload(sig, data)
+            except Exception:  # e.g., the kernel receives a function we cannot store: it will be compiled next time
+                pass
+
+
+# ======================================================================
+# Start-up benchmark: runs a short simulation in a fresh process with an empty cache (cold), and then
+# again in another fresh process (warm), and reports the time to the first simulated result.
+#   python -m WholeBrain.Utils.jitCache [--model CC|DMF|Hopf] [--N 80] [--cacheDir dir]
+# ======================================================================
+if __name__ == '__main__':
+    import argparse
+    import subprocess
+    import tempfile
+    import time
+
+    parser = argparse.ArgumentParser(description="Cold vs. warm start-up time with the compilation cache")
+    parser.add_argument('--model', choices=['CC', 'DMF', 'Hopf'], default='CC')
+    parser.add_argument('--N', type=int, default=80)
+    parser.add_argument('--cacheDir', default=None, help="cache folder, emptied first, so it can only hold numba cache "
+                                                         "files (default: a temporary one)")
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        t0 = time.perf_counter()
+        import WholeBrain.Integrators.HeunStochastic as integrator
+        rng = np.random.default_rng(42)
+        SC = rng.random((args.N, args.N)) * 0.2 / args.N
+        if args.model == 'CC':
+            import WholeBrain.Models.Chen_Campbell_Whole_Brain_version as model
+            model.setParms({'SC': SC, 'we': 0.5, 'J': 1.}); dt = 0.001
+        elif args.model == 'DMF':
+            import WholeBrain.Models.DynamicMeanField as model
+            model.setParms({'SC': SC, 'we': 1., 'J': np.ones(args.N)}); dt = 0.1
+        else:
+            import WholeBrain.Models.supHopf as model
+            model.setParms({'SC': SC, 'we': 1., 'a': -0.02 * np.ones(args.N), 'omega': 0.3 * np.ones(args.N)}); dt = 0.1
+        integrator.neuronalModel = model
+        integrator.verbose = False
+        integrator.ds = dt
+        integrator.simulate(dt, 10 * dt)
+        print(f"{time.perf_counter() - t0:.3f}")
+        sys.exit(0)
+
+    if args.cacheDir is not None and not isCacheFolder(args.cacheDir):
+        parser.error(f"{args.cacheDir} holds files that are not a numba cache: use an empty folder (or none)")
+    with tempfile.TemporaryDirectory() as tmp:
+        folder = args.cacheDir or tmp
+        env = dict(os.environ, WHOLEBRAIN_JIT_CACHE='1', WHOLEBRAIN_JIT_CACHE_DIR=folder)
+        cmd = [sys.executable, '-m', 'WholeBrain.Utils.jitCache', '--child', '--model', args.model, '--N', str(args.N)]
+        cacheDir = folder; clear()  # the cache files only (see isCacheFolder)
+        cold = float(subprocess.run(cmd, env=env, capture_output=True, text=True, check=True).stdout.split()[-1])
+        warm = float(subprocess.run(cmd, env=env, capture_output=True, text=True, check=True).stdout.split()[-1])
+        print(f"{args.model} (N={args.N}): cold start-up={cold:7.2f}s   warm start-up={warm:7.2f}s   ({cold / warm:.1f}x)")
+# ======================================================================
+# ======================================================================
+# ======================================================================EOF
@@ -0,0 +1,81 @@
+# --------------------------------------------------------------------------
+# --------------------------------------------------------------------------
+# Counter-based noise streams for the stochastic integrators
+#
+# Each noise value is a pure function of (seed, stream, counter): the stream identifies a trial (or a
+# worker) and the counter is the position of the value inside that stream. Thus, the noise a trial
+# gets does not depend on how many other trials are integrated together with it, nor on how trials
+# are scheduled across threads or processes, and any block of values can be generated on its own.
+#
+# The generator is SplitMix64 [1], whose state is a Weyl sequence, so the k-th output of a stream is
+# computed directly from the stream key and k. Each 64-bit output gives two 32-bit uniforms, which the
+# Box-Muller transform turns into two standard normals (so, tails are truncated at about 6.66 sigma).
+#
+# [1] G.L. Steele, D. Lea, C.H. Flood, Fast splittable pseudorandom number generators,
+#     OOPSLA 2014, pp. 453-472
+# --------------------------------------------------------------------------
+# --------------------------------------------------------------------------
+import numpy as np
+from numba import jit
+
+goldenGamma = np.uint64(0x9e3779b97f4a7c15)
+
+
+@jit(nopython=True)
+def mix64(z):
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return z ^ (z >> np.uint64(31))
+
+
+@jit(nopython=True)
+def computeStreamKeys(seed, streams):
+    keys = np.empty(streams.shape[0], dtype=np.uint64)
+    seedKey = mix64(seed + goldenGamma)
+    for s in range(streams.shape[0]):
+        keys[s] = mix64(seedKey ^ mix64((np.uint64(streams[s]) + np.uint64(1)) * goldenGamma))
+    return keys
+
+
+# One key per stream, from the seed and the stream ids (e.g., the trial indices)
+def streamKeys(seed, streams):
+    return computeStreamKeys(np.uint64(seed), np.asarray(streams, dtype=np.int64))
+
+
+# Fills block, with shape (steps, streams, M), with standard normal values: block[b, s, m] is the m-th
+# value of the integration step firstStep+b in stream s...
+@jit(nopython=True)
+def fillNormals(block, keys, firstStep):
+    steps = block.shape[0]; numStreams = block.shape[1]; M = block.shape[2]
+    pairsPerStep = (M + 1) // 2
+    for s in range(numStreams):
+        for b in range(steps):
+            counter = np.uint64(firstStep + b) * np.uint64(pairsPerStep) + np.uint64(1)
+            for p in range(pairsPerStep):
+                x = mix64(keys[s] + (counter + np.uint64(p)) * goldenGamma)
+                u1 = (np.float64(x >> np.uint64(32)) + 1.) / 4294967296.  # in (0,1]
+                u2 = np.float64(x & np.uint64(0xffffffff)) / 4294967296.  # in [0,1)
+                r = np.sqrt(-2. * np.log(u1))
+                block[b, s, 2*p] = r * np.cos(2. * np.pi * u2)
+                if 2*p + 1 < M:
+                    block[b, s, 2*p+1] = r * np.sin(2. * np.pi * u2)
+    return block
+
+
+# Creates the (pre-allocated) noise block for integrating a state of the given shape, (vars, N) or
+# (trials, vars, N), for numSteps steps, with at most blockSize values per block. Returns the stream
+# keys, the block to be filled with fillNormals and a view of the same memory with one state-shaped
+# noise array per step. With streams = None, trial k uses stream k.
+def initNoiseBlock(seed, streams, shape, numSteps, blockSize, dtype=np.float64):
+    numStreams = int(np.prod(shape[:-2]))
+    M = shape[-2] * shape[-1]
+    if streams is None:
+        streams = np.arange(numStreams)
+    keys = streamKeys(seed, streams)
+    steps = max(min(blockSize // (numStreams * M), numSteps), 1)
+    block = np.empty((steps, numStreams, M), dtype=dtype)
+    return keys, block, block.reshape((steps,) + tuple(shape))
+
+# ======================================================================
+# ======================================================================
+# ======================================================================EOF
@@ -1,5 +1,7 @@
 import numpy as np
-from numba import jit
+from numba import jit, types
+from numba.extending import overload
+from WholeBrain.Utils import precision
 
 @jit(nopython=True)
 def isClose(a, b, rtol=1e-05, atol=1e-08,):
@@ -18,4 +20,34 @@ def isZero(a):
     result = isClose(a, 0.)
     return result
 
+
+# Converts a model parameter to the type used to pass it, at run time, to a compiled kernel: scalars
+# and arrays become values of the pipeline precision (precision.floatType, float64 by default), arrays
+# contiguous. This way, changing the value of a parameter (e.g., from the int 700 to the float 700.2)
+# never triggers a new compilation...
+def toRuntimeParm(value):
+    if np.ndim(value) == 0:
+        return precision.floatType(value)
+    return np.ascontiguousarray(value, dtype=precision.floatType)
+
+
+# Value of a runtime parameter for the batch element (trial or sweep row) b at node i, inside compiled
+# element-wise kernels. The parameter can be a scalar, a per-node (N,) vector, or a per-row (rows, 1)
+# column or (rows, N) matrix, as in the models' setParms.
+def parmAt(p, b, i):
+    if np.ndim(p) == 0:
+        return p
+    if np.ndim(p) == 1:
+        return p[i]
+    return p[b, i % p.shape[1]]
+
+
+@overload(parmAt)
+def parmAtCompiled(p, b, i):
+    if isinstance(p, types.Number):
+        return lambda p, b, i: p
+    if p.ndim == 1:
+        return lambda p, b, i: p[i]
+    return lambda p, b, i: p[b, i % p.shape[1]]
+
 # ======================EOF
@@ -0,0 +1,75 @@
+# --------------------------------------------------------------------------
+# --------------------------------------------------------------------------
+# Opt-in multi-core execution of the model kernels and the integrators
+#
+# For high-resolution networks (N in the hundreds to thousands), each integration step is dominated by
+# the O(N^2) coupling product and the per-node arithmetic. With enabled = True, the integrators use
+# parallel versions of the kernels, which spread the coupling rows and the node updates across numThreads
+# threads (None = all the threads numba has, i.e., NUMBA_NUM_THREADS). Models can provide hand-written
+# parallel kernels (e.g., Chen_Campbell_Whole_Brain_version.dfunInPlaceParallel); otherwise, their dfun is
+# recompiled with parallel=True, so numba parallelizes its array expressions.
+#
+# For small networks (e.g., dbs80), the cost of starting the threads at every step is larger than what
+# we gain, so this is disabled by default. Run python -m WholeBrain.Utils.parallelKernels to get the
+# scaling over N on your machine.
+# --------------------------------------------------------------------------
+# --------------------------------------------------------------------------
+import numba
+from numba import jit
+import WholeBrain.Utils.jitCache as jitCache
+
+enabled = False
+numThreads = None
+
+
+def setNumThreads(n):
+    global numThreads
+    numThreads = n
+    applyNumThreads()
+
+
+def applyNumThreads():  # numba's thread count is per calling thread, so we set it before each run
+    if enabled and numThreads is not None:
+        numba.set_num_threads(numThreads)
+
+
+parallelVersions = {}
+def parallelVersion(f):  # f compiled with parallel=True (compiled only once)
+    if f not in parallelVersions:
+        parallelVersions[f] = jitCache.cacheFunction(jit(nopython=True, parallel=True)(f.py_func))
+    return parallelVersions[f]
+
+
+# ======================================================================
+# Scaling benchmark: ms per integration step of the Chen and Campbell model (HeunStochastic) for
+# increasing N, serial vs parallel, with 1, 2, 4, ... threads.
+# ======================================================================
+if __name__ == '__main__':
+    import time
+    import numpy as np
+    import WholeBrain.Models.Chen_Campbell_Whole_Brain_version as CN
+    import WholeBrain.Integrators.HeunStochastic as integrator
+    import WholeBrain.Utils.parallelKernels as parallelKernels  # the module the integrator sees (not __main__)
+    integrator.neuronalModel = CN
+    integrator.verbose = False
+    integrator.ds = 1.
+    dt = 0.001; steps = 200
+
+    def msPerStep(N, threads):
+        parallelKernels.enabled = threads is not None
+        parallelKernels.setNumThreads(threads)
+        integrator.simulate(dt, 2 * dt)  # compile...
+        t0 = time.perf_counter()
+        integrator.simulate(dt, steps * dt)
+        return (time.perf_counter() - t0) / steps * 1e3
+
+    rng = np.random.default_rng(42)
+    threadCounts = [1 << p for p in range(10) if (1 << p) <= numba.config.NUMBA_NUM_THREADS]
+    for N in [80, 200, 500, 1000, 2000]:
+        CN.setParms({'SC': rng.random((N, N)) * 0.2 / N, 'we': 0.5, 'J': 1.})
+        serial = msPerStep(N, None)
+        timings = "  ".join(f"{th} threads={serial / msPerStep(N, th):5.2f}x" for th in threadCounts)
+        print(f"N={N:5d}: serial={serial:8.3f} ms/step   speedup: {timings}")
+# ======================================================================
+# ======================================================================
+# ======================================================================EOF
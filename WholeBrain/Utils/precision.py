@@ -0,0 +1,92 @@
+# --------------------------------------------------------------------------
+# --------------------------------------------------------------------------
+# Floating point precision of the simulation and analysis pipeline
+#
+# floatType is used by the integrators (states, noise and bookkeeping arrays) and for the model
+# parameters passed to the compiled kernels (see numTricks.toRuntimeParm). The BOLD models and the
+# observables (FC, swFCD) just keep the precision of the signal they get. So, setPrecision(np.float32)
+# halves the memory (and the memory traffic in the SC products and the bookkeeping arrays) of the whole
+# pipeline, for instance for the screening of parameter sweeps. The scalar model constants (and the
+# literals in the compiled dfuns) are kept in double precision, so the element-wise arithmetic of the
+# models is still promoted to float64, while states are stored (and coupled through SC) in the chosen
+# precision. So, float32 halves the memory, but it does not double the SIMD width of the model
+# arithmetic: in the benchmark below (DMF, N=90, 16 trials) the integration time is about the same in
+# both precisions, within the timing noise, while the recorded activity takes half the memory.
+#
+# Use validatePrecision to check how much the fitting values change with respect to float64.
+# --------------------------------------------------------------------------
+# --------------------------------------------------------------------------
+import numpy as np
+
+floatType = np.float64
+
+
+def setPrecision(dtype):
+    global floatType
+    floatType = np.dtype(dtype).type
+
+
+# ==========================================================================
+# Validation harness: simulates the same seeds (same noise streams) in float64 and float32, and reports
+# how much the observables and their fitting values differ.
+#   simulateBOLD: the (already set up) simulate_SimAndBOLD module. Its integrator must have seedNoise.
+#   observables: dict of observable modules, e.g., {'FC': FC, 'swFCD': swFCD}
+#   seeds: one simulated subject per seed
+#   empirical: dict with the (postprocessed) empirical observables to fit, with the same keys as
+#       observables. If None, the float32 results are fitted against the float64 ones.
+# Returns, for each observable, a dict with the fitting values in both precisions, their difference,
+# and the maximum absolute difference between the float32 and float64 (postprocessed) observables.
+# ==========================================================================
+def validatePrecision(simulateBOLD, observables, seeds, empirical=None, applyFilters=True):
+    previousType = floatType
+    processed = {}
+    for dtype in [np.float64, np.float32]:
+        setPrecision(dtype)
+        N = simulateBOLD.integrator.neuronalModel.getParm('SC').shape[0]
+        accum = {name: observables[name].init(len(seeds), N) for name in observables}
+        for nsub, seed in enumerate(seeds):
+            simulateBOLD.integrator.seedNoise(seed)
+            bds = simulateBOLD.simulateSingleSubject().T
+            for name in observables:
+                signal = observables[name].from_fMRI(bds, applyFilters=applyFilters)
+                accum[name] = observables[name].accumulate(accum[name], nsub, signal)
+        processed[dtype] = {name: observables[name].postprocess(accum[name]) for name in observables}
+    setPrecision(previousType)
+
+    report = {}
+    for name in observables:
+        obs64 = processed[np.float64][name]; obs32 = processed[np.float32][name]
+        reference = empirical[name] if empirical is not None else obs64
+        fit64 = observables[name].distance(obs64, reference)
+        fit32 = observables[name].distance(obs32, reference)
+        report[name] = {'float64': fit64, 'float32': fit32, 'difference': abs(fit32 - fit64),
+                        'maxObservableDifference': np.max(np.abs(obs32 - obs64))}
+        print(f"{name}: fitting float64={fit64:.6f}, float32={fit32:.6f}, difference={abs(fit32 - fit64):.2e}"
+              f" (max observable difference={report[name]['maxObservableDifference']:.2e})")
+    return report
+
+
+# ======================================================================
+# Benchmark: integration time and recorded memory in float64 and float32 (best of 3 runs)
+# ======================================================================
+if __name__ == '__main__':
+    import time
+    import WholeBrain.Utils.precision as precision  # the module the integrators see (not __main__)
+    import WholeBrain.Models.DynamicMeanField as DMF
+    import WholeBrain.Integrators.HeunStochastic as integrator
+    rng = np.random.default_rng(42)
+    N = 90; trials = 16
+    DMF.setParms({'SC': rng.random((N, N)) * 0.2 / N, 'we': 1., 'J': np.ones(N)})
+    integrator.neuronalModel = DMF; integrator.verbose = False; integrator.ds = 1.
+    for dtype in [np.float64, np.float32]:
+        precision.setPrecision(dtype)
+        integrator.simulate(0.1, 100., numTrials=trials)  # compile...
+        times = []
+        for run in range(3):
+            t0 = time.perf_counter()
+            recorded = integrator.simulate(0.1, 5000., numTrials=trials)
+            times.append(time.perf_counter() - t0)
+        print(f"{np.dtype(dtype).name}: {min(times):.2f}s, recorded activity {recorded.nbytes / 1e6:.0f}MB")
+# ======================================================================
+# ======================================================================
+# ======================================================================EOF
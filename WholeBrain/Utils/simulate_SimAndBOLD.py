@@ -12,6 +12,9 @@ import numpy as np
 import matplotlib.pyplot as plt
 integrator = None  # import WholeBrain.Integrator_EulerMaruyama as integrator
 BOLDModel = None  # import WholeBrain.BOLDHemModel_Stephan2007 as Stephan2007 # import WholeBrain.BOLDHemModel_Stephan2008 as Stephan2008
+warmStates = None  # import WholeBrain.Utils.warmStateCache as warmStates, to reuse warmed-up states across runs
+steadyStates = None  # import WholeBrain.Utils.steadyState as steadyStates, to start the warm-up at the model's fixed point
+onlineBOLD = None  # import WholeBrain.Utils.BOLD.onlineBOLD as onlineBOLD, to compute the BOLD signal during the integration
 # import WholeBrain.Observables.swFCD as FCD
 
 # Set General Model Parameters
@@ -39,18 +42,51 @@ def recomputeTmaxneuronal():  # if we need a different Tmax or TR or any other v
 # ============================================================================
 warmUp = False
 warmUpFactor = 10.
-def computeSubjectSimulation():
+def integrateSubject(numTrials=None):
     # integrator.neuronalModel.SC = C
     # integrator.initBookkeeping(N, Tmaxneuronal)
+    # With numTrials, all trials are integrated together as an ensemble, and we get (time, trials, N)
     if warmUp:
-        currObsVars = integrator.warmUpAndSimulate(dt, Tmaxneuronal, TWarmUp=Tmaxneuronal/warmUpFactor)
+        TWarmUp = Tmaxneuronal/warmUpFactor
+        initialSimVars = None
+        parms = integrator.neuronalModel.getRuntimeParms()
+        if steadyStates is not None:  # we start at the noise-free equilibrium, so a short noise burn-in suffices...
+            fixedPoint = steadyStates.solve(integrator.neuronalModel, parms=parms)
+            if steadyStates.converged and steadyStates.isStable(integrator.neuronalModel, fixedPoint, parms):
+                initialSimVars = fixedPoint if numTrials is None else np.repeat(fixedPoint[np.newaxis], numTrials, axis=0)
+                TWarmUp *= steadyStates.burnInFactor
+            # ...but only if it is an attractor: otherwise, the full warm-up (as below)
+        if initialSimVars is None and warmStates is not None:
+            initialSimVars = warmStates.lookup(parms, numTrials)
+            if initialSimVars is not None:  # we start from an already warm state, so a short re-equilibration suffices
+                TWarmUp *= warmStates.reEquilibrationFactor
+        currObsVars = integrator.warmUpAndSimulate(dt, Tmaxneuronal, TWarmUp=TWarmUp, numTrials=numTrials,
+                                                   initialSimVars=initialSimVars)
+        if warmStates is not None:
+            warmStates.store(parms, integrator.warmState)
     else:
-        currObsVars = integrator.simulate(dt, Tmaxneuronal)
+        currObsVars = integrator.simulate(dt, Tmaxneuronal, numTrials=numTrials)
+    return currObsVars
+
+
+def computeSubjectSimulation(numTrials=None):
+    currObsVars = integrateSubject(numTrials)
     # currObsVars = integrator.returnBookkeeping()  # curr_xn, curr_rn
-    neuro_act = currObsVars[:,0,:]  # curr_rn
+    neuro_act = currObsVars[...,0,:]  # curr_rn
     return neuro_act
 
 
+# The BOLD signal computed along with the integration, from the same observation var as neuro_act above,
+# without storing the neural activity (see WholeBrain.Utils.BOLD.onlineBOLD): (time, N), or (time, trials, N)
+def computeOnlineBOLD(numTrials=None):
+    onlineBOLD.BOLDModel = BOLDModel; onlineBOLD.TR = TR; onlineBOLD.dtt = dtt
+    integrator.onlineBOLD = onlineBOLD
+    try:
+        return integrateSubject(numTrials)
+    finally:
+        integrator.onlineBOLD = None
+
+
 def computeSubjectBOLD(neuro_act, areasToSimulate=None):
     if not areasToSimulate:
         N = neuro_act.shape[1]
@@ -62,23 +98,44 @@ def computeSubjectBOLD(neuro_act, areasToSimulate=None):
     # Friston BALLOON-WINDKESSEL MODEL
     BOLDModel.dt = dtt  # BOLD integration time = 1 millisecond = 1e-3 seconds
     T = np.round(neuro_act.shape[0] * dtt)  # Total time in seconds
+    step = int(np.round(TR/dtt))  # each step is the length of the TR, in milliseconds
+    if hasattr(BOLDModel, 'BOLDModelAllRegions'):  # all the regions in one call, keeping only the TR samples
+        x = neuro_act if areasToSimulate == range(N) else neuro_act[:, list(areasToSimulate)]
+        return BOLDModel.BOLDModelAllRegions(T, x, step)
     n_t = BOLDModel.computeRequiredVectorLength(T)
-    BOLD_act = np.zeros([n_t,N])
+    BOLD_act = np.zeros([n_t,N], dtype=neuro_act.dtype)  # keep the precision of the simulation
     for nnew,area in enumerate(areasToSimulate):
         B = BOLDModel.BOLDModel(T,neuro_act[:,area])
         BOLD_act[:,nnew] = B
 
-    step = int(np.round(TR/dtt))  # each step is the length of the TR, in milliseconds
     bds = BOLD_act[step-1::step, :]
     return bds
 
 
 def simulateSingleSubject():
     # N=C.shape[0]
+    if onlineBOLD is not None:
+        return computeOnlineBOLD()
     neuro_act = computeSubjectSimulation()
     bds = computeSubjectBOLD(neuro_act)
     return bds
 
+
+# ============================================================================
+# simulates numTrials subjects at once, as a single ensemble integration.
+# Returns the BOLD signals of all trials in a (numTrials, time, N) array.
+# ============================================================================
+def simulateMultipleSubjects(numTrials):
+    if onlineBOLD is not None:
+        return np.ascontiguousarray(computeOnlineBOLD(numTrials).transpose(1, 0, 2))
+    neuro_act = computeSubjectSimulation(numTrials=numTrials)
+    if hasattr(BOLDModel, 'BOLDModelAllRegions'):  # the regions of all trials, as the columns of a single call
+        timePoints, _, N = neuro_act.shape
+        bds = computeSubjectBOLD(neuro_act.reshape(timePoints, numTrials * N))
+        return np.ascontiguousarray(bds.reshape(-1, numTrials, N).transpose(1, 0, 2))
+    bds = np.stack([computeSubjectBOLD(neuro_act[:, trial, :]) for trial in range(numTrials)])
+    return bds
+
 # ============================================================================
 # ============================================================================
 # ============================================================================EOF
@@ -0,0 +1,176 @@
+# --------------------------------------------------------------------------
+# --------------------------------------------------------------------------
+# Sparse structural connectivity
+#
+# The models compute the coupling term as SC @ x (for each trial). For large parcellations with
+# thresholded tractography most SC entries are zero, and a CSR (compressed sparse row) product is much
+# cheaper than the dense one. The models pass SC to their compiled kernels through toRuntimeSC, which
+# gives either a dense array or a CSR (data, indices, indptr) tuple, and compute the coupling with
+# couple(SC, x) (or coupleInto, for in-place kernels), which works with both representations.
+#
+# With couplingMode = 'auto', the sparse representation is used when the fraction of non-zero entries
+# of SC is at most sparseDensityThreshold. The default threshold comes from the benchmark at the end of
+# this file (python -m WholeBrain.Utils.sparseCoupling), run it to find the crossover on your machine.
+# SC can also be given as a scipy.sparse matrix.
+# --------------------------------------------------------------------------
+# --------------------------------------------------------------------------
+import numpy as np
+import scipy.sparse as sparse
+from numba import jit, types, prange
+from numba.extending import overload
+from WholeBrain.Utils import precision
+from WholeBrain.Utils.numTricks import toRuntimeParm
+
+couplingMode = 'auto'  # 'auto', 'dense' or 'sparse'
+sparseDensityThreshold = 0.05  # crossover measured at ~5% for N=80..360, ~10-20% for N=1000..2000
+
+
+def density(SC):
+    if sparse.issparse(SC):
+        return SC.nnz / (SC.shape[0] * SC.shape[1])
+    return np.count_nonzero(SC) / SC.size
+
+
+def useSparse(SC):
+    if couplingMode == 'auto':
+        return density(SC) <= sparseDensityThreshold
+    return couplingMode == 'sparse'
+
+
+# Converts SC to the representation passed to the compiled kernels: a dense contiguous array or a CSR
+# tuple (data, indices, indptr), according to couplingMode
+def toRuntimeSC(SC):
+    if useSparse(SC):
+        csr = sparse.csr_matrix(SC)
+        csr.sum_duplicates()
+        return (np.ascontiguousarray(csr.data, dtype=precision.floatType),
+                csr.indices.astype(np.int64), csr.indptr.astype(np.int64))
+    return toRuntimeParm(SC.toarray() if sparse.issparse(SC) else SC)
+
+
+@jit(nopython=True)
+def csrCoupleInto(data, indices, indptr, x, out):
+    for i in range(out.shape[0]):
+        acc = 0.
+        for p in range(indptr[i], indptr[i+1]):
+            acc += data[p] * x[indices[p]]
+        out[i] = acc
+
+
+@jit(nopython=True)
+def csrCouple(data, indices, indptr, x):
+    N = x.shape[-1]
+    rows = np.ascontiguousarray(x).reshape((-1, N))
+    out = np.empty(rows.shape, dtype=rows.dtype)
+    for bb in range(rows.shape[0]):
+        csrCoupleInto(data, indices, indptr, rows[bb], out[bb])
+    return out.reshape(x.shape)
+
+
+# SC @ x for each trial, i.e., along the last axis of x, for a (dense or CSR) runtime SC
+def couple(SC, x):
+    if isinstance(SC, tuple):
+        return csrCouple(SC[0], SC[1], SC[2], x)
+    return np.ascontiguousarray(x) @ SC.T
+
+
+@overload(couple)
+def coupleCompiled(SC, x):
+    if isinstance(SC, types.BaseTuple):
+        return lambda SC, x: csrCouple(SC[0], SC[1], SC[2], x)
+    return lambda SC, x: np.ascontiguousarray(x) @ SC.T
+
+
+# out = SC @ x, for a single (N,) vector x, without allocating anything
+def coupleInto(SC, x, out):
+    if isinstance(SC, tuple):
+        csrCoupleInto(SC[0], SC[1], SC[2], x, out)
+    else:
+        np.dot(SC, x, out)
+
+
+@overload(coupleInto)
+def coupleIntoCompiled(SC, x, out):
+    if isinstance(SC, types.BaseTuple):
+        def coupleCSR(SC, x, out):
+            csrCoupleInto(SC[0], SC[1], SC[2], x, out)
+        return coupleCSR
+    def coupleDense(SC, x, out):
+        np.dot(SC, x, out)
+    return coupleDense
+
+
+# Parallel versions of coupleInto: the rows of the product are spread across threads
+# (see WholeBrain.Utils.parallelKernels)
+@jit(nopython=True, parallel=True)
+def denseCoupleIntoParallel(SC, x, out):
+    for i in prange(out.shape[0]):
+        acc = 0.
+        for j in range(x.shape[0]):
+            acc += SC[i, j] * x[j]
+        out[i] = acc
+
+
+@jit(nopython=True, parallel=True)
+def csrCoupleIntoParallel(data, indices, indptr, x, out):
+    for i in prange(out.shape[0]):
+        acc = 0.
+        for p in range(indptr[i], indptr[i+1]):
+            acc += data[p] * x[indices[p]]
+        out[i] = acc
+
+
+def coupleIntoParallel(SC, x, out):
+    if isinstance(SC, tuple):
+        csrCoupleIntoParallel(SC[0], SC[1], SC[2], x, out)
+    else:
+        denseCoupleIntoParallel(SC, x, out)
+
+
+@overload(coupleIntoParallel)
+def coupleIntoParallelCompiled(SC, x, out):
+    if isinstance(SC, types.BaseTuple):
+        def coupleCSR(SC, x, out):
+            csrCoupleIntoParallel(SC[0], SC[1], SC[2], x, out)
+        return coupleCSR
+    def coupleDense(SC, x, out):
+        denseCoupleIntoParallel(SC, x, out)
+    return coupleDense
+
+
+# ======================================================================
+# Benchmark: time per coupling product (for a single (N,) state) with the dense and the CSR
+# representations, for different sizes and densities, and the density at which they cross over.
+# ======================================================================
+if __name__ == '__main__':
+    import time
+
+    @jit(nopython=True)
+    def repeatCoupling(SC, x, out, reps):
+        for r in range(reps):
+            coupleInto(SC, x, out)
+
+    def timePerProduct(SC, x, reps):
+        out = np.empty_like(x)
+        repeatCoupling(SC, x, out, 1)  # compile...
+        t0 = time.perf_counter()
+        repeatCoupling(SC, x, out, reps)
+        return (time.perf_counter() - t0) / reps
+
+    rng = np.random.default_rng(42)
+    for N in [80, 360, 1000, 2000]:
+        reps = max(20, int(2e8 / N**2))
+        x = rng.random(N)
+        print(f"N={N}")
+        crossover = None
+        for dens in [0.01, 0.02, 0.05, 0.1, 0.2, 0.3, 0.5, 1.0]:
+            SC = rng.random((N, N)) * (rng.random((N, N)) < dens)
+            couplingMode = 'dense'; tDense = timePerProduct(toRuntimeSC(SC), x, reps)
+            couplingMode = 'sparse'; tSparse = timePerProduct(toRuntimeSC(SC), x, reps)
+            print(f"   density={dens:.2f}: dense={tDense*1e6:9.2f}us  sparse={tSparse*1e6:9.2f}us  speedup={tDense/tSparse:6.2f}")
+            if tSparse < tDense:
+                crossover = dens
+        print(f"   -> CSR is faster up to a density of {crossover}")
+# ======================================================================
+# ======================================================================
+# ======================================================================EOF
@@ -0,0 +1,190 @@
+# --------------------------------------------------------------------------
+# --------------------------------------------------------------------------
+# Steady-state (fixed point) solver for the noise-free network
+#
+# The models start from initSim values (zeros, 0.001, ...) and rely on long warm-ups to reach their
+# attractor. Instead, we can solve dfun(x) = 0 directly, with the stimulus at 0 and no noise, and start
+# the simulations at the equilibrium, with only a short noise burn-in.
+#
+# The solver is a Newton method with pseudo-transient continuation [Kelley_1998]. Each iteration first
+# tries a plain Newton step, J dx = -dfun(x), which is kept if it reduces the residual (so, close to the
+# equilibrium, we get quadratic convergence). Otherwise, it solves
+#     (I/tau - J) dx = dfun(x)
+# i.e., a backward Euler step of (pseudo) time tau, so the iterations follow the dynamics of the model
+# (and we end up at the fixed point the warm-up would reach), with tau growing as ||f_old||/||f_new||
+# (switched evolution relaxation) as the residual decreases.
+#
+# The Jacobian J is computed with finite differences of the compiled model dfun, evaluating all the
+# perturbed states as a single batch of "trials" (jacobianChunk columns at a time), so any model with a
+# (trials, vars, N)-capable dfun works without writing its derivatives by hand.
+#
+# [Kelley_1998] C.T. Kelley, D.E. Keyes, Convergence analysis of pseudo-transient continuation,
+#               SIAM J. Numer. Anal. 35 (1998), pp. 508-523
+#
+# Use it with simulate_SimAndBOLD.steadyStates = steadyState (and warmUp = True), which only starts at the
+# fixed point (with the short burn-in) if it converged and isStable, or directly, e.g.,
+#     x0 = steadyState.solve(model)
+#     if steadyState.converged and steadyState.isStable(model, x0):
+#         integrator.warmUpAndSimulate(dt, Tmax, TWarmUp=burnIn, initialSimVars=x0)
+# --------------------------------------------------------------------------
+# --------------------------------------------------------------------------
+import numpy as np
+from WholeBrain.Utils import precision
+
+verbose = False
+tol = 1e-10                # convergence: max |dfun(x)|
+maxIterations = 200
+initialPseudoStep = 1.     # initial tau, in the time units of the model
+fdStep = 1e-7              # relative finite difference step
+jacobianChunk = 1024       # number of perturbed states evaluated together
+burnInFactor = 0.05        # fraction of the usual warm-up to integrate from the fixed point (see simulate_SimAndBOLD)
+
+converged = False          # results of the last call to solve
+residual = np.inf
+iterations = 0
+
+
+def residualAt(model, simVars, parms):
+    return model.dfun(simVars, 0., parms)[0]
+
+
+# Finite-difference Jacobian of dfun at simVars (vars, N), as a (vars*N, vars*N) matrix in the order of
+# simVars.ravel()
+def jacobian(model, simVars, parms=None, f0=None):
+    if parms is None:
+        parms = model.getRuntimeParms()
+    simVars = np.ascontiguousarray(simVars, dtype=np.float64)
+    if f0 is None:
+        f0 = residualAt(model, simVars, parms)
+    x = simVars.ravel()
+    M = x.size
+    h = fdStep * np.maximum(np.abs(x), 1.)
+    J = np.empty((M, M))
+    for first in range(0, M, jacobianChunk):
+        cols = np.arange(first, min(first + jacobianChunk, M))
+        batch = np.repeat(x[np.newaxis], len(cols), axis=0)
+        batch[np.arange(len(cols)), cols] += h[cols]
+        fBatch = residualAt(model, batch.reshape((len(cols),) + simVars.shape), parms)
+        J[:, cols] = ((fBatch.reshape(len(cols), M) - f0.ravel()) / h[cols, np.newaxis]).T
+    return J
+
+
+# x - A^{-1} f, and its residual (inf if A is singular or the residual is not finite)
+def step(model, x, parms, A, f):
+    try:
+        xNew = x - np.linalg.solve(A, f.ravel()).reshape(x.shape)
+    except np.linalg.LinAlgError:
+        return x, f, np.inf
+    fNew = residualAt(model, xNew, parms)
+    fNewNorm = np.max(np.abs(fNew))
+    return xNew, fNew, (fNewNorm if np.isfinite(fNewNorm) else np.inf)
+
+
+# Solves dfun(x) = 0 from simVars (model.initSim by default). Returns the fixed point as (vars, N), or
+# repeated along a leading axis as (numTrials, vars, N), in the pipeline precision. If it does not
+# converge, it returns the last iterate (check converged and residual).
+def solve(model, simVars=None, numTrials=None, parms=None):
+    global converged, residual, iterations
+    if parms is None:
+        parms = model.getRuntimeParms()
+    if simVars is None:
+        simVars = model.initSim(model.getParm('SC').shape[0])
+    x = np.array(simVars, dtype=np.float64)
+    f = residualAt(model, x, parms)
+    fNorm = np.max(np.abs(f))
+    tau = initialPseudoStep
+    I = np.eye(x.size)
+    iterations = 0
+    while fNorm > tol and iterations < maxIterations:
+        iterations += 1
+        J = jacobian(model, x, parms, f)
+        xNew, fNew, fNewNorm = step(model, x, parms, J, f)  # Newton step
+        if fNewNorm < fNorm:
+            x, f, fNorm = xNew, fNew, fNewNorm
+            kind = "Newton"
+        else:
+            xNew, fNew, fNewNorm = step(model, x, parms, J - I / tau, f)  # pseudo-transient step
+            if fNewNorm < 2. * fNorm:  # accept, and grow the pseudo time step as the residual decreases
+                tau = min(tau * fNorm / max(fNewNorm, 1e-300), 1e12)
+                x, f, fNorm = xNew, fNew, fNewNorm
+            else:  # too far: go back to shorter (more time-stepping-like) steps
+                tau /= 4.
+            kind = "pseudo-transient"
+        if verbose:
+            print(f"   steady state: iteration {iterations} ({kind}), residual={fNorm:.3e}, tau={tau:.3e}")
+    converged = fNorm <= tol
+    residual = fNorm
+    if verbose:
+        print(f"Steady state {'found' if converged else 'NOT found'} after {iterations} iterations (residual={fNorm:.3e})")
+    x = x.astype(precision.floatType)
+    if numTrials is not None:
+        x = np.repeat(x[np.newaxis], numTrials, axis=0)
+    return x
+
+
+# Whether the fixed point (vars, N) is linearly stable, i.e., all the eigenvalues of the Jacobian there
+# have negative real parts. Otherwise (e.g., supHopf with a > 0), the noise drives the simulation away from
+# it, and a short burn-in from there is not a warm-up.
+def isStable(model, fixedPoint, parms=None):
+    eigenvalues = np.linalg.eigvals(jacobian(model, np.asarray(fixedPoint, dtype=np.float64), parms))
+    return np.max(eigenvalues.real) < 0.
+
+
+# Natural parameter continuation: the fixed points for each of the values of the model parameter
+# parmName (e.g., 'we'), each one starting from the previous one. Returns them stacked,
+# (len(values), vars, N), and whether each one converged.
+def continuation(model, parmName, values, simVars=None):
+    states = []; convergedAll = []
+    for value in values:
+        model.setParms({parmName: value})
+        simVars = solve(model, simVars)
+        states.append(simVars); convergedAll.append(converged)
+    return np.stack(states), np.array(convergedAll)
+
+
+# ======================================================================
+# Test code: the fixed point vs. a noise-free integration, for the DMF and Chen and Campbell models. For the
+# latter, the adaptation variables are very slow (tens of thousands of steps are far from enough to settle)
+# ======================================================================
+if __name__ == '__main__':
+    import time
+    import WholeBrain.Integrators.HeunStochastic as integrator
+    import WholeBrain.Utils.steadyState as steadyState  # the module the test sees (not __main__)
+    integrator.verbose = False
+    rng = np.random.default_rng(42)
+    N = 80
+    SC = rng.random((N, N)) * 0.2 / N
+
+    import WholeBrain.Models.DynamicMeanField as DMF
+    import WholeBrain.Models.Chen_Campbell_Whole_Brain_version as CN
+    for model, parms, dt, T in [(DMF, {'SC': SC, 'we': 1., 'J': np.ones(N)}, 0.1, 10000.),
+                                (CN, {'SC': SC, 'we': 0.5, 'J': 1.}, 0.001, 50.)]:
+        model.setParms(parms)
+        integrator.neuronalModel = model
+        integrator.sigma = 0.; integrator.ds = dt
+        steadyState.solve(model)  # compile...
+        t0 = time.perf_counter()
+        x0 = steadyState.solve(model)
+        tSolve = time.perf_counter() - t0
+        integrator.initStimuli(dt, T)
+        xT, _ = integrator.integrate(dt, T, integrator.initSimVars(), doBookkeeping=False)
+        t0 = time.perf_counter()
+        xT, _ = integrator.integrate(dt, T, integrator.initSimVars(), doBookkeeping=False)
+        tWarm = time.perf_counter() - t0
+        x0T, _ = integrator.integrate(dt, T, x0.copy(), doBookkeeping=False)
+        eigs = np.linalg.eigvals(steadyState.jacobian(model, x0))
+        print(f"{model.__name__}: converged={steadyState.converged} in {steadyState.iterations} iterations "
+              f"({tSolve:.2f}s), residual={steadyState.residual:.2e}, max Re(eig)={eigs.real.max():.3e}")
+        print(f"   integrating {T} from the fixed point, it moves {np.max(np.abs(x0T - x0)):.3e}; "
+              f"from initSim ({tWarm:.2f}s), it ends at {np.max(np.abs(xT - x0)):.3e} from it")
+
+    # The origin is a fixed point of supHopf for any a, but only an attractor for a < 0
+    import WholeBrain.Models.supHopf as Hopf
+    Hopf.setParms({'SC': SC, 'we': 1., 'omega': 0.3 * np.ones(N)})
+    for a in [-0.5, 0.1]:
+        Hopf.setParms({'a': a * np.ones(N)})
+        x0 = steadyState.solve(Hopf)
+        print(f"supHopf, a={a}: converged={steadyState.converged}, stable={steadyState.isStable(Hopf, x0)}")
+# ======================================================================
+# ======================================================================
+# ======================================================================EOF
@@ -0,0 +1,123 @@
+# --------------------------------------------------------------------------
+# --------------------------------------------------------------------------
+# Warm-up state cache
+#
+# Warming up a simulation from initSim values means integrating a long transient for every subject at
+# every point of a parameter sweep. However, the state reached at the end of a warm-up is a perfectly
+# good starting point for another run with the same (or a nearby) set of parameters. So, we store the
+# warmed-up states keyed by the model parameters (as given by neuronalModel.getRuntimeParms()), and new
+# runs start from the stored state of the nearest parameter point, with a shorter re-equilibration
+# (reEquilibrationFactor times the full warm-up) and, of course, fresh noise.
+#
+# The key separates the connectivity, i.e., the parameters that are not scalars or per-node vectors (the
+# SC, dense or as a CSR tuple, see WholeBrain.Utils.sparseCoupling), from the rest. The connectivity must
+# match exactly (we compare a fingerprint of it), and the distance to the nearest point (and maxDistance)
+# is measured on the scalar and per-node parameters only, e.g., we and J.
+#
+# Use it by setting simulate_SimAndBOLD.warmStates = warmStateCache (and warmUp = True).
+# --------------------------------------------------------------------------
+# --------------------------------------------------------------------------
+import hashlib
+import numpy as np
+
+reEquilibrationFactor = 0.1  # fraction of the full warm-up time to integrate from a cached state
+maxDistance = np.inf  # only states at, at most, this (Euclidean) distance in parameter space are reused
+maxStates = 1000  # when there are more states than this, the oldest ones are discarded
+
+keys = []  # (connectivity fingerprint, flattened scalar and per-node parameters) of each stored state
+states = []  # the stored states, as (trials, vars, N) arrays
+
+
+def clear():
+    keys.clear()
+    states.clear()
+
+
+def addParms(parms, values, fingerprint, connectivity=False):
+    for p in parms:
+        if isinstance(p, tuple):  # a CSR SC, (data, indices, indptr)
+            addParms(p, values, fingerprint, connectivity=True)
+        elif np.ndim(p) <= 1 and not connectivity:
+            values.append(np.ravel(p).astype(float))
+        else:
+            p = np.ascontiguousarray(p)
+            fingerprint.update(f"{p.dtype}{p.shape}".encode())
+            fingerprint.update(p.tobytes())
+
+
+def parmsKey(parms):
+    values = []; fingerprint = hashlib.sha1()
+    addParms(parms, values, fingerprint)
+    return fingerprint.hexdigest(), np.concatenate(values) if values else np.zeros(0)
+
+
+def sameKind(key, other):  # same connectivity, and the same number of parameter values
+    return key[0] == other[0] and key[1].shape == other[1].shape
+
+
+# Returns the stored state with the nearest parameters, adapted to numTrials trials (None for a single
+# trial), or None if there is none close enough...
+def lookup(parms, numTrials=None):
+    key = parmsKey(parms)
+    candidates = [i for i in range(len(keys)) if sameKind(keys[i], key)]
+    if not candidates:
+        return None
+    distances = [np.linalg.norm(keys[i][1] - key[1]) for i in candidates]
+    nearest = int(np.argmin(distances))
+    if distances[nearest] > maxDistance:
+        return None
+    state = states[candidates[nearest]]
+    if numTrials is None:
+        return state[0].copy()
+    return state[np.arange(numTrials) % state.shape[0]]  # fancy indexing already gives us a copy
+
+
+# Stores a warmed-up state, (vars, N) or (trials, vars, N), replacing any state with the same parameters
+def store(parms, simVars):
+    key = parmsKey(parms)
+    state = simVars.reshape((-1,) + simVars.shape[-2:]).copy()
+    for i in range(len(keys)):
+        if sameKind(keys[i], key) and np.array_equal(keys[i][1], key[1]):
+            states[i] = state
+            return
+    keys.append(key)
+    states.append(state)
+    if len(keys) > maxStates:
+        del keys[0]
+        del states[0]
+
+
+# ======================================================================
+# Test code: a DMF with a sparse (2% density, so a CSR runtime SC) connectome, through the cache and a
+# warmed-up simulate_SimAndBOLD run, and the distances measured on we and J only
+# ======================================================================
+if __name__ == '__main__':
+    import scipy.sparse as sparse
+    import WholeBrain.Utils.warmStateCache as warmStates  # the module simulate_SimAndBOLD sees (not __main__)
+    import WholeBrain.Models.DynamicMeanField as DMF
+    import WholeBrain.Integrators.HeunStochastic as integrator
+    import WholeBrain.Utils.simulate_SimAndBOLD as simulateBOLD
+    N = 200
+    SC = sparse.random(N, N, density=0.02, random_state=42).toarray() * 0.1
+    DMF.setParms({'SC': SC, 'we': 1., 'J': np.ones(N)})
+    integrator.neuronalModel = DMF; integrator.verbose = False; integrator.ds = 1.
+    print(f"runtime SC is CSR: {isinstance(DMF.getRuntimeParms()[2], tuple)}")
+    for we in [1., 2.]:
+        DMF.setParms({'we': we})
+        warmStates.store(DMF.getRuntimeParms(), np.full((2, N), we))
+    DMF.setParms({'we': 1.2})
+    warmStates.maxDistance = 0.5
+    print(f"we=1.2 starts from the state of we={warmStates.lookup(DMF.getRuntimeParms())[0, 0]}")
+    DMF.setParms({'SC': SC * 2.})
+    print(f"another SC: {warmStates.lookup(DMF.getRuntimeParms())}")
+    warmStates.clear(); warmStates.maxDistance = np.inf
+    simulateBOLD.integrator = integrator; simulateBOLD.warmStates = warmStates; simulateBOLD.warmUp = True
+    simulateBOLD.Tmaxneuronal = 1000.
+    for we in [1., 1.1]:
+        DMF.setParms({'we': we})
+        simulateBOLD.integrateSubject(numTrials=2)
+        print(f"we={we}: {len(warmStates.keys)} stored state(s)")
+
+# ======================================================================
+# ======================================================================
+# ======================================================================EOF